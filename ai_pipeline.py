@@ -0,0 +1,163 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class TokenBucket:
+    """
+    线程安全的令牌桶：每秒补 rate 个令牌，最多攒 burst 个。acquire 阻塞调用线程直到拿到令牌；
+    给了 deadline（time.monotonic() 时刻）且等不到时返回 False，不占用令牌。
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {"acquired": 0, "rejected": 0, "waited": 0, "wait_seconds": 0.0}
+
+    def acquire(self, deadline=None):
+        if self.rate <= 0:
+            return True
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self._stats["acquired"] += 1
+                    if waited:
+                        self._stats["waited"] += 1
+                        self._stats["wait_seconds"] += waited
+                    return True
+                wait = (1 - self._tokens) / self.rate
+                if deadline is not None and now + wait > deadline:
+                    self._stats["rejected"] += 1
+                    return False
+            time.sleep(wait)
+            waited += wait
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+        data["wait_seconds"] = round(data["wait_seconds"], 2)
+        data["rate_per_minute"] = round(self.rate * 60, 2)
+        data["burst"] = self.burst
+        return data
+
+
+class BatchClassifier:
+    """
+    并发的 AI 判定管线。classify(kind, prompt) 提交一条判定并等待结果：
+    同一 kind 在 window_ms 内到达的请求凑成一批（最多 max_batch 条），交给 run_batch 合成一次请求，
+    run_batch 返回与 prompts 对齐的结果列表，缺项（None）或整批失败时这几条退回 run_single 逐条请求。
+    阻塞的 HTTP 调用在自带的 concurrency 个线程里执行；每条请求带 deadline，过期抛 DeadlineExceeded。
+    run_single(prompt, deadline) / run_batch(kind, prompts, deadline) 都在工作线程里调用。
+    """
+
+    def __init__(self, run_single, run_batch=None, concurrency=4, max_batch=1, window_ms=50, deadline=90.0, logger=None):
+        self.run_single = run_single
+        self.run_batch = run_batch
+        self.concurrency = max(1, int(concurrency))
+        self.max_batch = max(1, int(max_batch)) if run_batch else 1
+        self.window = max(0, int(window_ms)) / 1000.0
+        self.deadline = float(deadline)
+        self.logger = logger
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="AIClassifier")
+        self._pending = {}  # kind -> [(prompt, deadline, future)]
+        self._timers = {}
+        self._stats = {
+            "requests": 0, "calls": 0, "batches": 0, "batched_items": 0,
+            "batch_fallbacks": 0, "errors": 0, "deadline_exceeded": 0,
+        }
+
+    async def classify(self, kind, prompt, timeout=None):
+        self._stats["requests"] += 1
+        loop = asyncio.get_event_loop()
+        deadline = time.monotonic() + (self.deadline if timeout is None else float(timeout))
+        future = loop.create_future()
+        batch = self._pending.setdefault(kind, [])
+        batch.append((prompt, deadline, future))
+        if len(batch) >= self.max_batch:
+            self._flush(kind)
+        elif kind not in self._timers:
+            self._timers[kind] = loop.call_later(self.window, self._flush, kind)
+        return await asyncio.shield(future)
+
+    def stats(self):
+        data = dict(self._stats)
+        data["avg_batch_size"] = round(data["batched_items"] / data["batches"], 2) if data["batches"] else 0.0
+        data["concurrency"] = self.concurrency
+        data["max_batch"] = self.max_batch
+        data["pending"] = sum(len(batch) for batch in self._pending.values())
+        return data
+
+    def _flush(self, kind):
+        timer = self._timers.pop(kind, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(kind, None)
+        if batch:
+            asyncio.get_event_loop().create_task(self._run(kind, batch))
+
+    async def _run(self, kind, batch):
+        try:
+            await self._run_batch(kind, batch)
+        except asyncio.CancelledError:
+            for _, _, future in batch:
+                future.cancel()
+            raise
+
+    async def _run_batch(self, kind, batch):
+        loop = asyncio.get_event_loop()
+        if len(batch) > 1:
+            deadline = min(item[1] for item in batch)
+            self._stats["batches"] += 1
+            self._stats["batched_items"] += len(batch)
+            self._stats["calls"] += 1
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self.run_batch, kind, [item[0] for item in batch], deadline
+                )
+            except Exception as e:
+                results = None
+                self._count_error(e)
+                if self.logger:
+                    self.logger.warning(f"⚠️ [AIClassifier] {kind} 批量判定失败，逐条重试: {e}")
+            results = list(results or ())
+            leftovers = []
+            for idx, (prompt, item_deadline, future) in enumerate(batch):
+                result = results[idx] if idx < len(results) else None
+                if result is None:
+                    leftovers.append((prompt, item_deadline, future))
+                elif not future.done():
+                    future.set_result(result)
+            if leftovers:
+                self._stats["batch_fallbacks"] += len(leftovers)
+            batch = leftovers
+        await asyncio.gather(*(self._run_one(prompt, deadline, future) for prompt, deadline, future in batch))
+
+    async def _run_one(self, prompt, deadline, future):
+        self._stats["calls"] += 1
+        try:
+            result = await asyncio.get_event_loop().run_in_executor(self._executor, self.run_single, prompt, deadline)
+        except Exception as e:
+            self._count_error(e)
+            if not future.done():
+                future.set_exception(e)
+                # 调用方已取消时也不要留下 "exception was never retrieved"
+                future.exception()
+            return
+        if not future.done():
+            future.set_result(result)
+
+    def _count_error(self, error):
+        self._stats["deadline_exceeded" if isinstance(error, DeadlineExceeded) else "errors"] += 1
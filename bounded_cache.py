@@ -0,0 +1,163 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+_MISSING = object()
+_registry = weakref.WeakValueDictionary()
+
+
+class BoundedCache(MutableMapping):
+    """
+    线程安全的 LRU 缓存：按访问顺序淘汰，可设条数上限、默认/单条 TTL 以及按 sizeof 估算的内存上限。
+    用法与 dict 相同；`in` 只判断是否存在（会清掉已过期条目），不计命中也不刷新顺序。
+    """
+
+    def __init__(self, name, maxsize=10000, ttl=None, max_bytes=None, sizeof=None):
+        self.name = name
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof if max_bytes else None
+        self._data = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        _registry[id(self)] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._live_item(key)
+            if item is None:
+                self._misses += 1
+                return default
+            self._hits += 1
+            self._data.move_to_end(key)
+            return item[0]
+
+    def peek(self, key, default=None):
+        """读取但不计命中、不刷新 LRU 顺序。"""
+        with self._lock:
+            item = self._live_item(key)
+            return default if item is None else item[0]
+
+    def snapshot(self):
+        """按 LRU 顺序（最旧在前）返回 [(key, value), ...] 的副本，不影响统计。"""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, item[0]) for key, item in self._data.items() if item[1] is None or item[1] > now]
+
+    def set(self, key, value, ttl=_MISSING):
+        ttl = self.ttl if ttl is _MISSING else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        size = self.sizeof(value) if self.sizeof else 0
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+            self._shrink()
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._bytes -= self._data.pop(key)[2]
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._live_item(key) is not None
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            value = self.get(key, _MISSING)
+            if value is _MISSING:
+                self.set(key, default)
+                value = default
+            return value
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                if default is _MISSING:
+                    raise KeyError(key)
+                return default
+            self._bytes -= item[2]
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def purge_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, item in self._data.items() if item[1] is not None and item[1] <= now]
+            for key in expired:
+                self._bytes -= self._data.pop(key)[2]
+            self._expirations += len(expired)
+            return len(expired)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "bytes": self._bytes if self.sizeof else None,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else None,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
+
+    def _live_item(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= time.monotonic():
+            del self._data[key]
+            self._bytes -= item[2]
+            self._expirations += 1
+            return None
+        return item
+
+    def _shrink(self):
+        while len(self._data) > self.maxsize or (self.sizeof and self._bytes > self.max_bytes and len(self._data) > 1):
+            _, (_, _, size) = self._data.popitem(last=False)
+            self._bytes -= size
+            self._evictions += 1
+
+
+def cache_stats():
+    """所有存活 BoundedCache 的统计，按名字索引。"""
+    return {cache.name: cache.stats() for cache in sorted(list(_registry.values()), key=lambda cache: cache.name)}
+
+
+def purge_expired_caches():
+    return sum(cache.purge_expired() for cache in list(_registry.values()))
@@ -0,0 +1,72 @@
+import json
+import threading
+import time
+from collections import deque
+
+
+class ChatEventHub:
+    """
+    实时 chat 事件广播：所有订阅者共享一个环形缓冲，事件 id 单调递增。
+    事件只在发布时序列化一次，并附带 (chat_id, source, event_type) 供订阅者过滤；
+    断线重连按 Last-Event-ID 从缓冲里续传，续传点已被覆盖（或进程重启）时通知客户端整页重载。
+    """
+
+    def __init__(self, capacity=2000):
+        self.capacity = max(1, int(capacity))
+        self._buffer = deque(maxlen=self.capacity)
+        self._cond = threading.Condition()
+        # 以启动时刻（微秒）作为起点：重启后旧客户端带来的 id 一定落在缓冲之外，会被判定为需要重载
+        self._last_id = time.time_ns() // 1000
+        self._published = 0
+        self._resets = 0
+
+    def publish(self, row):
+        meta = (row.get("chat_id"), row.get("source"), row.get("event_type"))
+        payload = json.dumps(row, ensure_ascii=False)
+        with self._cond:
+            self._last_id += 1
+            self._buffer.append((self._last_id, meta, payload))
+            self._published += 1
+            self._cond.notify_all()
+        return self._last_id
+
+    @property
+    def last_id(self):
+        with self._cond:
+            return self._last_id
+
+    def read(self, after_id, timeout=25.0):
+        """
+        返回 (events, cursor, reset)：events 为 [(id, meta, payload), ...]，cursor 为下次调用的 after_id。
+        没有新事件时最多阻塞 timeout 秒；reset=True 表示 after_id 之后的事件已不在缓冲里。
+        """
+        with self._cond:
+            if not self._resumable(after_id):
+                self._resets += 1
+                return [], self._last_id, True
+            if after_id == self._last_id:
+                self._cond.wait(timeout)
+                if not self._resumable(after_id):
+                    self._resets += 1
+                    return [], self._last_id, True
+            events = []
+            for item in reversed(self._buffer):
+                if item[0] <= after_id:
+                    break
+                events.append(item)
+            events.reverse()
+            return events, self._last_id, False
+
+    def _resumable(self, after_id):
+        oldest = self._buffer[0][0] if self._buffer else self._last_id + 1
+        return oldest - 1 <= after_id <= self._last_id
+
+    def stats(self):
+        with self._cond:
+            return {
+                "capacity": self.capacity,
+                "buffered": len(self._buffer),
+                "last_id": self._last_id,
+                "published": self._published,
+                "resets": self._resets,
+            }
@@ -0,0 +1,239 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+
+class ChatLogPartitions:
+    """
+    chat log 按月分区：context（快照/新消息/文本日志）与 audit（编辑/删除）两个族各自一组
+    <prefix>_<family>_<YYYYMM>.db 文件。保留期清理直接卸载并删除整月文件，查询只挂载时间窗口内的分区。
+    分区列表按目录变化定期刷新，其他进程新建/删除的分区最多 refresh_interval 秒后可见。
+    """
+
+    FAMILIES = ("context", "audit")
+    # 这些表的自增 id 在各分区从 YYYYMM * 10^9 起，跨分区、跨旧库都不会撞号
+    SEQUENCE_TABLES = ("chat_events", "chat_logs")
+
+    def __init__(self, base_dir, prefix="chat_logs", init_schema=None, max_attached=10, tz=None, refresh_interval=5.0):
+        self.base_dir = base_dir or "."
+        self.prefix = prefix
+        self.init_schema = init_schema
+        # SQLite 默认最多同时 ATTACH 10 个库
+        self.max_attached = max(2, int(max_attached))
+        self.tz = tz or timezone(timedelta(hours=8))
+        self._lock = threading.Lock()
+        self._keys = {family: set() for family in self.FAMILIES}
+        self._touched = set()
+        self._seeded = set()
+        self._readers = {}  # (family, key) -> 正在挂载该分区的读连接数
+        self._doomed = set()  # 已 drop、等最后一个读连接卸载后再删文件的分区
+        self.refresh_interval = refresh_interval
+        self._checked_at = 0.0
+        self._dir_mtime = None
+        self._name_re = re.compile(rf"^{re.escape(prefix)}_({'|'.join(self.FAMILIES)})_(\d{{6}})\.db$")
+        self.refresh()
+
+    def refresh(self):
+        keys = {family: set() for family in self.FAMILIES}
+        try:
+            mtime = os.stat(self.base_dir).st_mtime_ns
+            names = os.listdir(self.base_dir)
+        except OSError:
+            mtime, names = None, []
+        for name in names:
+            match = self._name_re.match(name)
+            if match:
+                keys[match.group(1)].add(match.group(2))
+        with self._lock:
+            for family, key in self._doomed:
+                keys[family].discard(key)
+            self._keys = keys
+            self._dir_mtime = mtime
+            self._checked_at = time.monotonic()
+
+    def _maybe_refresh(self):
+        if not self.refresh_interval or time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+        try:
+            mtime = os.stat(self.base_dir).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._dir_mtime:
+            self.refresh()
+        else:
+            self._checked_at = time.monotonic()
+
+    def month_key(self, ts):
+        return datetime.fromtimestamp(float(ts), self.tz).strftime("%Y%m")
+
+    def month_bounds(self, key):
+        start = datetime.strptime(key, "%Y%m").replace(tzinfo=self.tz)
+        end = (start + timedelta(days=32)).replace(day=1)
+        return start.timestamp(), end.timestamp()
+
+    def path(self, family, key):
+        return os.path.join(self.base_dir, f"{self.prefix}_{family}_{key}.db")
+
+    def schema(self, family, key):
+        return f"{family}_{key}"
+
+    def keys(self, family, start_ts=None, end_ts=None, newest_first=False):
+        self._maybe_refresh()
+        with self._lock:
+            keys = sorted(self._keys[family], reverse=newest_first)
+        if start_ts is not None:
+            first = self.month_key(start_ts)
+            keys = [key for key in keys if key >= first]
+        if end_ts is not None:
+            last = self.month_key(end_ts)
+            keys = [key for key in keys if key <= last]
+        return keys
+
+    def exists(self, family, key):
+        self._maybe_refresh()
+        with self._lock:
+            return key in self._keys[family]
+
+    def ensure(self, family, key):
+        if self.exists(family, key):
+            return self.path(family, key)
+        path = self.path(family, key)
+        with sqlite3.connect(path) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if self.init_schema:
+                self.init_schema(conn)
+            self._seed_sequences(conn, "main", key)
+            conn.commit()
+        with self._lock:
+            # 刚 drop、文件还等着读连接卸载的分区又有写入：取消删除
+            self._doomed.discard((family, key))
+            self._keys[family].add(key)
+            self._seeded.add((family, key))
+        return path
+
+    def _seed_sequences(self, conn, schema, key):
+        base = int(key) * 1_000_000_000
+        tables = {row[0] for row in conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type='table'").fetchall()}
+        if "sqlite_sequence" not in tables:
+            return
+        for table in self.SEQUENCE_TABLES:
+            if table not in tables:
+                continue
+            # 旧分区里 chat_logs 从 1 开始计数：把序号抬到本月基数，之后新写入的 id 不再与别的分区重复
+            conn.execute(f"UPDATE {schema}.sqlite_sequence SET seq=? WHERE name=? AND seq < ?", (base, table, base))
+            conn.execute(
+                f"""INSERT INTO {schema}.sqlite_sequence(name, seq)
+                    SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM {schema}.sqlite_sequence WHERE name=?)""",
+                (table, base, table)
+            )
+
+    def expired(self, family, cutoff_ts):
+        return [key for key in self.keys(family) if self.month_bounds(key)[1] <= cutoff_ts]
+
+    def drop(self, family, key, conn=None):
+        """卸载并删除整月分区；还有读连接挂着它时只摘掉 key，等最后一个读连接卸载后再删文件。"""
+        if conn is not None:
+            self.detach(conn, self.schema(family, key))
+        with self._lock:
+            self._keys[family].discard(key)
+            self._seeded.discard((family, key))
+            if self._readers.get((family, key)):
+                self._doomed.add((family, key))
+                return
+        self._remove_files(family, key)
+
+    def _remove_files(self, family, key):
+        path = self.path(family, key)
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def attached(self, conn):
+        return [row[1] for row in conn.execute("PRAGMA database_list").fetchall() if row[1] not in ("main", "temp")]
+
+    def attach(self, conn, family, key):
+        schema = self.schema(family, key)
+        if schema in self.attached(conn):
+            return schema
+        if not self.exists(family, key):
+            return None
+        path = self.path(family, key)
+        if not os.path.exists(path):
+            # 已被其他进程删除：ATTACH 会建出一个空库，直接当作不存在
+            with self._lock:
+                self._keys[family].discard(key)
+            return None
+        conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+        return schema
+
+    def detach(self, conn, schema):
+        if schema in self.attached(conn):
+            conn.execute(f"DETACH DATABASE {schema}")
+
+    def begin_batch(self):
+        self._touched = set()
+
+    def attach_for_write(self, conn, family, key):
+        """写线程专用：分区不存在则创建；挂载数达上限时卸载本批次未用到的最旧分区。"""
+        self.ensure(family, key)
+        schema = self.schema(family, key)
+        attached = self.attached(conn)
+        if schema not in attached:
+            idle = sorted((name for name in attached if name not in self._touched), key=lambda name: name.split("_")[-1])
+            while len(attached) >= self.max_attached and idle:
+                victim = idle.pop(0)
+                conn.execute(f"DETACH DATABASE {victim}")
+                attached.remove(victim)
+            if len(attached) >= self.max_attached:
+                raise sqlite3.OperationalError(f"too many attached partitions ({self.max_attached})")
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (self.path(family, key),))
+        if (family, key) not in self._seeded:
+            self._seed_sequences(conn, schema, key)
+            with self._lock:
+                self._seeded.add((family, key))
+        self._touched.add(schema)
+        return schema
+
+    @contextmanager
+    def mounted(self, conn, items):
+        """读连接临时挂载 [(family, key), ...]，按顺序返回 schema 名（分区不存在为 None），退出时卸载。"""
+        schemas = []
+        held = []
+        try:
+            for family, key in items:
+                with self._lock:
+                    self._readers[(family, key)] = self._readers.get((family, key), 0) + 1
+                held.append((family, key))
+                schemas.append(self.attach(conn, family, key))
+            yield schemas
+        finally:
+            for schema in schemas:
+                if schema:
+                    try:
+                        self.detach(conn, schema)
+                    except sqlite3.OperationalError:
+                        pass
+            for item in held:
+                self._release_reader(item)
+
+    def _release_reader(self, item):
+        with self._lock:
+            count = self._readers.get(item, 0) - 1
+            if count > 0:
+                self._readers[item] = count
+                return
+            self._readers.pop(item, None)
+            if item not in self._doomed:
+                return
+            self._doomed.discard(item)
+        self._remove_files(*item)
+
+    def stats(self):
+        with self._lock:
+            return {family: sorted(keys) for family, keys in self._keys.items()}
@@ -0,0 +1,226 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+
+
+class _FlushMarker:
+    def __init__(self):
+        self.event = threading.Event()
+
+
+class ChatLogWriter:
+    """
+    chat_logs.db 单写线程：所有写入以 job(conn) 形式入队，由独立线程按
+    batch_size 条或 flush_interval_ms 毫秒合并成一个事务提交，调用方只负责入队。
+    """
+
+    def __init__(
+        self,
+        db_path,
+        logger,
+        batch_size=200,
+        flush_interval_ms=50,
+        max_queue_size=20000,
+        busy_timeout_ms=5000,
+        before_batch=None,
+    ):
+        self.db_path = db_path
+        self.logger = logger
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(1, int(flush_interval_ms)) / 1000.0
+        self.max_queue_size = max(1, int(max_queue_size))
+        self.busy_timeout_ms = max(0, int(busy_timeout_ms))
+        self.before_batch = before_batch
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._conn = None
+        self._stopping = False
+        self._last_drop_log_at = 0.0
+        self._stats = {
+            "batches": 0,
+            "jobs": 0,
+            "failed_jobs": 0,
+            "dropped": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_commit_ms": 0.0,
+            "max_commit_ms": 0.0,
+            "total_commit_ms": 0.0,
+            "last_queue_wait_ms": 0.0,
+            "max_queue_wait_ms": 0.0,
+            "last_commit_at": None,
+            "last_error": "",
+        }
+
+    def start(self):
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="ChatLogWriter", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def submit(self, job, on_commit=None, timeout=0, prepare=None):
+        """
+        job(conn) 在写线程内执行，返回值在事务提交后传给 on_commit(result)（None 不回调）。
+        prepare(conn) 在本批事务开始前执行，用于 ATTACH 等不能放进事务的操作。
+        timeout=0 表示队列满时直接丢弃；>0 表示最多阻塞等待这么多秒。
+        """
+        if self._stopping:
+            return False
+        self.start()
+        item = (job, on_commit, time.monotonic(), prepare)
+        try:
+            if timeout and timeout > 0:
+                self._queue.put(item, timeout=timeout)
+            else:
+                self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            with self._stats_lock:
+                self._stats["dropped"] += 1
+                dropped = self._stats["dropped"]
+            now = time.monotonic()
+            if now - self._last_drop_log_at >= 30:
+                self._last_drop_log_at = now
+                self.logger.warning(f"⚠️ [ChatLogWriter] 写入队列已满({self.max_queue_size})，累计丢弃 {dropped} 条")
+            return False
+
+    def flush(self, timeout=5.0):
+        if not self._thread or not self._thread.is_alive():
+            return True
+        marker = _FlushMarker()
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.event.wait(timeout)
+
+    def stop(self, timeout=5.0):
+        if self._stopping:
+            return
+        self.flush(timeout=timeout)
+        self._stopping = True
+
+    def stats(self):
+        with self._stats_lock:
+            data = dict(self._stats)
+        total_commit_ms = data.pop("total_commit_ms")
+        data["avg_commit_ms"] = round(total_commit_ms / data["batches"], 3) if data["batches"] else 0.0
+        data["avg_batch_size"] = round(data["jobs"] / data["batches"], 2) if data["batches"] else 0.0
+        data["queue_depth"] = self._queue.qsize()
+        data["max_queue_size"] = self.max_queue_size
+        data["batch_size"] = self.batch_size
+        data["flush_interval_ms"] = int(self.flush_interval * 1000)
+        data["running"] = bool(self._thread and self._thread.is_alive())
+        return data
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        return conn
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and not isinstance(batch[-1], _FlushMarker):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        markers = [item for item in batch if isinstance(item, _FlushMarker)]
+        jobs = [item for item in batch if not isinstance(item, _FlushMarker)]
+        committed = []
+        failed = 0
+        if jobs:
+            started = time.monotonic()
+            oldest_enqueued = min(item[2] for item in jobs)
+            try:
+                if self._conn is None:
+                    self._conn = self._connect()
+                conn = self._conn
+                if self.before_batch:
+                    self.before_batch(conn)
+                ready = []
+                for item in jobs:
+                    prepare = item[3]
+                    try:
+                        if prepare:
+                            prepare(conn)
+                        ready.append(item)
+                    except Exception as e:
+                        failed += 1
+                        self._record_error(f"job 准备失败: {e}")
+                conn.execute("BEGIN IMMEDIATE")
+                for job, on_commit, _, _ in ready:
+                    conn.execute("SAVEPOINT chat_log_job")
+                    try:
+                        result = job(conn)
+                        conn.execute("RELEASE chat_log_job")
+                        committed.append((on_commit, result))
+                    except Exception as e:
+                        failed += 1
+                        conn.execute("ROLLBACK TO chat_log_job")
+                        conn.execute("RELEASE chat_log_job")
+                        self._record_error(f"job 执行失败: {e}")
+                conn.execute("COMMIT")
+            except Exception as e:
+                failed = len(jobs)
+                committed = []
+                self._record_error(f"批量提交失败: {e}")
+                self.logger.error(f"❌ [ChatLogWriter] 批量提交失败({len(jobs)} 条): {e}")
+                self._reset_connection()
+
+            elapsed_ms = (time.monotonic() - started) * 1000
+            wait_ms = (started - oldest_enqueued) * 1000
+            with self._stats_lock:
+                stats = self._stats
+                stats["batches"] += 1
+                stats["jobs"] += len(jobs)
+                stats["failed_jobs"] += failed
+                stats["last_batch_size"] = len(jobs)
+                stats["max_batch_size"] = max(stats["max_batch_size"], len(jobs))
+                stats["last_commit_ms"] = round(elapsed_ms, 3)
+                stats["max_commit_ms"] = round(max(stats["max_commit_ms"], elapsed_ms), 3)
+                stats["total_commit_ms"] += elapsed_ms
+                stats["last_queue_wait_ms"] = round(wait_ms, 3)
+                stats["max_queue_wait_ms"] = round(max(stats["max_queue_wait_ms"], wait_ms), 3)
+                stats["last_commit_at"] = time.time()
+
+            for on_commit, result in committed:
+                if on_commit is None or result is None:
+                    continue
+                try:
+                    on_commit(result)
+                except Exception as e:
+                    self._record_error(f"提交回调失败: {e}")
+
+        for marker in markers:
+            marker.event.set()
+
+    def _reset_connection(self):
+        try:
+            if self._conn is not None:
+                self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+    def _record_error(self, message):
+        with self._stats_lock:
+            self._stats["last_error"] = message
@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+from telethon import utils
+
+from bounded_cache import BoundedCache
+
+_USER_FIELDS = ("first_name", "last_name", "username")
+_CHAT_FIELDS = ("title", "username")
+
+
+class EntityCache:
+    """
+    进程级用户/群实体名称缓存，按 peer id（带 -100 前缀的 marked id）索引，定期落盘，重启后直接可用。
+    update 与 iter_messages 每页响应里附带的 users/chats 已被 Telethon 填进 message.sender / chat，
+    这里顺手收下；只有缓存缺失或超过 ttl 时才 await 网络，网络失败时退回旧值。
+    返回的是只带名称字段的 SimpleNamespace，getattr(x, 'first_name', ...) 等写法保持不变。
+    """
+
+    def __init__(self, path, ttl=6 * 3600, maxsize=50000, logger=None):
+        self.path = path
+        self.ttl = ttl
+        self.logger = logger
+        self._entries = BoundedCache("entity_cache", maxsize)
+        self._dirty = False
+        self._save_lock = threading.Lock()
+        self._network_lookups = 0
+        self._network_failures = 0
+
+    def remember(self, entity):
+        if entity is None:
+            return None
+        try:
+            peer_id = utils.get_peer_id(entity)
+        except Exception:
+            return None
+        fields = _USER_FIELDS if hasattr(entity, "first_name") else _CHAT_FIELDS
+        record = {field: getattr(entity, field, None) for field in fields}
+        record["ts"] = time.time()
+        old = self._entries.peek(peer_id)
+        self._entries[peer_id] = record
+        if old is None or any(old.get(field) != record[field] for field in fields):
+            self._dirty = True
+        return self._view(record)
+
+    def remember_many(self, entities):
+        for entity in entities or ():
+            self.remember(entity)
+
+    def get(self, peer_id, allow_stale=False):
+        record = self._entries.get(peer_id) if peer_id else None
+        if record is None:
+            return None
+        if not allow_stale and self.ttl and time.time() - record["ts"] > self.ttl:
+            return None
+        return self._view(record)
+
+    async def sender_of(self, message):
+        if message is None:
+            return None
+        sender = getattr(message, "sender", None)
+        if sender is not None:
+            # LocalMessage 等已经带着名称视图的对象原样返回
+            return self.remember(sender) or sender
+        sender_id = getattr(message, "sender_id", None)
+        cached = self.get(sender_id)
+        if cached is not None:
+            return cached
+        self._network_lookups += 1
+        try:
+            return self.remember(await message.get_sender())
+        except Exception:
+            self._network_failures += 1
+            stale = self.get(sender_id, allow_stale=True)
+            if stale is None:
+                raise
+            return stale
+
+    async def entity(self, client, peer_id):
+        cached = self.get(peer_id)
+        if cached is not None:
+            return cached
+        self._network_lookups += 1
+        try:
+            return self.remember(await client.get_entity(peer_id))
+        except Exception:
+            self._network_failures += 1
+            stale = self.get(peer_id, allow_stale=True)
+            if stale is None:
+                raise
+            return stale
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            if self.logger:
+                self.logger.warning(f"⚠️ [EntityCache] 读取失败，忽略旧缓存: {e}")
+            return 0
+        # snapshot 按 LRU 从旧到新写出，原样回放即可恢复顺序
+        for peer_id, record in data.items():
+            try:
+                self._entries[int(peer_id)] = record
+            except (TypeError, ValueError):
+                continue
+        return len(self._entries)
+
+    def save(self, force=False):
+        if not (self._dirty or force):
+            return False
+        with self._save_lock:
+            self._dirty = False
+            data = {str(peer_id): record for peer_id, record in self._entries.snapshot()}
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+                return True
+            except OSError as e:
+                self._dirty = True
+                if self.logger:
+                    self.logger.warning(f"⚠️ [EntityCache] 落盘失败: {e}")
+                return False
+
+    def stats(self):
+        data = self._entries.stats()
+        data["network_lookups"] = self._network_lookups
+        data["network_failures"] = self._network_failures
+        data["dirty"] = self._dirty
+        return data
+
+    @staticmethod
+    def _view(record):
+        return SimpleNamespace(**{key: value for key, value in record.items() if key != "ts"})
@@ -0,0 +1,179 @@
+import json
+import secrets
+import threading
+import time
+
+
+class Job:
+    """
+    一次后台任务（漏回检测 / 下班巡检）。输出是一行行 JSON 文本，全部缓存在内存里：
+    任何时候订阅都从第 0 行开始回放，再跟随后续输出直到任务结束。
+    put() 与 check_wait_keyword_logic 使用的 result_queue 同接口，put(None) 表示结束。
+    """
+
+    def __init__(self, kind, key, params=None, max_events=20000):
+        self.id = secrets.token_hex(6)
+        self.kind = kind
+        self.key = key
+        self.params = dict(params or {})
+        self.max_events = max_events
+        self.created_at = time.time()
+        self.finished_at = None
+        self.error = None
+        self.future = None
+        self.subscribers = 0
+        self.truncated = 0
+        self._events = []
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    @property
+    def status(self):
+        if not self.finished:
+            return "running"
+        return "failed" if self.error else "done"
+
+    def put(self, item):
+        if item is None:
+            self.finish()
+            return
+        with self._cond:
+            if self.finished:
+                return
+            if len(self._events) >= self.max_events:
+                # 结果行一条不丢，只丢最早的进度行
+                for idx, line in enumerate(self._events):
+                    if '"type": "progress"' in line:
+                        del self._events[idx]
+                        self.truncated += 1
+                        break
+            self._events.append(item)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            if self.finished:
+                return
+            if error:
+                self.error = str(error)
+                self._events.append(json.dumps({"type": "error", "msg": self.error}, ensure_ascii=False))
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def follow(self, start=0, poll=30):
+        """回放已缓存的输出并跟随新输出，任务结束后返回；在 Web 线程里迭代。"""
+        idx = max(0, int(start))
+        with self._cond:
+            self.subscribers += 1
+        try:
+            while True:
+                with self._cond:
+                    while idx >= len(self._events) and not self.finished:
+                        self._cond.wait(poll)
+                    batch = self._events[idx:]
+                    idx += len(batch)
+                    done = self.finished
+                yield from batch
+                if done and not batch:
+                    return
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "id": self.id,
+                "kind": self.kind,
+                "params": self.params,
+                "status": self.status,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+                "duration": round((self.finished_at or time.time()) - self.created_at, 1),
+                "events": len(self._events),
+                "truncated": self.truncated,
+                "subscribers": self.subscribers,
+                "error": self.error,
+            }
+
+
+class JobManager:
+    """
+    按 (kind, key) 去重的后台任务表：同样的请求在任务进行中、或结束后 retention 秒内都接到同一个 Job 上，
+    结束超过 retention 的任务在下次访问时清理。refresh=True 时只要旧任务已结束就重新跑。
+    """
+
+    def __init__(self, retention=900, max_events=20000, logger=None):
+        self.retention = retention
+        self.max_events = max_events
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._jobs = {}  # id -> Job
+        self._by_key = {}  # (kind, key) -> Job
+        self._stats = {"started": 0, "attached": 0, "failed": 0}
+
+    def start(self, kind, key, runner, params=None, refresh=False):
+        """
+        返回 (job, created)。新建时调用 runner(job) 启动任务；runner 可以返回 asyncio / concurrent future，
+        future 结束时任务随之结束（异常记为失败），runner 自己 put(None) 的话以先到者为准。
+        """
+        with self._lock:
+            self._purge()
+            job = self._by_key.get((kind, key))
+            if job is not None and not (refresh and job.finished):
+                self._stats["attached"] += 1
+                return job, False
+            job = Job(kind, key, params, max_events=self.max_events)
+            self._jobs[job.id] = job
+            self._by_key[(kind, key)] = job
+            self._stats["started"] += 1
+        try:
+            future = runner(job)
+        except Exception as e:
+            self._finish(job, e)
+            return job, True
+        if future is not None:
+            job.future = future
+            future.add_done_callback(lambda f: self._finish(job, None if f.cancelled() else f.exception(), f.cancelled()))
+        return job, True
+
+    def get(self, job_id):
+        with self._lock:
+            self._purge()
+            return self._jobs.get(job_id)
+
+    def list(self, kind=None):
+        with self._lock:
+            self._purge()
+            jobs = [job for job in self._jobs.values() if kind is None or job.kind == kind]
+        return [job.snapshot() for job in sorted(jobs, key=lambda job: job.created_at, reverse=True)]
+
+    def stats(self):
+        with self._lock:
+            self._purge()
+            data = dict(self._stats)
+            data["running"] = sum(1 for job in self._jobs.values() if not job.finished)
+            data["cached"] = sum(1 for job in self._jobs.values() if job.finished)
+        data["retention"] = self.retention
+        return data
+
+    def _finish(self, job, error=None, cancelled=False):
+        if cancelled:
+            error = "任务已取消"
+        if error and not job.finished:
+            with self._lock:
+                self._stats["failed"] += 1
+            if self.logger:
+                self.logger.error(f"❌ [JobManager] {job.kind} 任务 {job.id} 失败: {error}")
+        job.finish(error)
+
+    def _purge(self):
+        cutoff = time.time() - self.retention
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.finished_at < cutoff:
+                del self._jobs[job_id]
+                if self._by_key.get((job.kind, job.key)) is job:
+                    del self._by_key[(job.kind, job.key)]
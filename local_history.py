@@ -0,0 +1,248 @@
+import bisect
+from types import SimpleNamespace
+
+
+class LocalMessage:
+    """
+    本地窗口里的一条消息，字段与 Telethon Message 同名（id / date / sender_id / sender / text / reply_to /
+    reply_to_msg_id / grouped_id / action），原来遍历 iter_messages 结果的代码可以直接复用。
+    """
+
+    __slots__ = ("id", "date", "sender_id", "sender", "text", "reply_to", "reply_to_msg_id", "grouped_id", "action", "deleted")
+
+    def __init__(self, msg_id, date=None, sender_id=None, sender=None, text="", reply_to=None,
+                 grouped_id=None, action=None, deleted=False):
+        self.id = msg_id
+        self.date = date
+        self.sender_id = sender_id
+        self.sender = sender
+        self.text = text
+        self.reply_to = reply_to
+        self.reply_to_msg_id = getattr(reply_to, "reply_to_msg_id", None) if reply_to else None
+        self.grouped_id = grouped_id
+        self.action = action
+        self.deleted = deleted
+
+    async def get_sender(self):
+        return self.sender
+
+    def in_thread(self, thread_id):
+        reply_to = self.reply_to
+        return bool(reply_to) and thread_id in (reply_to.reply_to_msg_id, reply_to.reply_to_top_id)
+
+
+class _ChatWindow:
+    __slots__ = ("records", "ids", "first_id", "max_id", "missing")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.records = {}
+        self.ids = []  # 升序
+        self.first_id = None  # [first_id, max_id] 内除 missing 外的 id 都已观察到（含删除/服务消息）
+        self.max_id = None
+        self.missing = set()
+
+    def covers(self, msg_id):
+        return self.first_id is not None and self.first_id <= msg_id <= self.max_id and msg_id not in self.missing
+
+    def put(self, record):
+        if record.id not in self.records:
+            bisect.insort(self.ids, record.id)
+        self.records[record.id] = record
+
+
+class LocalHistory:
+    """
+    每个群最近 window 条消息的内存窗口，由实时 update 和启动回补同步喂入，和写进 chat_message_snapshots 的是同一批数据。
+    窗口按 id 连续性记录覆盖范围：id 跳号视为缺口，缺口补齐（或被淘汰出窗口）之前涉及该段的查询一律返回 None，
+    调用方据此回退到 Telegram 请求，因此本地命中的结果与直接请求等价。
+    """
+
+    def __init__(self, window=1000, remember_sender=None, lookup_sender=None):
+        self.window = max(1, int(window))
+        self.remember_sender = remember_sender
+        self.lookup_sender = lookup_sender
+        self._chats = {}
+        self._stats = {"observed": 0, "hits": 0, "gaps": 0, "unknown_senders": 0, "resets": 0}
+
+    def observe(self, message, chat_id=None):
+        """实时新消息；id 不连续时把中间段记为缺口。"""
+        chat_id = chat_id if chat_id is not None else getattr(message, "chat_id", None)
+        msg_id = getattr(message, "id", None)
+        if not chat_id or not msg_id:
+            return
+        chat = self._chats.setdefault(chat_id, _ChatWindow())
+        if chat.max_id is None:
+            chat.first_id = chat.max_id = msg_id
+        elif msg_id > chat.max_id:
+            if msg_id - chat.max_id > self.window:
+                self._reset(chat, msg_id)
+            else:
+                chat.missing.update(range(chat.max_id + 1, msg_id))
+                chat.max_id = msg_id
+        elif msg_id < chat.first_id:
+            if msg_id != chat.first_id - 1:
+                return
+            chat.first_id = msg_id
+        else:
+            chat.missing.discard(msg_id)
+        chat.put(self._record(message))
+        self._stats["observed"] += 1
+        self._evict(chat)
+
+    def observe_history(self, chat_id, messages, lo=None):
+        """
+        一次 iter_messages 拉到的连续历史：[lo, 最大 id] 之间没返回的 id 都已删除（或从未存在），整段记为已观察。
+        lo 默认取本批最小 id；用 min_id 拉取且没被 limit 截断时可传 min_id + 1。
+        """
+        messages = [m for m in messages or () if getattr(m, "id", None)]
+        if not chat_id or not messages:
+            return
+        by_id = {m.id: m for m in messages}
+        hi = max(by_id)
+        lo = max(lo or min(by_id), hi - 4 * self.window)
+        chat = self._chats.setdefault(chat_id, _ChatWindow())
+        if chat.max_id is not None:
+            if hi < chat.first_id - 1 - self.window or lo > chat.max_id + 1 + self.window:
+                # 与现有窗口相距太远：更旧的直接丢弃，更新的整段替换
+                if hi < chat.first_id:
+                    return
+                self._reset(chat, None)
+        if chat.max_id is None:
+            chat.first_id, chat.max_id = lo, hi
+        else:
+            if lo > chat.max_id + 1:
+                chat.missing.update(range(chat.max_id + 1, lo))
+            if hi < chat.first_id - 1:
+                chat.missing.update(range(hi + 1, chat.first_id))
+            chat.first_id = min(chat.first_id, lo)
+            chat.max_id = max(chat.max_id, hi)
+        for msg_id in range(lo, hi + 1):
+            chat.missing.discard(msg_id)
+            old = chat.records.get(msg_id)
+            if msg_id in by_id:
+                record = self._record(by_id[msg_id])
+                # 拉取期间实时收到的删除以本地为准
+                record.deleted = bool(old and old.deleted)
+                chat.put(record)
+            elif old is None:
+                chat.put(LocalMessage(msg_id, deleted=True))
+            else:
+                old.deleted = True
+        self._stats["observed"] += len(by_id)
+        self._evict(chat)
+
+    def observe_edit(self, message, chat_id=None):
+        chat_id = chat_id if chat_id is not None else getattr(message, "chat_id", None)
+        chat = self._chats.get(chat_id)
+        record = chat.records.get(getattr(message, "id", None)) if chat else None
+        if record is not None and not record.deleted:
+            updated = self._record(message)
+            record.text = updated.text
+            record.sender = updated.sender or record.sender
+
+    def mark_deleted(self, chat_id, msg_ids):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return
+        for msg_id in msg_ids or ():
+            record = chat.records.get(msg_id)
+            if record is not None:
+                record.deleted = True
+
+    def exists(self, chat_id, msg_id):
+        """True/False 表示窗口能确定该消息是否还在；None 表示不在覆盖范围内。"""
+        chat = self._chats.get(chat_id)
+        if chat is None or not chat.covers(msg_id) or msg_id not in chat.records:
+            self._stats["gaps"] += 1
+            return None
+        self._stats["hits"] += 1
+        return not chat.records[msg_id].deleted
+
+    def get(self, chat_id, msg_id):
+        chat = self._chats.get(chat_id)
+        record = chat.records.get(msg_id) if chat else None
+        return None if record is None or record.deleted else record
+
+    def recent(self, chat_id, limit, until_ts=None, thread_id=None):
+        """
+        等价于 iter_messages(chat_id, limit=limit[, reply_to=thread_id])：按 id 从新到旧，跳过已删除消息；
+        until_ts 给定时遇到 date <= until_ts 的消息即停止（该条不返回）。窗口不足以给出同样结果时返回 None。
+        """
+        chat = self._chats.get(chat_id)
+        if chat is None or chat.max_id is None:
+            self._stats["gaps"] += 1
+            return None
+        result = []
+        for msg_id in range(chat.max_id, chat.first_id - 1, -1):
+            record = chat.records.get(msg_id)
+            if record is None or msg_id in chat.missing:
+                self._stats["gaps"] += 1
+                return None
+            if record.deleted:
+                continue
+            if until_ts is not None and record.date and record.date.timestamp() <= until_ts:
+                break
+            if thread_id and not record.in_thread(thread_id):
+                continue
+            if record.sender is None and not record.action:
+                record.sender = self.lookup_sender(record.sender_id) if self.lookup_sender else None
+                if record.sender is None:
+                    # 不知道发送者名字就判断不了是不是客服，交给网络请求
+                    self._stats["unknown_senders"] += 1
+                    return None
+            result.append(record)
+            if len(result) >= limit:
+                break
+        else:
+            # 窗口翻到底仍未凑够 limit：只有整个群/整个消息流都在窗口内时结果才完整
+            if chat.first_id > 1 and not (thread_id and chat.first_id <= thread_id + 1):
+                self._stats["gaps"] += 1
+                return None
+        self._stats["hits"] += 1
+        return result
+
+    def stats(self):
+        data = dict(self._stats)
+        lookups = data["hits"] + data["gaps"] + data["unknown_senders"]
+        data["hit_rate"] = round(data["hits"] / lookups, 4) if lookups else None
+        data["chats"] = len(self._chats)
+        data["records"] = sum(len(chat.records) for chat in self._chats.values())
+        data["window"] = self.window
+        return data
+
+    def _record(self, message):
+        reply_to = getattr(message, "reply_to", None)
+        if reply_to is not None:
+            reply_to = SimpleNamespace(
+                reply_to_msg_id=getattr(reply_to, "reply_to_msg_id", None),
+                reply_to_top_id=getattr(reply_to, "reply_to_top_id", None),
+            )
+        sender = getattr(message, "sender", None)
+        if sender is not None and self.remember_sender:
+            sender = self.remember_sender(sender) or sender
+        return LocalMessage(
+            message.id,
+            date=getattr(message, "date", None),
+            sender_id=getattr(message, "sender_id", None),
+            sender=sender,
+            text=getattr(message, "text", None) or "",
+            reply_to=reply_to,
+            grouped_id=getattr(message, "grouped_id", None),
+            action=True if getattr(message, "action", None) else None,
+        )
+
+    def _reset(self, chat, msg_id):
+        chat.reset()
+        self._stats["resets"] += 1
+        if msg_id is not None:
+            chat.first_id = chat.max_id = msg_id
+
+    def _evict(self, chat):
+        while len(chat.ids) > self.window:
+            del chat.records[chat.ids.pop(0)]
+        if chat.ids and chat.first_id < chat.ids[0]:
+            chat.first_id = chat.ids[0]
+            chat.missing = {msg_id for msg_id in chat.missing if msg_id > chat.first_id}
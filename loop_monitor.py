@@ -0,0 +1,199 @@
+import asyncio
+import bisect
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+LAG_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+_CORO_NAME = re.compile(r"coro=<([\w.]+)\(")
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LAG_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value_ms):
+        self.counts[bisect.bisect_left(self.buckets, value_ms)] += 1
+        self.count += 1
+        self.total += value_ms
+        self.max = max(self.max, value_ms)
+
+    def snapshot(self):
+        labels = [f"<={bucket}ms" for bucket in self.buckets] + [f">{self.buckets[-1]}ms"]
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 2) if self.count else None,
+            "max_ms": round(self.max, 1),
+        }
+
+
+class LoopMonitor:
+    """
+    事件循环卡顿监控：看门狗协程每 interval 秒醒来一次，醒得晚了多少就是调度延迟，记入直方图；
+    采样线程发现看门狗超过 threshold 还没醒，就抓事件循环线程的当前栈，把这次阻塞归到 tags 里
+    最内层的那个函数（handler / multi_rule_handler / ...），没有命中时归到项目内最外层的函数。
+    """
+
+    def __init__(self, interval=0.25, threshold=0.1, sample_interval=0.05, tags=(), root=None,
+                 logger=None, warn_threshold=1.0, stack_depth=15):
+        self.interval = interval
+        self.threshold = threshold
+        self.sample_interval = sample_interval
+        self.tags = frozenset(tags)
+        self.root = os.path.abspath(root) if root else None
+        self.logger = logger
+        self.warn_threshold = warn_threshold
+        self.stack_depth = stack_depth
+        self._lock = threading.Lock()
+        self._lag = LatencyHistogram()
+        self._stalls = LatencyHistogram()
+        self._slow_callbacks = LatencyHistogram()
+        self._offenders = {}
+        self._slow_callback_sources = Counter()
+        self._deadline = None
+        self._loop_thread = None
+        self._episode = None
+        self._stop = threading.Event()
+        self._started = False
+
+    def start(self, loop):
+        if self._started:
+            return
+        self._started = True
+        loop.create_task(self._watchdog())
+        threading.Thread(target=self._sample_forever, name="LoopMonitor", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def enable_slow_callback_log(self, loop, threshold=None):
+        """打开 asyncio 调试模式的慢回调告警并收集到统计里；调试模式本身有开销，只在排查时开。"""
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.threshold if threshold is None else threshold
+        logging.getLogger("asyncio").addHandler(_SlowCallbackHandler(self))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "interval_ms": round(self.interval * 1000),
+                "threshold_ms": round(self.threshold * 1000),
+                "lag": self._lag.snapshot(),
+                "stalls": self._stalls.snapshot(),
+                "slow_callbacks": self._slow_callbacks.snapshot(),
+                "slow_callback_sources": dict(self._slow_callback_sources.most_common(10)),
+            }
+
+    def top_offenders(self, limit=10):
+        with self._lock:
+            items = sorted(self._offenders.items(), key=lambda item: item[1]["total_ms"], reverse=True)[:limit]
+            return [
+                {
+                    "tag": tag,
+                    "count": data["count"],
+                    "total_ms": round(data["total_ms"], 1),
+                    "max_ms": round(data["max_ms"], 1),
+                    "last_at": data["last_at"],
+                    "sites": dict(data["sites"].most_common(5)),
+                    "stack": list(data["stack"]),
+                }
+                for tag, data in items
+            ]
+
+    async def _watchdog(self):
+        self._loop_thread = threading.get_ident()
+        while not self._stop.is_set():
+            deadline = time.monotonic() + self.interval
+            self._deadline = deadline
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, time.monotonic() - deadline) * 1000
+            with self._lock:
+                self._lag.add(lag_ms)
+
+    def _sample_forever(self):
+        while not self._stop.wait(self.sample_interval):
+            deadline = self._deadline
+            if deadline is None:
+                continue
+            overdue = time.monotonic() - deadline
+            episode = self._episode
+            if episode is not None and episode["deadline"] != deadline:
+                self._finish_episode(episode)
+                episode = self._episode = None
+            if overdue < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            if episode is None:
+                episode = self._episode = {"deadline": deadline, "samples": [], "overdue": 0.0}
+            episode["overdue"] = overdue
+            episode["samples"].append(self._describe(frame))
+            del frame
+
+    def _finish_episode(self, episode):
+        # 采样只能看到阻塞持续的下限；精确时长以看门狗记下的 lag 直方图为准
+        duration_ms = episode["overdue"] * 1000
+        tags = Counter(sample[0] for sample in episode["samples"])
+        tag = tags.most_common(1)[0][0]
+        sample = next(sample for sample in episode["samples"] if sample[0] == tag)
+        with self._lock:
+            self._stalls.add(duration_ms)
+            data = self._offenders.setdefault(tag, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "last_at": None, "sites": Counter(), "stack": []})
+            data["count"] += 1
+            data["total_ms"] += duration_ms
+            data["max_ms"] = max(data["max_ms"], duration_ms)
+            data["last_at"] = time.time()
+            data["sites"].update(sample[1] for sample in episode["samples"] if sample[0] == tag)
+            data["stack"] = sample[2]
+        if self.logger and duration_ms >= self.warn_threshold * 1000:
+            self.logger.warning(f"⚠️ [LoopMonitor] 事件循环阻塞 ≥{duration_ms:.0f}ms | {tag} @ {sample[1]}")
+
+    def _describe(self, frame):
+        stack = traceback.extract_stack(frame)  # 外层在前
+        project = [entry for entry in stack if self._is_project(entry.filename)]
+        tag = next((entry.name for entry in reversed(stack) if entry.name in self.tags), None)
+        if tag is None:
+            tag = project[0].name if project else next(
+                (entry.name for entry in stack if not entry.filename.startswith(_ASYNCIO_DIR)), stack[-1].name
+            )
+        site_entry = project[-1] if project else stack[-1]
+        site = f"{os.path.basename(site_entry.filename)}:{site_entry.lineno} {site_entry.name}"
+        lines = [f"{os.path.basename(entry.filename)}:{entry.lineno} {entry.name}" for entry in stack[-self.stack_depth:]]
+        return tag, site, lines
+
+    def _is_project(self, filename):
+        return bool(self.root) and os.path.abspath(filename).startswith(self.root + os.sep)
+
+    def _record_slow_callback(self, source, duration_ms):
+        with self._lock:
+            self._slow_callbacks.add(duration_ms)
+            self._slow_callback_sources[source] += 1
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """接住 asyncio 调试模式打出的 "Executing <Task ...> took 0.123 seconds"。"""
+
+    def __init__(self, monitor):
+        super().__init__(logging.WARNING)
+        self.monitor = monitor
+
+    def emit(self, record):
+        try:
+            if not str(record.msg).startswith("Executing") or not record.args or len(record.args) != 2:
+                return
+            handle, seconds = record.args
+            match = _CORO_NAME.search(str(handle))
+            self.monitor._record_slow_callback(match.group(1) if match else str(handle)[:80], float(seconds) * 1000)
+        except Exception:
+            pass
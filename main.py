@@ -1,13 +1,16 @@
 import os
 import sys
 import asyncio
+import atexit
 import logging
 import requests
 import re
 import time
 import json
+import base64
 import queue
 import sqlite3
+import contextlib
 import copy
 import secrets
 import socket
@@ -15,11 +18,26 @@ import signal
 import urllib.parse
 from collections import deque, defaultdict
 from datetime import datetime, timedelta, timezone
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 from flask import Flask, render_template, render_template_string, Response, request, stream_with_context, jsonify
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, functions, types, utils
 from telethon.sessions import StringSession
+from bounded_cache import BoundedCache, cache_stats, purge_expired_caches
+from chat_event_hub import ChatEventHub
+from chat_log_partitions import ChatLogPartitions
+from chat_log_writer import ChatLogWriter
+from entity_cache import EntityCache
+from local_history import LocalHistory
+from loop_monitor import LoopMonitor
+from message_batcher import MessageBatcher
+from task_registry import ActiveMessageIndex, ReverseIndexedMap
+from timer_service import TimerService
+from verdict_cache import VerdictCache, VerdictStats, verdict_key
+from ai_pipeline import BatchClassifier, DeadlineExceeded, TokenBucket
+from job_manager import JobManager
+from wait_check_checkpoints import GroupCheckpoint, RunCheckpoint, WaitCheckCheckpoints
 from runtime_lock import TelegramRuntimeLock
+from signature_matcher import compile_signatures
 from session_store import SessionStore, format_extra_session_items, parse_extra_session_items
 from telegram_accounts import (
     get_runtime_account_statuses,
@@ -31,6 +49,7 @@ from telegram_login import TelegramLoginManager
 from telegram_proxy import parse_telegram_proxy_url, telegram_proxy_client_kwargs
 from telethon.errors import (
     AuthKeyDuplicatedError,
+    FloodWaitError,
     PasswordHashInvalidError,
     PhoneCodeExpiredError,
     PhoneCodeInvalidError,
@@ -98,7 +117,7 @@ class BeijingFormatter(logging.Formatter):
         return self.converter(record.created).strftime('%Y-%m-%d %H:%M:%S')
 
 file_fmt = BeijingFormatter('%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 file_handler = RotatingFileHandler(LOG_FILE_PATH, mode='a', encoding='utf-8', maxBytes=10*1024*1024, backupCount=3)
 file_handler.setLevel(logging.DEBUG)
 file_handler.setFormatter(file_fmt)
@@ -140,105 +159,889 @@ _console_level_name = os.environ.get("BOT_CONSOLE_LOG_LEVEL", "DEBUG" if CHAT_LO
 console_handler.setLevel(getattr(logging, _console_level_name, logging.INFO))
 console_handler.setFormatter(file_fmt)
 
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+class _LazyQueueHandler(QueueHandler):
+    """只把 record 原样入队：消息拼接、时间格式化和各 handler 的 I/O 都在日志线程里做。"""
+
+    def prepare(self, record):
+        return record
+
+# logger 上只挂入队 handler，调用方（包括事件循环线程）不再同步写文件/控制台/数据库
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, file_handler, console_handler, respect_handler_level=True)
+_log_listener.start()
+logger.addHandler(_LazyQueueHandler(_log_queue))
 
 CHAT_LOG_DB = data_path('chat_logs.db')
 CHAT_CONTEXT_RETENTION_DAYS = int(os.environ.get("CHAT_CONTEXT_RETENTION_DAYS", os.environ.get("CHAT_LOG_RETENTION_DAYS", "90")) or "90")
 CHAT_AUDIT_RETENTION_DAYS = int(os.environ.get("CHAT_AUDIT_RETENTION_DAYS", "0") or "0")
 CHAT_HISTORY_BACKFILL_LIMIT = int(os.environ.get("CHAT_HISTORY_BACKFILL_LIMIT", "500") or "0")
-_db_lock = Lock()
-_sse_clients = []
-_sse_clients_lock = Lock()
+CHAT_HISTORY_BACKFILL_CONCURRENCY = max(1, int(os.environ.get("CHAT_HISTORY_BACKFILL_CONCURRENCY", "3") or "3"))
+CHAT_HISTORY_BACKFILL_BATCH = 100  # 与 GetHistoryRequest 单页条数一致
+CHAT_LOG_WRITER_BATCH_SIZE = int(os.environ.get("CHAT_LOG_WRITER_BATCH_SIZE", "200") or "200")
+CHAT_LOG_WRITER_FLUSH_MS = int(os.environ.get("CHAT_LOG_WRITER_FLUSH_MS", "50") or "50")
+CHAT_LOG_WRITER_QUEUE_SIZE = int(os.environ.get("CHAT_LOG_WRITER_QUEUE_SIZE", "20000") or "20000")
+CHAT_LOG_WRITER_SUBMIT_TIMEOUT = 0.5  # 只给后台线程用；事件循环里一律 timeout=0，队列满就丢弃计数，不能阻塞
+# 群标题批量预取：启动时一次，之后按这个间隔刷新（小于 ENTITY_CACHE_TTL_SECONDS，缓存不会过期）
+GROUP_METADATA_REFRESH_SECONDS = int(os.environ.get("GROUP_METADATA_REFRESH_SECONDS", "3600") or "0")
+GROUP_METADATA_BATCH = 100  # GetChannelsRequest 单次 id 数
+ENTITY_CACHE_TTL_SECONDS = int(os.environ.get("ENTITY_CACHE_TTL_SECONDS", str(6 * 3600)) or "0")
+# 事件循环卡顿监控：看门狗间隔与判定阻塞的阈值；LOOP_ASYNCIO_DEBUG=1 时额外打开 asyncio 慢回调告警（有开销，排查时再开）
+LOOP_MONITOR_INTERVAL_MS = int(os.environ.get("LOOP_MONITOR_INTERVAL_MS", "250") or "0")
+LOOP_LAG_THRESHOLD_MS = int(os.environ.get("LOOP_LAG_THRESHOLD_MS", "100") or "100")
+LOOP_ASYNCIO_DEBUG = os.environ.get("LOOP_ASYNCIO_DEBUG", "0").strip().lower() in ("1", "true", "yes", "on")
+# 每个群在内存里保留最近多少条消息，供历史探测直接本地查询
+LOCAL_HISTORY_WINDOW = int(os.environ.get("LOCAL_HISTORY_WINDOW", "1000") or "1000")
+# 同一群按 id 查消息的请求在这个窗口内合并成一次 get_messages，结果缓存几秒供同一事件的后续查询复用
+GET_MESSAGES_BATCH_WINDOW_MS = int(os.environ.get("GET_MESSAGES_BATCH_WINDOW_MS", "5") or "0")
+GET_MESSAGES_CACHE_TTL_SECONDS = float(os.environ.get("GET_MESSAGES_CACHE_TTL_SECONDS", "3") or "0") or None
+# 漏回检测/下班巡检的 AI 判定缓存保留时长；0 表示不过期
+AI_VERDICT_CACHE_TTL_SECONDS = int(os.environ.get("AI_VERDICT_CACHE_TTL_SECONDS", str(3 * 86400)) or "0")
+# 重启时超过这个时长仍未处理的倒计时直接丢弃，交给下班巡检兜底
+PENDING_TIMER_MAX_AGE_SECONDS = int(os.environ.get("PENDING_TIMER_MAX_AGE_SECONDS", str(6 * 3600)) or "0")
+CHAT_LOG_MAX_ATTACHED = int(os.environ.get("CHAT_LOG_MAX_ATTACHED", "10") or "10")
+# 写入快照前要在哪些 context 月分区里查找已有记录；默认覆盖整个 context 保留期
+CHAT_LOG_SNAPSHOT_PROBE_MONTHS = int(
+    os.environ.get("CHAT_LOG_SNAPSHOT_PROBE_MONTHS", "")
+    or (CHAT_CONTEXT_RETENTION_DAYS // 30 + 2 if CHAT_CONTEXT_RETENTION_DAYS > 0 else 6)
+)
+CHAT_LOG_MIGRATE_CHUNK = int(os.environ.get("CHAT_LOG_MIGRATE_CHUNK", "2000") or "2000")
+CHAT_EVENT_BUFFER_SIZE = int(os.environ.get("CHAT_EVENT_BUFFER_SIZE", "2000") or "2000")
+chat_event_hub = ChatEventHub(capacity=CHAT_EVENT_BUFFER_SIZE)
+CHAT_LOG_FTS_BUILD_CHUNK = int(os.environ.get("CHAT_LOG_FTS_BUILD_CHUNK", "2000") or "2000")
+CHAT_LOG_FTS_MIN_QUERY_LEN = 3  # trigram 分词器对少于 3 个字符的查询无法命中，回退 LIKE
+
+# 外部内容 FTS5 索引：只存倒排，不重复存原文。target/cursor 记录首次建索引时已有数据的回填进度，
+# 触发器只维护 rowid>target（建索引后新增）或 rowid<=cursor（已回填）的行，避免与后台回填重复。
+_CHAT_LOG_FTS_INDEXES = {
+    "snapshots": {
+        "fts": "chat_snapshots_fts",
+        "table": "chat_message_snapshots",
+        "key": "rowid",
+        "columns": ("text", "sender_name"),
+        "filter": "",
+    },
+    "audit": {
+        "fts": "chat_audit_fts",
+        "table": "chat_events",
+        "key": "id",
+        "columns": ("text", "old_text", "sender_name"),
+        "filter": "event_type IN ('edit', 'delete')",
+    },
+}
+_chat_log_fts_state = {"available": False, "building": False, "error": "", "indexes": {}}
+
+def _chat_log_fts_indexed_sql(name, spec, ref):
+    key = f"{ref}.{spec['key']}"
+    cond = (
+        f"({key} > (SELECT CAST(value AS INTEGER) FROM chat_log_meta WHERE key='fts_{name}_target')"
+        f" OR {key} <= (SELECT CAST(value AS INTEGER) FROM chat_log_meta WHERE key='fts_{name}_cursor'))"
+    )
+    if spec["filter"]:
+        cond = f"{ref}.{spec['filter']} AND {cond}"
+    return cond
+
+def _chat_log_fts_trigger_sql(name, spec):
+    fts = spec["fts"]
+    table = spec["table"]
+    cols = ", ".join(spec["columns"])
+    old_vals = ", ".join(f"OLD.{c}" for c in spec["columns"])
+    new_vals = ", ".join(f"NEW.{c}" for c in spec["columns"])
+    old_key = f"OLD.{spec['key']}"
+    new_key = f"NEW.{spec['key']}"
+    delete_old = (
+        f"INSERT INTO {fts}({fts}, rowid, {cols}) SELECT 'delete', {old_key}, {old_vals} "
+        f"WHERE {_chat_log_fts_indexed_sql(name, spec, 'OLD')};"
+    )
+    insert_new = (
+        f"INSERT INTO {fts}(rowid, {cols}) SELECT {new_key}, {new_vals} "
+        f"WHERE {_chat_log_fts_indexed_sql(name, spec, 'NEW')};"
+    )
+    watched = list(spec["columns"])
+    if spec["filter"]:
+        watched.append("event_type")
+    changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in watched)
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN {delete_old} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {', '.join(watched)} ON {table} "
+        f"WHEN {changed} BEGIN {delete_old} {insert_new} END",
+    ]
+
+def _init_chat_log_fts(conn):
+    try:
+        for name, spec in _CHAT_LOG_FTS_INDEXES.items():
+            exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (spec["fts"],)
+            ).fetchone()
+            if not exists:
+                conn.execute(
+                    f"""CREATE VIRTUAL TABLE {spec['fts']} USING fts5(
+                        {', '.join(spec['columns'])},
+                        content='{spec['table']}', content_rowid='{spec['key']}', tokenize='trigram'
+                    )"""
+                )
+                target = conn.execute(f"SELECT COALESCE(MAX({spec['key']}), 0) FROM {spec['table']}").fetchone()[0]
+                conn.executemany(
+                    "INSERT OR REPLACE INTO chat_log_meta(key, value) VALUES(?, ?)",
+                    ((f"fts_{name}_target", str(target)), (f"fts_{name}_cursor", "0"))
+                )
+            for sql in _chat_log_fts_trigger_sql(name, spec):
+                conn.execute(sql)
+        _chat_log_fts_state["available"] = True
+    except sqlite3.OperationalError as e:
+        _chat_log_fts_state["available"] = False
+        _chat_log_fts_state["error"] = str(e)
+        logger.warning(f"⚠️ [FTS] 当前 SQLite 不支持 FTS5 trigram，日志搜索回退 LIKE: {e}")
+
+def _chat_log_has_column(conn, table, column):
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})").fetchall())
+
+def _chat_log_migration_create_tables(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS chat_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        chat_id INTEGER,
+        msg_type TEXT NOT NULL DEFAULT 'sys',
+        raw TEXT NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_ts ON chat_logs(chat_id, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ts ON chat_logs(ts)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS chat_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_uid TEXT NOT NULL UNIQUE,
+        ts REAL NOT NULL,
+        chat_id INTEGER,
+        message_id INTEGER,
+        event_type TEXT NOT NULL,
+        sender_id INTEGER,
+        sender_name TEXT,
+        text TEXT,
+        old_text TEXT,
+        original_ts REAL,
+        sender_role TEXT NOT NULL DEFAULT 'user',
+        msg_type TEXT NOT NULL DEFAULT '文本',
+        raw TEXT NOT NULL,
+        reply_to_msg_id INTEGER,
+        grouped_id INTEGER
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS chat_message_snapshots (
+        chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        first_ts REAL NOT NULL,
+        last_ts REAL NOT NULL,
+        sender_id INTEGER,
+        sender_name TEXT,
+        sender_role TEXT NOT NULL DEFAULT 'user',
+        text TEXT,
+        msg_type TEXT NOT NULL DEFAULT '文本',
+        reply_to_msg_id INTEGER,
+        grouped_id INTEGER,
+        is_deleted INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(chat_id, message_id)
+    )""")
+
+def _chat_log_migration_add_columns(conn):
+    # 早期版本的 chat_events 没有这两列
+    if not _chat_log_has_column(conn, "chat_events", "sender_role"):
+        conn.execute("ALTER TABLE chat_events ADD COLUMN sender_role TEXT NOT NULL DEFAULT 'user'")
+    if not _chat_log_has_column(conn, "chat_events", "original_ts"):
+        conn.execute("ALTER TABLE chat_events ADD COLUMN original_ts REAL")
+
+def _chat_log_migration_create_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_events_chat_ts ON chat_events(chat_id, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_events_ts ON chat_events(ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_events_message ON chat_events(chat_id, message_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_chat_ts ON chat_message_snapshots(chat_id, first_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_reply ON chat_message_snapshots(chat_id, reply_to_msg_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_ts ON chat_message_snapshots(first_ts)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chat_events_audit_ts ON chat_events(ts) "
+        "WHERE event_type IN ('edit', 'delete')"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chat_events_audit_chat_ts ON chat_events(chat_id, ts) "
+        "WHERE event_type IN ('edit', 'delete')"
+    )
+
+def _chat_log_migration_create_fts(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS chat_log_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""")
+    _init_chat_log_fts(conn)
+
+def _chat_log_migration_queue_snapshot_backfill(conn):
+    # 旧版每次启动都全表扫描 chat_events 补快照；改为记录一次目标 id，由后台任务分块补齐
+    target = conn.execute("SELECT COALESCE(MAX(id), 0) FROM chat_events").fetchone()[0]
+    conn.executemany(
+        "INSERT OR REPLACE INTO chat_log_meta(key, value) VALUES(?, ?)",
+        (("snapshot_backfill_target", str(target)), ("snapshot_backfill_cursor", "0"))
+    )
+
+def _chat_log_migration_add_thread_root(conn):
+    # thread_root_id 在写入快照时确定，/log_flow 按 (chat_id, thread_root_id) 一次取回整条回复链
+    if not _chat_log_has_column(conn, "chat_message_snapshots", "thread_root_id"):
+        conn.execute("ALTER TABLE chat_message_snapshots ADD COLUMN thread_root_id INTEGER")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_snapshots_thread ON chat_message_snapshots(chat_id, thread_root_id, first_ts)"
+    )
+
+def _chat_log_migration_create_group_stats(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS chat_group_stats (
+        chat_id INTEGER PRIMARY KEY,
+        title TEXT,
+        last_ts REAL,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        edit_count INTEGER NOT NULL DEFAULT 0,
+        delete_count INTEGER NOT NULL DEFAULT 0
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS chat_group_daily_stats (
+        chat_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        edit_count INTEGER NOT NULL DEFAULT 0,
+        delete_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(chat_id, day)
+    ) WITHOUT ROWID""")
+
+def _chat_log_migration_create_sync_state(conn):
+    # 历史回补水位：重启后只用 min_id 拉取水位之后的新消息
+    conn.execute("""CREATE TABLE IF NOT EXISTS chat_sync_state (
+        chat_id INTEGER PRIMARY KEY,
+        last_synced_message_id INTEGER NOT NULL DEFAULT 0,
+        updated_at REAL
+    )""")
+
+def _chat_log_migration_create_pending_timers(conn):
+    # 未到期的倒计时（稍等/跟进/漏回/自回），重启后据此重新挂回；token 对应进程内的一个定时器句柄
+    conn.execute("""CREATE TABLE IF NOT EXISTS pending_timers (
+        token TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        key_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        deadline REAL NOT NULL,
+        stage TEXT NOT NULL DEFAULT '',
+        payload TEXT NOT NULL,
+        updated_at REAL
+    )""")
+
+def _chat_log_migration_create_ai_verdicts(conn):
+    # AI 判定结果缓存：key 为 (kind, 模型, 规范化 prompt) 的 sha256；chat_id/message_id 记目标消息，编辑时据此失效
+    conn.execute("""CREATE TABLE IF NOT EXISTS ai_verdicts (
+        key TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        model TEXT NOT NULL,
+        verdict TEXT NOT NULL,
+        chat_id INTEGER,
+        message_id INTEGER,
+        created_at REAL NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_verdicts_message ON ai_verdicts(chat_id, message_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_verdicts_created ON ai_verdicts(created_at)")
+
+# 按版本号顺序执行且只执行一次；每一步本身也是幂等的，中途崩溃重跑不会出错
+_CHAT_LOG_MIGRATIONS = (
+    (1, "create chat log tables", _chat_log_migration_create_tables),
+    (2, "add chat_events sender_role/original_ts", _chat_log_migration_add_columns),
+    (3, "create chat log indexes", _chat_log_migration_create_indexes),
+    (4, "create fts indexes", _chat_log_migration_create_fts),
+    (5, "queue legacy snapshot backfill", _chat_log_migration_queue_snapshot_backfill),
+    (6, "add chat_message_snapshots thread_root_id", _chat_log_migration_add_thread_root),
+    (7, "create chat group stats", _chat_log_migration_create_group_stats),
+    (8, "create chat sync state", _chat_log_migration_create_sync_state),
+    (9, "create pending timers", _chat_log_migration_create_pending_timers),
+    (10, "create ai verdicts", _chat_log_migration_create_ai_verdicts),
+)
+
+def _migrate_chat_log_db(conn):
+    """主库和每个月分区库共用同一套表结构与迁移。"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at REAL NOT NULL
+    )""")
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    for version, name, migrate in _CHAT_LOG_MIGRATIONS:
+        if version <= current:
+            continue
+        migrate(conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO schema_version(version, name, applied_at) VALUES(?, ?, ?)",
+            (version, name, time.time())
+        )
+        conn.commit()
+        current = version
+    return current
+
+chat_log_partitions = ChatLogPartitions(
+    os.path.dirname(CHAT_LOG_DB) or ".",
+    prefix=os.path.splitext(os.path.basename(CHAT_LOG_DB))[0],
+    init_schema=_migrate_chat_log_db,
+    max_attached=CHAT_LOG_MAX_ATTACHED,
+)
+
+_chat_group_stats_state = {"ready": False, "rebuilding": False, "error": ""}
 
 def _init_db():
+    # 已是最新版本时只读一次 schema_version，启动耗时与数据量无关
     with sqlite3.connect(CHAT_LOG_DB) as conn:
-        conn.execute("""CREATE TABLE IF NOT EXISTS chat_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ts REAL NOT NULL,
-            chat_id INTEGER,
-            msg_type TEXT NOT NULL DEFAULT 'sys',
-            raw TEXT NOT NULL
-        )""")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_ts ON chat_logs(chat_id, ts)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_ts ON chat_logs(ts)")
-        conn.execute("""CREATE TABLE IF NOT EXISTS chat_events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            event_uid TEXT NOT NULL UNIQUE,
-            ts REAL NOT NULL,
-            chat_id INTEGER,
-            message_id INTEGER,
-            event_type TEXT NOT NULL,
-            sender_id INTEGER,
-            sender_name TEXT,
-            text TEXT,
-            old_text TEXT,
-            original_ts REAL,
-            sender_role TEXT NOT NULL DEFAULT 'user',
-            msg_type TEXT NOT NULL DEFAULT '文本',
-            raw TEXT NOT NULL,
-            reply_to_msg_id INTEGER,
-            grouped_id INTEGER
-        )""")
-        try:
-            conn.execute("ALTER TABLE chat_events ADD COLUMN sender_role TEXT NOT NULL DEFAULT 'user'")
-        except sqlite3.OperationalError:
-            pass
-        try:
-            conn.execute("ALTER TABLE chat_events ADD COLUMN original_ts REAL")
-        except sqlite3.OperationalError:
-            pass
-        conn.execute("""CREATE TABLE IF NOT EXISTS chat_message_snapshots (
-            chat_id INTEGER NOT NULL,
-            message_id INTEGER NOT NULL,
-            first_ts REAL NOT NULL,
-            last_ts REAL NOT NULL,
-            sender_id INTEGER,
-            sender_name TEXT,
-            sender_role TEXT NOT NULL DEFAULT 'user',
-            text TEXT,
-            msg_type TEXT NOT NULL DEFAULT '文本',
-            reply_to_msg_id INTEGER,
-            grouped_id INTEGER,
-            is_deleted INTEGER NOT NULL DEFAULT 0,
-            PRIMARY KEY(chat_id, message_id)
-        )""")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_events_chat_ts ON chat_events(chat_id, ts)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_events_ts ON chat_events(ts)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_events_message ON chat_events(chat_id, message_id)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_chat_ts ON chat_message_snapshots(chat_id, first_ts)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_reply ON chat_message_snapshots(chat_id, reply_to_msg_id)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_ts ON chat_message_snapshots(first_ts)")
-        conn.execute("""INSERT OR IGNORE INTO chat_message_snapshots(
-            chat_id, message_id, first_ts, last_ts, sender_id, sender_name, sender_role,
-            text, msg_type, reply_to_msg_id, grouped_id, is_deleted
+        conn.execute("PRAGMA journal_mode=WAL")
+        before = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='schema_version'"
+        ).fetchone()
+        version = _migrate_chat_log_db(conn)
+        _chat_log_fts_state["available"] = all(
+            conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (spec["fts"],)).fetchone()
+            for spec in _CHAT_LOG_FTS_INDEXES.values()
         )
-        SELECT chat_id, message_id, ts, ts, sender_id, sender_name, sender_role,
-               text, msg_type, reply_to_msg_id, grouped_id, 0
-        FROM chat_events
-        WHERE event_type IN ('new', 'history') AND chat_id IS NOT NULL AND message_id IS NOT NULL""")
-        conn.commit()
+        _chat_group_stats_state["ready"] = bool(conn.execute(
+            "SELECT 1 FROM chat_log_meta WHERE key='group_stats_ready' AND value='1'"
+        ).fetchone())
+    if not before:
+        logger.info(f"🗄️ [ChatLog] 主库 schema 已初始化/升级到 v{version}")
+    for family in chat_log_partitions.FAMILIES:
+        for key in chat_log_partitions.keys(family):
+            with sqlite3.connect(chat_log_partitions.path(family, key)) as conn:
+                _migrate_chat_log_db(conn)
 
 _init_db()
 
+chat_log_writer = ChatLogWriter(
+    CHAT_LOG_DB,
+    logger,
+    batch_size=CHAT_LOG_WRITER_BATCH_SIZE,
+    flush_interval_ms=CHAT_LOG_WRITER_FLUSH_MS,
+    max_queue_size=CHAT_LOG_WRITER_QUEUE_SIZE,
+    before_batch=lambda conn: chat_log_partitions.begin_batch(),
+)
+
+_SNAPSHOT_COLUMNS = (
+    "chat_id, message_id, first_ts, last_ts, sender_id, sender_name, sender_role, "
+    "text, msg_type, reply_to_msg_id, grouped_id, is_deleted"
+)
+_EVENT_COLUMNS = (
+    "id, event_uid, ts, chat_id, message_id, event_type, sender_id, sender_name, text, old_text, "
+    "original_ts, sender_role, msg_type, raw, reply_to_msg_id, grouped_id"
+)
+_CHAT_LOG_COLUMNS = "id, ts, chat_id, msg_type, raw"
+
+def _snapshot_probe_keys(ts=None):
+    limit = max(1, min(CHAT_LOG_SNAPSHOT_PROBE_MONTHS, chat_log_partitions.max_attached - 3))
+    keys = chat_log_partitions.keys("context", newest_first=True)[:limit]
+    if ts is not None:
+        key = chat_log_partitions.month_key(ts)
+        if key not in keys and chat_log_partitions.exists("context", key):
+            keys.append(key)
+    return keys
+
+def _attach_snapshot_probe(conn, ts=None):
+    """写线程：挂载可能已存有该消息快照的 context 分区；主库旧表排在最前，迁移完成前仍可能命中。"""
+    return ["main"] + [chat_log_partitions.attach_for_write(conn, "context", key) for key in _snapshot_probe_keys(ts)]
+
+def _snapshot_read_items():
+    limit = max(1, chat_log_partitions.max_attached - 1)
+    return [("context", key) for key in chat_log_partitions.keys("context", newest_first=True)[:limit]]
+
+def _find_snapshot(conn, schemas, chat_id, message_id, columns="first_ts"):
+    for schema in schemas:
+        if not schema:
+            continue
+        row = conn.execute(
+            f"SELECT {columns} FROM {schema}.chat_message_snapshots WHERE chat_id=? AND message_id=? LIMIT 1",
+            (chat_id, message_id)
+        ).fetchone()
+        if row:
+            return schema, row
+    return None, None
+
+def _resolve_thread_root(conn, schemas, chat_id, message_id, reply_to_msg_id):
+    """沿 reply_to_msg_id 向上找根；遇到已有 thread_root_id 的祖先直接复用，父消息缺失时以当前消息为根。"""
+    current, parent_id = int(message_id), reply_to_msg_id
+    seen = {current}
+    while parent_id and int(parent_id) not in seen and len(seen) < 80:
+        _, parent = _find_snapshot(conn, schemas, chat_id, int(parent_id), "reply_to_msg_id, thread_root_id")
+        if not parent:
+            break
+        if parent[1]:
+            return int(parent[1])
+        current = int(parent_id)
+        seen.add(current)
+        parent_id = parent[0]
+    return current
+
+def _reroot_thread_orphans(conn, schemas, chat_id, message_id, root_id):
+    """父消息晚于回复入库（补拉历史）时，把此前以其直接回复为根的子树并入新根。"""
+    orphan_roots = []
+    for schema in schemas:
+        orphan_roots.extend(
+            row[0] for row in conn.execute(
+                f"""SELECT message_id FROM {schema}.chat_message_snapshots
+                   WHERE chat_id=? AND reply_to_msg_id=? AND thread_root_id=message_id""",
+                (chat_id, message_id)
+            ).fetchall()
+        )
+    if not orphan_roots:
+        return
+    placeholders = ",".join("?" for _ in orphan_roots)
+    for schema in schemas:
+        conn.execute(
+            f"""UPDATE {schema}.chat_message_snapshots SET thread_root_id=?
+               WHERE chat_id=? AND thread_root_id IN ({placeholders})""",
+            tuple([root_id, chat_id] + orphan_roots)
+        )
+
+# 群组汇总和按日计数只存在主库；与消息写入在同一事务内累加，/log_groups 无需再扫大表
+_GROUP_STATS_UPSERT = """ON CONFLICT(chat_id) DO UPDATE SET
+    last_ts=MAX(COALESCE(last_ts, 0), excluded.last_ts),
+    message_count=message_count+excluded.message_count,
+    edit_count=edit_count+excluded.edit_count,
+    delete_count=delete_count+excluded.delete_count"""
+_GROUP_DAILY_STATS_UPSERT = """ON CONFLICT(chat_id, day) DO UPDATE SET
+    message_count=message_count+excluded.message_count,
+    edit_count=edit_count+excluded.edit_count,
+    delete_count=delete_count+excluded.delete_count"""
+
+def _group_stats_counted(conn, schema):
+    """首次重建完成前，只有已被重建计入的库才实时累加，避免与重建重复计数。"""
+    if _chat_group_stats_state["ready"]:
+        return True
+    row = conn.execute(f"SELECT value FROM {schema}.chat_log_meta WHERE key='group_stats_counted'").fetchone()
+    return bool(row and row[0] == "1")
+
+def _bump_group_stats(conn, chat_id, ts, messages=0, edits=0, deletes=0):
+    _bump_group_stats_many(conn, [(chat_id, ts, messages, edits, deletes)])
+
+def _bump_group_stats_many(conn, items):
+    """items: [(chat_id, ts, messages, edits, deletes), ...]"""
+    tz = timezone(timedelta(hours=8))
+    conn.executemany(
+        f"""INSERT INTO main.chat_group_stats(chat_id, last_ts, message_count, edit_count, delete_count)
+           VALUES(?,?,?,?,?) {_GROUP_STATS_UPSERT}""",
+        items
+    )
+    conn.executemany(
+        f"""INSERT INTO main.chat_group_daily_stats(chat_id, day, message_count, edit_count, delete_count)
+           VALUES(?,?,?,?,?) {_GROUP_DAILY_STATS_UPSERT}""",
+        [
+            (chat_id, datetime.fromtimestamp(ts, tz).strftime("%Y-%m-%d"), messages, edits, deletes)
+            for chat_id, ts, messages, edits, deletes in items
+        ]
+    )
+
+def _drop_expired_partitions(conn):
+    now = time.time()
+    for family, days in (("context", CHAT_CONTEXT_RETENTION_DAYS), ("audit", CHAT_AUDIT_RETENTION_DAYS)):
+        if days <= 0:
+            continue
+        for key in chat_log_partitions.expired(family, now - days * 86400):
+            chat_log_partitions.drop(family, key, conn)
+            logger.info(f"🧹 [ChatLog] 已删除过期分区 {family}/{key}")
+
 def _cleanup_old_logs():
-    with _db_lock:
-        with sqlite3.connect(CHAT_LOG_DB) as conn:
-            if CHAT_CONTEXT_RETENTION_DAYS > 0:
-                context_cutoff = time.time() - CHAT_CONTEXT_RETENTION_DAYS * 86400
-                conn.execute("DELETE FROM chat_logs WHERE ts < ?", (context_cutoff,))
-                conn.execute("DELETE FROM chat_events WHERE event_type IN ('new', 'history') AND ts < ?", (context_cutoff,))
-                conn.execute("DELETE FROM chat_message_snapshots WHERE first_ts < ?", (context_cutoff,))
-            if CHAT_AUDIT_RETENTION_DAYS > 0:
-                audit_cutoff = time.time() - CHAT_AUDIT_RETENTION_DAYS * 86400
-                conn.execute("DELETE FROM chat_events WHERE event_type IN ('edit', 'delete') AND ts < ?", (audit_cutoff,))
-            conn.commit()
+    # 分区按整月卸载删除；主库里只剩尚未迁移的旧数据，按行删除
+    def cleanup(conn):
+        if CHAT_CONTEXT_RETENTION_DAYS > 0:
+            context_cutoff = time.time() - CHAT_CONTEXT_RETENTION_DAYS * 86400
+            conn.execute("DELETE FROM chat_logs WHERE ts < ?", (context_cutoff,))
+            conn.execute("DELETE FROM chat_events WHERE event_type IN ('new', 'history') AND ts < ?", (context_cutoff,))
+            conn.execute("DELETE FROM chat_message_snapshots WHERE first_ts < ?", (context_cutoff,))
+        if CHAT_AUDIT_RETENTION_DAYS > 0:
+            audit_cutoff = time.time() - CHAT_AUDIT_RETENTION_DAYS * 86400
+            conn.execute("DELETE FROM chat_events WHERE event_type IN ('edit', 'delete') AND ts < ?", (audit_cutoff,))
+
+    chat_log_writer.submit(cleanup, timeout=CHAT_LOG_WRITER_SUBMIT_TIMEOUT, prepare=_drop_expired_partitions)
     # reschedule
     t = Thread(target=lambda: (time.sleep(86400), _cleanup_old_logs()), daemon=True)
     t.start()
 
 _cleanup_old_logs()
 
+def _chat_log_fts_progress(conn, name, spec):
+    meta = dict(conn.execute(
+        "SELECT key, value FROM chat_log_meta WHERE key IN (?, ?)",
+        (f"fts_{name}_target", f"fts_{name}_cursor")
+    ).fetchall())
+    target = int(meta.get(f"fts_{name}_target") or 0)
+    cursor = int(meta.get(f"fts_{name}_cursor") or 0)
+    return {
+        "target": target,
+        "cursor": min(cursor, target),
+        "percent": 100.0 if target <= 0 else round(min(cursor, target) * 100.0 / target, 1),
+        "ready": cursor >= target,
+    }
+
+def _build_chat_log_fts_chunk(name, spec):
+    def build(conn):
+        progress = _chat_log_fts_progress(conn, name, spec)
+        if progress["ready"]:
+            return progress
+        where = [f"{spec['key']} > ?", f"{spec['key']} <= ?"]
+        if spec["filter"]:
+            where.append(spec["filter"])
+        rows = conn.execute(
+            f"""SELECT {spec['key']}, {', '.join(spec['columns'])} FROM {spec['table']}
+               WHERE {' AND '.join(where)} ORDER BY {spec['key']} LIMIT ?""",
+            (progress["cursor"], progress["target"], CHAT_LOG_FTS_BUILD_CHUNK)
+        ).fetchall()
+        cols = ", ".join(spec["columns"])
+        conn.executemany(
+            f"INSERT INTO {spec['fts']}(rowid, {cols}) VALUES({', '.join('?' * (len(spec['columns']) + 1))})",
+            rows
+        )
+        cursor = rows[-1][0] if len(rows) >= CHAT_LOG_FTS_BUILD_CHUNK else progress["target"]
+        conn.execute(
+            "UPDATE chat_log_meta SET value=? WHERE key=?",
+            (str(cursor), f"fts_{name}_cursor")
+        )
+        return _chat_log_fts_progress(conn, name, spec)
+    return build
+
+def _submit_chat_log_job_and_wait(job, prepare=None, timeout=60):
+    """后台维护任务用：把 job 交给写线程并等待提交，超时或入队失败返回 None。"""
+    done = Event()
+    result = {}
+
+    def on_commit(value):
+        result["value"] = value
+        done.set()
+
+    if not chat_log_writer.submit(job, on_commit=on_commit, timeout=5, prepare=prepare):
+        return None
+    if not done.wait(timeout):
+        return None
+    return result.get("value")
+
+# 旧版单库数据按时间迁入月分区：每块在同一事务内“插入分区 + 从主库删除”，中断后从剩余行继续即可
+_CHAT_LOG_LEGACY_MOVES = (
+    ("chat_message_snapshots", "context", "first_ts", "", _SNAPSHOT_COLUMNS),
+    ("chat_events", "context", "ts", "event_type IN ('new', 'history')", _EVENT_COLUMNS),
+    ("chat_events", "audit", "ts", "event_type IN ('edit', 'delete')", _EVENT_COLUMNS),
+    ("chat_logs", "context", "ts", "", _CHAT_LOG_COLUMNS),
+)
+_CHAT_LOG_MIGRATE_MAX_MONTHS = 4
+_chat_log_migration_state = {"running": False, "done": False, "moved": {}, "error": ""}
+
+def _move_legacy_chunk(table, family, ts_col, filter_sql, columns):
+    plan = {}
+
+    def prepare(conn):
+        where_sql = f"WHERE {filter_sql}" if filter_sql else ""
+        rows = conn.execute(
+            f"SELECT rowid, {ts_col} FROM main.{table} {where_sql} ORDER BY rowid LIMIT ?",
+            (CHAT_LOG_MIGRATE_CHUNK,)
+        ).fetchall()
+        plan.clear()
+        for rowid, ts in rows:
+            key = chat_log_partitions.month_key(ts)
+            if key not in plan and len(plan) >= _CHAT_LOG_MIGRATE_MAX_MONTHS:
+                continue
+            plan.setdefault(key, []).append(rowid)
+        for key in plan:
+            chat_log_partitions.attach_for_write(conn, family, key)
+
+    def move(conn):
+        moved = 0
+        for key, rowids in plan.items():
+            schema = chat_log_partitions.schema(family, key)
+            for i in range(0, len(rowids), 500):
+                part = rowids[i:i + 500]
+                placeholders = ",".join("?" for _ in part)
+                conn.execute(
+                    f"""INSERT OR IGNORE INTO {schema}.{table}({columns})
+                       SELECT {columns} FROM main.{table} WHERE rowid IN ({placeholders})""",
+                    part
+                )
+                moved += conn.execute(f"DELETE FROM main.{table} WHERE rowid IN ({placeholders})", part).rowcount
+        return moved
+
+    return prepare, move
+
+_chat_log_backfill_state = {"running": False, "target": 0, "cursor": 0, "error": ""}
+
+def _snapshot_backfill_chunk(conn):
+    meta = dict(conn.execute(
+        "SELECT key, value FROM chat_log_meta WHERE key IN ('snapshot_backfill_target', 'snapshot_backfill_cursor')"
+    ).fetchall())
+    target = int(meta.get("snapshot_backfill_target") or 0)
+    cursor = int(meta.get("snapshot_backfill_cursor") or 0)
+    if cursor >= target:
+        return {"target": target, "cursor": cursor}
+    upto = conn.execute(
+        "SELECT MAX(id) FROM (SELECT id FROM chat_events WHERE id > ? AND id <= ? ORDER BY id LIMIT ?)",
+        (cursor, target, CHAT_LOG_MIGRATE_CHUNK)
+    ).fetchone()[0] or target
+    conn.execute(
+        """INSERT OR IGNORE INTO chat_message_snapshots(
+            chat_id, message_id, first_ts, last_ts, sender_id, sender_name, sender_role,
+            text, msg_type, reply_to_msg_id, grouped_id, is_deleted
+        )
+        SELECT chat_id, message_id, ts, ts, sender_id, sender_name, sender_role,
+               text, msg_type, reply_to_msg_id, grouped_id, 0
+        FROM chat_events
+        WHERE id > ? AND id <= ?
+          AND event_type IN ('new', 'history') AND chat_id IS NOT NULL AND message_id IS NOT NULL""",
+        (cursor, upto)
+    )
+    conn.execute("UPDATE chat_log_meta SET value=? WHERE key='snapshot_backfill_cursor'", (str(upto),))
+    return {"target": target, "cursor": upto}
+
+def _run_chat_log_snapshot_backfill():
+    with sqlite3.connect(CHAT_LOG_DB) as conn:
+        meta = dict(conn.execute(
+            "SELECT key, value FROM chat_log_meta WHERE key IN ('snapshot_backfill_target', 'snapshot_backfill_cursor')"
+        ).fetchall())
+    _chat_log_backfill_state["target"] = int(meta.get("snapshot_backfill_target") or 0)
+    _chat_log_backfill_state["cursor"] = int(meta.get("snapshot_backfill_cursor") or 0)
+    if _chat_log_backfill_state["cursor"] >= _chat_log_backfill_state["target"]:
+        return
+    _chat_log_backfill_state["running"] = True
+    logger.info(f"🗄️ [ChatLog] 开始后台补齐旧消息快照: {_chat_log_backfill_state['cursor']}/{_chat_log_backfill_state['target']}")
+    try:
+        while _chat_log_backfill_state["cursor"] < _chat_log_backfill_state["target"]:
+            progress = _submit_chat_log_job_and_wait(_snapshot_backfill_chunk)
+            if progress is None:
+                logger.warning("⚠️ [ChatLog] 快照补齐分块提交超时，稍后重试")
+                time.sleep(5)
+                continue
+            _chat_log_backfill_state.update(progress)
+        logger.info("🗄️ [ChatLog] 旧消息快照补齐完成")
+    except Exception as e:
+        _chat_log_backfill_state["error"] = str(e)
+        logger.error(f"❌ [ChatLog] 旧消息快照补齐失败: {e}")
+    finally:
+        _chat_log_backfill_state["running"] = False
+
+def _run_chat_log_legacy_migration():
+    pending = []
+    with sqlite3.connect(CHAT_LOG_DB) as conn:
+        for spec in _CHAT_LOG_LEGACY_MOVES:
+            table, family, _, filter_sql, _ = spec
+            where_sql = f"WHERE {filter_sql}" if filter_sql else ""
+            if conn.execute(f"SELECT 1 FROM {table} {where_sql} LIMIT 1").fetchone():
+                pending.append(spec)
+    if not pending:
+        _chat_log_migration_state["done"] = True
+        return
+    _chat_log_migration_state["running"] = True
+    logger.info(f"📦 [ChatLog] 开始把旧单库数据迁入月分区: {', '.join(f'{t}/{f}' for t, f, *_ in pending)}")
+    try:
+        for table, family, ts_col, filter_sql, columns in pending:
+            name = f"{table}/{family}"
+            while True:
+                prepare, move = _move_legacy_chunk(table, family, ts_col, filter_sql, columns)
+                moved = _submit_chat_log_job_and_wait(move, prepare=prepare)
+                if moved is None:
+                    logger.warning(f"⚠️ [ChatLog] {name} 分区迁移提交超时，稍后重试")
+                    time.sleep(5)
+                    continue
+                _chat_log_migration_state["moved"][name] = _chat_log_migration_state["moved"].get(name, 0) + moved
+                if not moved:
+                    break
+        _chat_log_migration_state["done"] = True
+        logger.info(f"📦 [ChatLog] 旧数据分区迁移完成: {_chat_log_migration_state['moved']}")
+    except Exception as e:
+        _chat_log_migration_state["error"] = str(e)
+        logger.error(f"❌ [ChatLog] 旧数据分区迁移失败: {e}")
+    finally:
+        _chat_log_migration_state["running"] = False
+
+_chat_log_thread_backfill_state = {"running": False, "filled": 0, "error": ""}
+
+def _thread_root_backfill_chunk(key):
+    """按 rowid 游标为一个库中 thread_root_id 为空的旧快照补根；游标存在该库自己的 chat_log_meta。"""
+    mounted = {}
+
+    def prepare(conn):
+        schema = "main" if key is None else chat_log_partitions.attach_for_write(conn, "context", key)
+        ts = None if key is None else chat_log_partitions.month_bounds(key)[0]
+        probe = _attach_snapshot_probe(conn, ts)
+        mounted["schema"] = schema
+        mounted["probe"] = probe if schema in probe else probe + [schema]
+
+    def fill(conn):
+        schema = mounted["schema"]
+        row = conn.execute(f"SELECT value FROM {schema}.chat_log_meta WHERE key='thread_root_cursor'").fetchone()
+        cursor = int(row[0]) if row else 0
+        rows = conn.execute(
+            f"""SELECT rowid, chat_id, message_id, reply_to_msg_id, thread_root_id
+               FROM {schema}.chat_message_snapshots WHERE rowid > ? ORDER BY rowid LIMIT ?""",
+            (cursor, CHAT_LOG_MIGRATE_CHUNK)
+        ).fetchall()
+        filled = 0
+        for rowid, chat_id, message_id, reply_to_msg_id, root_id in rows:
+            if root_id is not None:
+                continue
+            root_id = _resolve_thread_root(conn, mounted["probe"], chat_id, message_id, reply_to_msg_id)
+            conn.execute(f"UPDATE {schema}.chat_message_snapshots SET thread_root_id=? WHERE rowid=?", (root_id, rowid))
+            filled += 1
+        if rows:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {schema}.chat_log_meta(key, value) VALUES('thread_root_cursor', ?)",
+                (str(rows[-1][0]),)
+            )
+        return {"scanned": len(rows), "filled": filled}
+
+    return prepare, fill
+
+def _run_chat_log_thread_backfill():
+    # 旧快照、迁移/补齐进来的快照没有 thread_root_id；由旧到新逐库补齐，父消息通常先于回复得到根
+    _chat_log_thread_backfill_state["running"] = True
+    try:
+        for key in [None] + chat_log_partitions.keys("context"):
+            while True:
+                prepare, fill = _thread_root_backfill_chunk(key)
+                result = _submit_chat_log_job_and_wait(fill, prepare=prepare)
+                if result is None:
+                    if key is not None and not chat_log_partitions.exists("context", key):
+                        break
+                    logger.warning(f"⚠️ [ChatLog] 回复链根补齐提交超时，稍后重试: {key or 'main'}")
+                    time.sleep(5)
+                    continue
+                _chat_log_thread_backfill_state["filled"] += result["filled"]
+                if result["scanned"] < CHAT_LOG_MIGRATE_CHUNK:
+                    break
+        if _chat_log_thread_backfill_state["filled"]:
+            logger.info(f"🧵 [ChatLog] 回复链根补齐完成: {_chat_log_thread_backfill_state['filled']} 条")
+    except Exception as e:
+        _chat_log_thread_backfill_state["error"] = str(e)
+        logger.error(f"❌ [ChatLog] 回复链根补齐失败: {e}")
+    finally:
+        _chat_log_thread_backfill_state["running"] = False
+
+def _group_stats_rebuild_chunk(family, key):
+    """把一个库（主库或某个月分区）的历史数据一次性计入群组统计，并在该库打上已计入标记。"""
+    mounted = {}
+
+    def prepare(conn):
+        if key is None:
+            mounted["schema"] = "main"
+        elif chat_log_partitions.exists(family, key):
+            mounted["schema"] = chat_log_partitions.attach_for_write(conn, family, key)
+        else:
+            # 已被保留期清理删除的分区不再重建，也不能被 attach_for_write 重新创建
+            mounted["schema"] = None
+
+    def rebuild(conn):
+        schema = mounted["schema"]
+        if not schema or _group_stats_counted(conn, schema):
+            return 0
+        if family in (None, "context"):
+            conn.execute(
+                f"""INSERT INTO main.chat_group_stats(chat_id, last_ts, message_count, edit_count, delete_count)
+                   SELECT chat_id, MAX(first_ts), COUNT(*), 0, 0 FROM {schema}.chat_message_snapshots
+                   WHERE chat_id IS NOT NULL GROUP BY chat_id {_GROUP_STATS_UPSERT}"""
+            )
+            conn.execute(
+                f"""INSERT INTO main.chat_group_daily_stats(chat_id, day, message_count, edit_count, delete_count)
+                   SELECT chat_id, date(first_ts, 'unixepoch', '+8 hours'), COUNT(*), 0, 0
+                   FROM {schema}.chat_message_snapshots
+                   WHERE chat_id IS NOT NULL GROUP BY 1, 2 {_GROUP_DAILY_STATS_UPSERT}"""
+            )
+        if family in (None, "audit"):
+            conn.execute(
+                f"""INSERT INTO main.chat_group_stats(chat_id, last_ts, message_count, edit_count, delete_count)
+                   SELECT chat_id, MAX(ts), 0, SUM(event_type='edit'), SUM(event_type='delete')
+                   FROM {schema}.chat_events
+                   WHERE chat_id IS NOT NULL AND event_type IN ('edit', 'delete')
+                   GROUP BY chat_id {_GROUP_STATS_UPSERT}"""
+            )
+            conn.execute(
+                f"""INSERT INTO main.chat_group_daily_stats(chat_id, day, message_count, edit_count, delete_count)
+                   SELECT chat_id, date(ts, 'unixepoch', '+8 hours'), 0, SUM(event_type='edit'), SUM(event_type='delete')
+                   FROM {schema}.chat_events
+                   WHERE chat_id IS NOT NULL AND event_type IN ('edit', 'delete')
+                   GROUP BY 1, 2 {_GROUP_DAILY_STATS_UPSERT}"""
+            )
+        conn.execute(f"INSERT OR REPLACE INTO {schema}.chat_log_meta(key, value) VALUES('group_stats_counted', '1')")
+        return 1
+
+    return prepare, rebuild
+
+def _run_chat_group_stats_rebuild():
+    if _chat_group_stats_state["ready"]:
+        return
+    _chat_group_stats_state["rebuilding"] = True
+    done = set()
+
+    def finalize(conn):
+        # 分区只会在写线程里创建；这里确认所有现存分区都已计入后，后续写入一律实时累加
+        pending = [
+            (family, key) for family in chat_log_partitions.FAMILIES
+            for key in chat_log_partitions.keys(family) if (family, key) not in done
+        ]
+        if pending or (None, None) not in done:
+            return False
+        conn.execute("INSERT OR REPLACE INTO main.chat_log_meta(key, value) VALUES('group_stats_ready', '1')")
+        _chat_group_stats_state["ready"] = True
+        return True
+
+    try:
+        while True:
+            items = [(None, None)] + [
+                (family, key) for family in chat_log_partitions.FAMILIES for key in chat_log_partitions.keys(family)
+            ]
+            for item in items:
+                if item in done:
+                    continue
+                prepare, rebuild = _group_stats_rebuild_chunk(*item)
+                if _submit_chat_log_job_and_wait(rebuild, prepare=prepare) is None:
+                    logger.warning(f"⚠️ [ChatLog] 群组统计重建提交超时，稍后重试: {item[0] or 'main'}/{item[1] or ''}")
+                    time.sleep(5)
+                    continue
+                done.add(item)
+            if _submit_chat_log_job_and_wait(finalize):
+                break
+        logger.info("📊 [ChatLog] 群组统计表重建完成")
+    except Exception as e:
+        _chat_group_stats_state["error"] = str(e)
+        logger.error(f"❌ [ChatLog] 群组统计表重建失败: {e}")
+    finally:
+        _chat_group_stats_state["rebuilding"] = False
+
+def _run_chat_log_fts_build():
+    if not _chat_log_fts_state["available"]:
+        return
+    with sqlite3.connect(CHAT_LOG_DB) as conn:
+        for name, spec in _CHAT_LOG_FTS_INDEXES.items():
+            _chat_log_fts_state["indexes"][name] = _chat_log_fts_progress(conn, name, spec)
+    pending = [name for name, item in _chat_log_fts_state["indexes"].items() if not item["ready"]]
+    if not pending:
+        return
+    _chat_log_fts_state["building"] = True
+    logger.info(f"🔎 [FTS] 开始后台构建日志全文索引: {', '.join(pending)}")
+    try:
+        for name in pending:
+            spec = _CHAT_LOG_FTS_INDEXES[name]
+            while not _chat_log_fts_state["indexes"][name]["ready"]:
+                result = _submit_chat_log_job_and_wait(_build_chat_log_fts_chunk(name, spec))
+                if result is None:
+                    logger.warning(f"⚠️ [FTS] {name} 索引分块提交超时，稍后重试")
+                    time.sleep(5)
+                    continue
+                _chat_log_fts_state["indexes"][name] = dict(result)
+            logger.info(f"🔎 [FTS] {name} 全文索引构建完成")
+    except Exception as e:
+        _chat_log_fts_state["error"] = str(e)
+        logger.error(f"❌ [FTS] 全文索引构建失败: {e}")
+    finally:
+        _chat_log_fts_state["building"] = False
+
+def _chat_log_fts_ready(name):
+    if not _chat_log_fts_state["available"]:
+        return False
+    item = _chat_log_fts_state["indexes"].get(name)
+    return bool(item and item["ready"])
+
+def _run_chat_log_background_tasks():
+    # 顺序有依赖：先从旧事件补齐快照，再整体迁入月分区并补回复链根、重建群组统计，最后为主库残留数据补全文索引
+    _run_chat_log_snapshot_backfill()
+    _run_chat_log_legacy_migration()
+    _run_chat_log_thread_backfill()
+    _run_chat_group_stats_rebuild()
+    _run_chat_log_fts_build()
+
+Thread(target=_run_chat_log_background_tasks, name="ChatLogMaintenance", daemon=True).start()
+
 def _event_uid(event_type, chat_id, message_id, ts=None):
     if event_type in ("new", "history"):
         return f"new:{chat_id}:{message_id}"
@@ -255,19 +1058,7 @@ def _is_meaningful_edit_text(old_text, new_text):
     return old_norm != new_norm
 
 def _broadcast_chat_event(row):
-    payload = json.dumps(row, ensure_ascii=False)
-    dead_clients = []
-    with _sse_clients_lock:
-        for q in list(_sse_clients):
-            try:
-                q.put_nowait(payload)
-            except Exception:
-                dead_clients.append(q)
-        for q in dead_clients:
-            try:
-                _sse_clients.remove(q)
-            except ValueError:
-                pass
+    chat_event_hub.publish(row)
 
 def record_chat_event(event_type, chat_id, message_id, sender_id=None, sender_name=None,
                       text="", old_text="", msg_type="文本", ts=None, raw=None,
@@ -302,26 +1093,47 @@ def record_chat_event(event_type, chat_id, message_id, sender_id=None, sender_na
         "reply_to_msg_id": reply_to_msg_id,
         "grouped_id": grouped_id,
     }
+    event_uid = _event_uid(event_type, chat_id, message_id, ts)
+    family = row["source"]
+    mounted = {}
+
+    def prepare(conn):
+        mounted["target"] = chat_log_partitions.attach_for_write(conn, family, chat_log_partitions.month_key(ts))
+        # 审计行写入时补齐原消息时间，读取时无需再跨分区关联快照
+        mounted["probe"] = _attach_snapshot_probe(conn) if family == "audit" and original_ts is None else []
+
+    def write(conn):
+        if mounted["probe"]:
+            _, hit = _find_snapshot(conn, mounted["probe"], chat_id, message_id)
+            if hit:
+                row["original_ts"] = hit[0]
+        cur = conn.execute(
+            f"""INSERT OR IGNORE INTO {mounted['target']}.chat_events(
+                event_uid, ts, chat_id, message_id, event_type, sender_id, sender_name,
+                text, old_text, original_ts, sender_role, msg_type, raw, reply_to_msg_id, grouped_id
+            ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            (
+                event_uid, ts, chat_id, message_id,
+                event_type, sender_id, row["sender_name"], safe_text, safe_old_text,
+                row["original_ts"], row["sender_role"], row["msg_type"], raw, reply_to_msg_id, grouped_id
+            )
+        )
+        if cur.rowcount == 0:
+            return None
+        row["id"] = cur.lastrowid
+        if family == "audit" and _group_stats_counted(conn, mounted["target"]):
+            _bump_group_stats(
+                conn, chat_id, ts, edits=int(event_type == "edit"), deletes=int(event_type == "delete")
+            )
+        return row
+
     try:
-        with _db_lock:
-            with sqlite3.connect(CHAT_LOG_DB) as conn:
-                cur = conn.execute(
-                    """INSERT OR IGNORE INTO chat_events(
-                        event_uid, ts, chat_id, message_id, event_type, sender_id, sender_name,
-                        text, old_text, original_ts, sender_role, msg_type, raw, reply_to_msg_id, grouped_id
-                    ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                    (
-                        _event_uid(event_type, chat_id, message_id, ts), ts, chat_id, message_id,
-                        event_type, sender_id, row["sender_name"], safe_text, safe_old_text,
-                        original_ts, row["sender_role"], row["msg_type"], raw, reply_to_msg_id, grouped_id
-                    )
-                )
-                conn.commit()
-                if cur.rowcount == 0:
-                    return None
-                row["id"] = cur.lastrowid
-        if broadcast:
-            _broadcast_chat_event(row)
+        if not chat_log_writer.submit(
+            write,
+            on_commit=_broadcast_chat_event if broadcast else None,
+            prepare=prepare,
+        ):
+            return None
         return row
     except Exception as e:
         logger.error(f"❌ chat_events 写入失败: {e}")
@@ -351,257 +1163,556 @@ def upsert_message_snapshot(chat_id, message_id, sender_id=None, sender_name=Non
         "grouped_id": grouped_id,
         "is_deleted": 1 if is_deleted else 0,
     }
+
+    mounted = {}
+
+    def prepare(conn):
+        mounted["target"] = chat_log_partitions.attach_for_write(conn, "context", chat_log_partitions.month_key(ts))
+        mounted["probe"] = _attach_snapshot_probe(conn, ts)
+
+    def write(conn):
+        # 快照留在首次出现的月分区；first_ts/thread_root_id 只在首次插入时写入，冲突更新不覆盖。
+        schema, existing = _find_snapshot(conn, mounted["probe"], chat_id, message_id, "thread_root_id")
+        root_id = existing[0] if existing else None
+        if root_id is None:
+            root_id = _resolve_thread_root(conn, mounted["probe"], chat_id, message_id, reply_to_msg_id)
+        conn.execute(
+            f"""INSERT INTO {schema or mounted['target']}.chat_message_snapshots(
+                chat_id, message_id, first_ts, last_ts, sender_id, sender_name, sender_role,
+                text, msg_type, reply_to_msg_id, grouped_id, is_deleted, thread_root_id
+            ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)
+            ON CONFLICT(chat_id, message_id) DO UPDATE SET
+                thread_root_id=COALESCE(thread_root_id, excluded.thread_root_id),
+                last_ts=excluded.last_ts,
+                sender_id=excluded.sender_id,
+                sender_name=excluded.sender_name,
+                sender_role=excluded.sender_role,
+                text=excluded.text,
+                msg_type=excluded.msg_type,
+                reply_to_msg_id=excluded.reply_to_msg_id,
+                grouped_id=excluded.grouped_id,
+                is_deleted=excluded.is_deleted""",
+            (
+                chat_id, message_id, ts, ts, sender_id, row["sender_name"], row["sender_role"],
+                row["text"], row["msg_type"], reply_to_msg_id, grouped_id, row["is_deleted"], root_id
+            )
+        )
+        if not existing:
+            _reroot_thread_orphans(conn, mounted["probe"], chat_id, message_id, root_id)
+            if _group_stats_counted(conn, mounted["target"]):
+                _bump_group_stats(conn, chat_id, ts, messages=1)
+        return row
+
     try:
-        with _db_lock:
-            with sqlite3.connect(CHAT_LOG_DB) as conn:
-                existing = conn.execute(
-                    "SELECT first_ts FROM chat_message_snapshots WHERE chat_id=? AND message_id=?",
-                    (chat_id, message_id)
-                ).fetchone()
-                first_ts = existing[0] if existing else ts
-                conn.execute(
-                    """INSERT INTO chat_message_snapshots(
-                        chat_id, message_id, first_ts, last_ts, sender_id, sender_name, sender_role,
-                        text, msg_type, reply_to_msg_id, grouped_id, is_deleted
-                    ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
-                    ON CONFLICT(chat_id, message_id) DO UPDATE SET
-                        last_ts=excluded.last_ts,
-                        sender_id=excluded.sender_id,
-                        sender_name=excluded.sender_name,
-                        sender_role=excluded.sender_role,
-                        text=excluded.text,
-                        msg_type=excluded.msg_type,
-                        reply_to_msg_id=excluded.reply_to_msg_id,
-                        grouped_id=excluded.grouped_id,
-                        is_deleted=excluded.is_deleted""",
-                    (
-                        chat_id, message_id, first_ts, ts, sender_id, row["sender_name"], row["sender_role"],
-                        row["text"], row["msg_type"], reply_to_msg_id, grouped_id, row["is_deleted"]
-                    )
-                )
-                conn.commit()
-        if broadcast:
-            _broadcast_chat_event(row)
+        if not chat_log_writer.submit(
+            write,
+            on_commit=_broadcast_chat_event if broadcast else None,
+            prepare=prepare,
+        ):
+            return None
         return row
     except Exception as e:
         logger.error(f"❌ chat_message_snapshots 写入失败: {e}")
         return None
 
+def upsert_history_snapshots(chat_id, rows, progress, sync_chat_id=None, watermark=None):
+    """
+    历史回补专用的批量 upsert：一批消息一个写事务、executemany 写入，语义与逐条 upsert_message_snapshot 相同
+    （已存在的快照原地更新，新快照补 thread_root_id、并入孤儿子树、累加群组统计）。
+    progress 在同一群的各批之间共享；带 watermark 的最后一批只有在此前各批都已写入时才推进回补水位。
+    """
+    rows = [row for row in rows if row.get("message_id")]
+    if not chat_id or not rows:
+        return False
+    keys = sorted({chat_log_partitions.month_key(row["ts"]) for row in rows})
+    mounted = {}
+
+    def prepare(conn):
+        mounted["targets"] = {key: chat_log_partitions.attach_for_write(conn, "context", key) for key in keys}
+        probe = _attach_snapshot_probe(conn)
+        mounted["probe"] = probe + [schema for schema in mounted["targets"].values() if schema not in probe]
+
+    def write(conn):
+        schemas = mounted["probe"]
+        ids = [row["message_id"] for row in rows]
+        placeholders = ",".join("?" for _ in ids)
+        existing = {}
+        for schema in schemas:
+            for (message_id,) in conn.execute(
+                f"SELECT message_id FROM {schema}.chat_message_snapshots WHERE chat_id=? AND message_id IN ({placeholders})",
+                tuple([chat_id] + ids)
+            ).fetchall():
+                existing.setdefault(message_id, schema)
+
+        updates = {}
+        inserts = {}
+        roots = {}
+        stats = []
+        # 按消息 id 升序处理，同批内的父消息先确定根
+        for row in sorted(rows, key=lambda item: item["message_id"]):
+            message_id = row["message_id"]
+            values = (
+                row["ts"], row.get("sender_id"), row.get("sender_name") or "Unknown", row.get("sender_role") or "user",
+                row.get("text") or "", row.get("msg_type") or "文本", row.get("reply_to_msg_id"), row.get("grouped_id"),
+            )
+            if message_id in existing:
+                updates.setdefault(existing[message_id], []).append(values + (chat_id, message_id))
+                continue
+            parent_id = row.get("reply_to_msg_id")
+            if parent_id in roots:
+                root_id = roots[parent_id]
+            else:
+                root_id = _resolve_thread_root(conn, schemas, chat_id, message_id, parent_id)
+            roots[message_id] = root_id
+            target = mounted["targets"][chat_log_partitions.month_key(row["ts"])]
+            inserts.setdefault(target, []).append((chat_id, message_id, row["ts"]) + values + (root_id,))
+            if _group_stats_counted(conn, target):
+                stats.append((chat_id, row["ts"], 1, 0, 0))
+
+        for schema, params in updates.items():
+            conn.executemany(
+                f"""UPDATE {schema}.chat_message_snapshots SET
+                    last_ts=?, sender_id=?, sender_name=?, sender_role=?, text=?, msg_type=?,
+                    reply_to_msg_id=?, grouped_id=?, is_deleted=0
+                   WHERE chat_id=? AND message_id=?""",
+                params
+            )
+        for schema, params in inserts.items():
+            conn.executemany(
+                f"""INSERT OR IGNORE INTO {schema}.chat_message_snapshots(
+                    chat_id, message_id, first_ts, last_ts, sender_id, sender_name, sender_role,
+                    text, msg_type, reply_to_msg_id, grouped_id, thread_root_id
+                ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?)""",
+                params
+            )
+        if roots:
+            # 补拉到的父消息晚于其回复入库：把以这些回复为根的子树并入父消息所在的线程
+            new_ids = list(roots)
+            placeholders = ",".join("?" for _ in new_ids)
+            moves = []
+            for schema in schemas:
+                moves.extend(
+                    (roots[parent_id], chat_id, orphan_id)
+                    for orphan_id, parent_id in conn.execute(
+                        f"""SELECT message_id, reply_to_msg_id FROM {schema}.chat_message_snapshots
+                           WHERE chat_id=? AND reply_to_msg_id IN ({placeholders}) AND thread_root_id=message_id""",
+                        tuple([chat_id] + new_ids)
+                    ).fetchall()
+                    if roots[parent_id] != orphan_id
+                )
+            for schema in schemas:
+                conn.executemany(
+                    f"UPDATE {schema}.chat_message_snapshots SET thread_root_id=? WHERE chat_id=? AND thread_root_id=?",
+                    moves
+                )
+        if stats:
+            _bump_group_stats_many(conn, stats)
+
+        progress["stored"] = progress.get("stored", 0) + 1
+        if watermark and progress["stored"] == progress.get("submitted", 0):
+            _write_chat_sync_watermark(conn, sync_chat_id or chat_id, watermark)
+
+    progress["submitted"] = progress.get("submitted", 0) + 1
+    try:
+        if chat_log_writer.submit(write, prepare=prepare):
+            return True
+    except Exception as e:
+        logger.error(f"❌ 历史快照批量写入失败: {e}")
+    progress["submitted"] -= 1
+    return False
+
+def _write_chat_sync_watermark(conn, chat_id, watermark):
+    conn.execute(
+        """INSERT INTO main.chat_sync_state(chat_id, last_synced_message_id, updated_at) VALUES(?,?,?)
+           ON CONFLICT(chat_id) DO UPDATE SET
+               last_synced_message_id=MAX(last_synced_message_id, excluded.last_synced_message_id),
+               updated_at=excluded.updated_at""",
+        (chat_id, int(watermark), time.time())
+    )
+
+def advance_chat_sync_watermark(chat_id, watermark, progress):
+    """这段历史里没有要入库的消息（全是服务消息）时单独推进水位；同样要等此前各批都已写入。"""
+    def write(conn):
+        if progress.get("stored", 0) == progress.get("submitted", 0):
+            _write_chat_sync_watermark(conn, chat_id, watermark)
+
+    try:
+        return chat_log_writer.submit(write)
+    except Exception as e:
+        logger.error(f"❌ 回补水位写入失败: {e}")
+        return False
+
+def _load_chat_sync_watermarks():
+    try:
+        with sqlite3.connect(CHAT_LOG_DB) as conn:
+            return dict(conn.execute("SELECT chat_id, last_synced_message_id FROM chat_sync_state").fetchall())
+    except sqlite3.Error:
+        return {}
+
 def mark_message_snapshot_deleted(chat_id, message_id):
+    deleted_ts = time.time()
+    mounted = {}
+
+    def prepare(conn):
+        mounted["probe"] = _attach_snapshot_probe(conn)
+
+    def write(conn):
+        schema, _ = _find_snapshot(conn, mounted["probe"], chat_id, message_id)
+        if schema:
+            conn.execute(
+                f"UPDATE {schema}.chat_message_snapshots SET is_deleted=1, last_ts=? WHERE chat_id=? AND message_id=?",
+                (deleted_ts, chat_id, message_id)
+            )
+
     try:
-        with _db_lock:
-            with sqlite3.connect(CHAT_LOG_DB) as conn:
-                conn.execute(
-                    "UPDATE chat_message_snapshots SET is_deleted=1, last_ts=? WHERE chat_id=? AND message_id=?",
-                    (time.time(), chat_id, message_id)
-                )
-                conn.commit()
+        chat_log_writer.submit(write, prepare=prepare)
     except Exception:
         pass
 
-def _snapshot_rows(chat_id=None, limit=600, before_ts=None):
-    with sqlite3.connect(CHAT_LOG_DB) as conn:
-        conn.row_factory = sqlite3.Row
+_AUDIT_VISIBLE_SQL = """(
+    e.event_type!='edit'
+    OR (
+        COALESCE(TRIM(e.old_text),'')!=''
+        AND COALESCE(TRIM(e.old_text),'')!='[非文本/空]'
+        AND COALESCE(TRIM(e.old_text),'')!=COALESCE(TRIM(e.text),'')
+    )
+)"""
+
+def _snapshot_row_dict(row):
+    return {
+        "id": f"ctx:{row['chat_id']}:{row['message_id']}",
+        "source": "context",
+        "ts": row["first_ts"],
+        "chat_id": row["chat_id"],
+        "message_id": row["message_id"],
+        "event_type": "new",
+        "sender_id": row["sender_id"],
+        "sender_name": row["sender_name"] or "Unknown",
+        "text": row["text"] or "",
+        "old_text": "",
+        "original_ts": row["first_ts"],
+        "sender_role": row["sender_role"] or "user",
+        "msg_type": row["msg_type"] or "文本",
+        "raw": f"[MSG] Msg={row['message_id']} | [{row['chat_id']}] {row['sender_name'] or 'Unknown'}: {row['text'] or ''} [{row['msg_type'] or '文本'}]",
+        "reply_to_msg_id": row["reply_to_msg_id"],
+        "grouped_id": row["grouped_id"],
+        "is_deleted": row["is_deleted"] or 0,
+    }
+
+# 分页游标是 (ts, kind, k1, k2) 的全序键：kind=0 为快照(k1=chat_id, k2=message_id)，
+# kind=1 为审计事件(k1=chat_events.id)。kind=-1 只用于把 before_ts/start_ts 转成游标。
+_LOG_CURSOR_CONTEXT = 0
+_LOG_CURSOR_AUDIT = 1
+
+def _encode_log_cursor(key):
+    if key is None:
+        return None
+    raw = json.dumps(list(key), separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_log_cursor(text):
+    text = (text or "").strip()
+    if not text:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(text + "=" * (-len(text) % 4)).decode("utf-8")
+        ts, kind, k1, k2 = json.loads(raw)
+        return (float(ts), int(kind), int(k1), int(k2))
+    except Exception:
+        raise ValueError("invalid cursor")
+
+def _chat_log_reader():
+    conn = sqlite3.connect(CHAT_LOG_DB)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _event_page_query(conn, context_schema, audit_schema, chat_id, limit, mode, cursor, forward):
+    op = ">" if forward else "<"
+    bound = ">=" if forward else "<="
+    order = "ASC" if forward else "DESC"
+    branches = []
+    params = []
+
+    if context_schema and mode in ("all", "context"):
         where = []
-        params = []
         if chat_id:
-            where.append("chat_id=?")
+            where.append("s.chat_id=?")
             params.append(chat_id)
-        if before_ts:
-            where.append("first_ts < ?")
-            params.append(float(before_ts))
+        if cursor:
+            where.append(f"s.first_ts {bound} ?")
+            where.append(f"(s.first_ts, {_LOG_CURSOR_CONTEXT}, s.chat_id, s.message_id) {op} (?, ?, ?, ?)")
+            params.append(cursor[0])
+            params.extend(cursor)
         where_sql = ("WHERE " + " AND ".join(where)) if where else ""
         params.append(limit)
-        rows = conn.execute(
-            f"""SELECT chat_id, message_id, first_ts, last_ts, sender_id, sender_name,
-                      sender_role, text, msg_type, reply_to_msg_id, grouped_id, is_deleted
-               FROM chat_message_snapshots {where_sql} ORDER BY first_ts DESC LIMIT ?""",
-            tuple(params)
-        ).fetchall()
-    result = []
-    for r in rows:
-        row = dict(r)
-        result.append({
-            "id": f"ctx:{row['chat_id']}:{row['message_id']}",
-            "source": "context",
-            "ts": row["first_ts"],
-            "chat_id": row["chat_id"],
-            "message_id": row["message_id"],
-            "event_type": "new",
-            "sender_id": row["sender_id"],
-            "sender_name": row["sender_name"] or "Unknown",
-            "text": row["text"] or "",
-            "old_text": "",
-            "sender_role": row["sender_role"] or "user",
-            "msg_type": row["msg_type"] or "文本",
-            "raw": f"[MSG] Msg={row['message_id']} | [{row['chat_id']}] {row['sender_name'] or 'Unknown'}: {row['text'] or ''} [{row['msg_type'] or '文本'}]",
-            "reply_to_msg_id": row["reply_to_msg_id"],
-            "grouped_id": row["grouped_id"],
-            "is_deleted": row["is_deleted"] or 0,
-        })
-    return list(reversed(result))
-
-def _audit_rows(chat_id=None, limit=600, event_type=None, before_ts=None):
-    with sqlite3.connect(CHAT_LOG_DB) as conn:
-        conn.row_factory = sqlite3.Row
-        where = [
-            "e.event_type IN ('edit', 'delete')",
-            """(
-                e.event_type!='edit'
-                OR (
-                    COALESCE(TRIM(e.old_text),'')!=''
-                    AND COALESCE(TRIM(e.old_text),'')!='[非文本/空]'
-                    AND COALESCE(TRIM(e.old_text),'')!=COALESCE(TRIM(e.text),'')
-                )
+        branches.append(
+            f"""SELECT * FROM (
+                SELECT s.first_ts AS ts, {_LOG_CURSOR_CONTEXT} AS kind, s.chat_id AS k1, s.message_id AS k2,
+                       s.chat_id, s.message_id, 'new' AS event_type, s.sender_id, s.sender_name,
+                       s.text, '' AS old_text, s.first_ts AS original_ts, s.sender_role, s.msg_type,
+                       NULL AS raw, s.reply_to_msg_id, s.grouped_id, s.is_deleted, s.first_ts
+                FROM {context_schema}.chat_message_snapshots s {where_sql}
+                ORDER BY s.first_ts {order}, s.chat_id {order}, s.message_id {order} LIMIT ?
             )"""
-        ]
-        params = []
+        )
+
+    if audit_schema and mode in ("all", "audit", "edit", "delete"):
+        where = ["e.event_type IN ('edit', 'delete')", _AUDIT_VISIBLE_SQL]
         if chat_id:
             where.append("e.chat_id=?")
             params.append(chat_id)
-        if event_type:
+        if mode in ("edit", "delete"):
             where.append("e.event_type=?")
-            params.append(event_type)
-        if before_ts:
-            where.append("e.ts < ?")
-            params.append(float(before_ts))
-        where_sql = " AND ".join(where)
+            params.append(mode)
+        if cursor:
+            where.append(f"e.ts {bound} ?")
+            where.append(f"(e.ts, {_LOG_CURSOR_AUDIT}, e.id, 0) {op} (?, ?, ?, ?)")
+            params.append(cursor[0])
+            params.extend(cursor)
         params.append(limit)
-        rows = conn.execute(
-            f"""SELECT e.id, e.ts, e.chat_id, e.message_id, e.event_type, e.sender_id, e.sender_name,
-                      e.text, e.old_text, COALESCE(e.original_ts, s.first_ts) AS original_ts,
-                      e.sender_role, e.msg_type, e.raw, e.reply_to_msg_id, e.grouped_id
-               FROM chat_events e
-               LEFT JOIN chat_message_snapshots s ON s.chat_id=e.chat_id AND s.message_id=e.message_id
-               WHERE {where_sql} ORDER BY e.ts DESC, e.id DESC LIMIT ?""",
-            tuple(params)
-        ).fetchall()
+        branches.append(
+            f"""SELECT * FROM (
+                SELECT e.ts AS ts, {_LOG_CURSOR_AUDIT} AS kind, e.id AS k1, 0 AS k2,
+                       e.chat_id, e.message_id, e.event_type, e.sender_id, e.sender_name,
+                       e.text, e.old_text,
+                       COALESCE(e.original_ts, (
+                           SELECT s.first_ts FROM {audit_schema}.chat_message_snapshots s
+                           WHERE s.chat_id=e.chat_id AND s.message_id=e.message_id
+                       )) AS original_ts,
+                       e.sender_role, e.msg_type, e.raw, e.reply_to_msg_id, e.grouped_id,
+                       0 AS is_deleted, NULL AS first_ts
+                FROM {audit_schema}.chat_events e
+                WHERE {" AND ".join(where)}
+                ORDER BY e.ts {order}, e.id {order} LIMIT ?
+            )"""
+        )
+
+    if not branches:
+        return []
+    params.append(limit)
+    sql = (
+        " UNION ALL ".join(branches)
+        + f" ORDER BY ts {order}, kind {order}, k1 {order}, k2 {order} LIMIT ?"
+    )
+    return conn.execute(sql, tuple(params)).fetchall()
+
+def _page_chat_event_rows(chat_id=None, limit=600, mode="all", cursor=None, direction="before"):
+    """
+    快照与审计事件按 (ts, kind, k1, k2) 在 SQL 里 UNION ALL 合并分页；每个分支各自走索引取 limit 条，
+    翻页成本与滚动深度无关。月分区从游标所在月份开始逐月挂载，凑够 limit 条即停，
+    主库旧表（迁移完成前）始终参与合并。返回 (按时间升序的行, 下一页游标)。
+    """
+    forward = direction == "after"
+    families = []
+    if mode in ("all", "context"):
+        families.append("context")
+    if mode in ("all", "audit", "edit", "delete"):
+        families.append("audit")
+    bound_ts = cursor[0] if cursor else None
+    months = set()
+    for family in families:
+        if forward:
+            months.update(chat_log_partitions.keys(family, start_ts=bound_ts))
+        else:
+            months.update(chat_log_partitions.keys(family, end_ts=bound_ts))
+
+    fetched = []
+    conn = _chat_log_reader()
+    try:
+        fetched.extend(_event_page_query(conn, "main", "main", chat_id, limit, mode, cursor, forward))
+        from_partitions = 0
+        for key in sorted(months, reverse=not forward):
+            with chat_log_partitions.mounted(conn, [("context", key), ("audit", key)]) as (context_schema, audit_schema):
+                rows = _event_page_query(conn, context_schema, audit_schema, chat_id, limit, mode, cursor, forward)
+            fetched.extend(rows)
+            from_partitions += len(rows)
+            if from_partitions >= limit:
+                break
+    finally:
+        conn.close()
+    fetched.sort(key=lambda r: (r["ts"], r["kind"], r["k1"], r["k2"]), reverse=not forward)
+    fetched = fetched[:limit]
+
     result = []
-    for r in rows:
-        item = dict(r)
-        if item.get("event_type") == "edit" and not _is_meaningful_edit_text(item.get("old_text"), item.get("text")):
+    for r in fetched:
+        if r["kind"] == _LOG_CURSOR_CONTEXT:
+            result.append(_snapshot_row_dict(r))
             continue
+        if r["event_type"] == "edit" and not _is_meaningful_edit_text(r["old_text"], r["text"]):
+            continue
+        item = {key: r[key] for key in (
+            "ts", "chat_id", "message_id", "event_type", "sender_id", "sender_name", "text", "old_text",
+            "original_ts", "sender_role", "msg_type", "raw", "reply_to_msg_id", "grouped_id",
+        )}
+        item["id"] = r["k1"]
         item["source"] = "audit"
         result.append(item)
-    return list(reversed(result))
+
+    next_cursor = None
+    if len(fetched) >= limit:
+        last = fetched[-1]
+        next_cursor = _encode_log_cursor((last["ts"], last["kind"], last["k1"], last["k2"]))
+    if not forward:
+        result.reverse()
+    return result, next_cursor
 
 def _chat_event_rows(chat_id=None, limit=600, mode="all", before_ts=None):
-    if mode == "context":
-        return _snapshot_rows(chat_id=chat_id, limit=limit, before_ts=before_ts)
-    if mode == "audit":
-        return _audit_rows(chat_id=chat_id, limit=limit, before_ts=before_ts)
-    if mode == "edit":
-        return _audit_rows(chat_id=chat_id, limit=limit, event_type="edit", before_ts=before_ts)
-    if mode == "delete":
-        return _audit_rows(chat_id=chat_id, limit=limit, event_type="delete", before_ts=before_ts)
-
-    data = (
-        _snapshot_rows(chat_id=chat_id, limit=limit, before_ts=before_ts)
-        + _audit_rows(chat_id=chat_id, limit=limit, before_ts=before_ts)
-    )
-    data.sort(key=lambda row: (row.get("ts") or 0, str(row.get("id") or "")))
-    return data[-limit:]
+    cursor = (float(before_ts), -1, 0, 0) if before_ts else None
+    rows, _ = _page_chat_event_rows(chat_id=chat_id, limit=limit, mode=mode, cursor=cursor)
+    return rows
 
 def _legacy_chat_log_rows(chat_id=None, limit=600, before_ts=None):
-    with sqlite3.connect(CHAT_LOG_DB) as conn:
-        conn.row_factory = sqlite3.Row
-        where = []
-        params = []
-        if chat_id:
-            where.append("chat_id=?")
-            params.append(chat_id)
-        if before_ts:
-            where.append("ts < ?")
-            params.append(float(before_ts))
-        where_sql = ("WHERE " + " AND ".join(where)) if where else ""
-        params.append(limit)
-        rows = conn.execute(
+    where = []
+    params = []
+    if chat_id:
+        where.append("chat_id=?")
+        params.append(chat_id)
+    if before_ts:
+        where.append("ts < ?")
+        params.append(float(before_ts))
+    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+    params.append(limit)
+    rows = []
+    conn = _chat_log_reader()
+    try:
+        rows.extend(conn.execute(
             f"SELECT ts, chat_id, msg_type, raw FROM chat_logs {where_sql} ORDER BY ts DESC LIMIT ?",
             tuple(params)
-        ).fetchall()
-    return [{"source": "legacy", "ts": r["ts"], "chat_id": r["chat_id"], "msg_type": r["msg_type"], "raw": r["raw"]} for r in reversed(rows)]
+        ).fetchall())
+        from_partitions = 0
+        for key in chat_log_partitions.keys("context", end_ts=before_ts, newest_first=True):
+            with chat_log_partitions.mounted(conn, [("context", key)]) as (schema,):
+                if not schema:
+                    continue
+                part = conn.execute(
+                    f"SELECT ts, chat_id, msg_type, raw FROM {schema}.chat_logs {where_sql} ORDER BY ts DESC LIMIT ?",
+                    tuple(params)
+                ).fetchall()
+            rows.extend(part)
+            from_partitions += len(part)
+            if from_partitions >= limit:
+                break
+    finally:
+        conn.close()
+    rows.sort(key=lambda r: r["ts"], reverse=True)
+    return [{"source": "legacy", "ts": r["ts"], "chat_id": r["chat_id"], "msg_type": r["msg_type"], "raw": r["raw"]} for r in reversed(rows[:limit])]
+
+def _fts_phrase(query):
+    return '"' + query.replace('"', '""') + '"'
+
+def _search_snapshot_rows(conn, schema, query, use_fts, chat_id, limit, sort):
+    if use_fts:
+        source = f"{schema}.chat_snapshots_fts f JOIN {schema}.chat_message_snapshots s ON s.rowid=f.rowid"
+        where = ["chat_snapshots_fts MATCH ?"]
+        params = [_fts_phrase(query)]
+        rank_sql = "bm25(chat_snapshots_fts, 1.0, 0.5)"
+    else:
+        like = f"%{query}%"
+        source = f"{schema}.chat_message_snapshots s"
+        where = ["(COALESCE(s.text,'') LIKE ? OR COALESCE(s.sender_name,'') LIKE ?)"]
+        params = [like, like]
+        rank_sql = "NULL"
+    if chat_id:
+        where.append("s.chat_id=?")
+        params.append(chat_id)
+    params.append(limit)
+    order_sql = "rank, s.first_ts DESC" if sort == "rank" and use_fts else "s.first_ts DESC"
+    rows = []
+    for r in conn.execute(
+        f"""SELECT s.chat_id, s.message_id, s.first_ts, s.last_ts, s.sender_id, s.sender_name,
+                  s.sender_role, s.text, s.msg_type, s.reply_to_msg_id, s.grouped_id, s.is_deleted,
+                  {rank_sql} AS rank
+           FROM {source}
+           WHERE {" AND ".join(where)}
+           ORDER BY {order_sql} LIMIT ?""",
+        tuple(params)
+    ).fetchall():
+        row = _snapshot_row_dict(r)
+        row["rank"] = r["rank"]
+        rows.append(row)
+    return rows
+
+def _search_audit_rows(conn, schema, query, use_fts, chat_id, limit, mode, sort):
+    if use_fts:
+        source = f"{schema}.chat_audit_fts f JOIN {schema}.chat_events e ON e.id=f.rowid"
+        where = ["chat_audit_fts MATCH ?"]
+        params = [_fts_phrase(query)]
+        rank_sql = "bm25(chat_audit_fts, 1.0, 1.0, 0.5)"
+    else:
+        like = f"%{query}%"
+        source = f"{schema}.chat_events e"
+        where = ["(COALESCE(e.text,'') LIKE ? OR COALESCE(e.old_text,'') LIKE ? OR COALESCE(e.sender_name,'') LIKE ?)"]
+        params = [like, like, like]
+        rank_sql = "NULL"
+    where += ["e.event_type IN ('edit', 'delete')", _AUDIT_VISIBLE_SQL]
+    if chat_id:
+        where.append("e.chat_id=?")
+        params.append(chat_id)
+    if mode in ("edit", "delete"):
+        where.append("e.event_type=?")
+        params.append(mode)
+    params.append(limit)
+    order_sql = "rank, e.ts DESC, e.id DESC" if sort == "rank" and use_fts else "e.ts DESC, e.id DESC"
+    rows = []
+    for r in conn.execute(
+        f"""SELECT e.id, e.ts, e.chat_id, e.message_id, e.event_type, e.sender_id, e.sender_name,
+                  e.text, e.old_text, COALESCE(e.original_ts, s.first_ts) AS original_ts,
+                  e.sender_role, e.msg_type, e.raw, e.reply_to_msg_id, e.grouped_id,
+                  {rank_sql} AS rank
+           FROM {source}
+           LEFT JOIN {schema}.chat_message_snapshots s ON s.chat_id=e.chat_id AND s.message_id=e.message_id
+           WHERE {" AND ".join(where)}
+           ORDER BY {order_sql} LIMIT ?""",
+        tuple(params)
+    ).fetchall():
+        item = dict(r)
+        item["source"] = "audit"
+        rows.append(item)
+    return rows
 
-def _search_log_rows(query, chat_id=None, limit=200, mode="all"):
+def _search_log_rows(query, chat_id=None, limit=200, mode="all", sort="recent"):
     query = (query or "").strip()
     if not query:
         return []
-    like = f"%{query}%"
+    use_fts = len(query) >= CHAT_LOG_FTS_MIN_QUERY_LEN and _chat_log_fts_state["available"]
     rows = []
-    with sqlite3.connect(CHAT_LOG_DB) as conn:
-        conn.row_factory = sqlite3.Row
+    conn = _chat_log_reader()
+    try:
+        # 主库旧表在迁移/回填完成前可能还没有完整的全文索引，按构建进度决定是否回退 LIKE
         if mode in ("all", "context"):
-            where = ["(COALESCE(text,'') LIKE ? OR COALESCE(sender_name,'') LIKE ?)"]
-            params = [like, like]
-            if chat_id:
-                where.append("chat_id=?")
-                params.append(chat_id)
-            params.append(limit)
-            snapshots = conn.execute(
-                f"""SELECT chat_id, message_id, first_ts, last_ts, sender_id, sender_name,
-                          sender_role, text, msg_type, reply_to_msg_id, grouped_id, is_deleted
-                   FROM chat_message_snapshots
-                   WHERE {" AND ".join(where)}
-                   ORDER BY first_ts DESC LIMIT ?""",
-                tuple(params)
-            ).fetchall()
-            for r in snapshots:
-                row = dict(r)
-                rows.append({
-                    "id": f"ctx:{row['chat_id']}:{row['message_id']}",
-                    "source": "context",
-                    "ts": row["first_ts"],
-                    "chat_id": row["chat_id"],
-                    "message_id": row["message_id"],
-                    "event_type": "new",
-                    "sender_id": row["sender_id"],
-                    "sender_name": row["sender_name"] or "Unknown",
-                    "text": row["text"] or "",
-                    "old_text": "",
-                    "original_ts": row["first_ts"],
-                    "sender_role": row["sender_role"] or "user",
-                    "msg_type": row["msg_type"] or "文本",
-                    "raw": f"[MSG] Msg={row['message_id']} | [{row['chat_id']}] {row['sender_name'] or 'Unknown'}: {row['text'] or ''} [{row['msg_type'] or '文本'}]",
-                    "reply_to_msg_id": row["reply_to_msg_id"],
-                    "grouped_id": row["grouped_id"],
-                    "is_deleted": row["is_deleted"] or 0,
-                })
-
+            rows.extend(_search_snapshot_rows(
+                conn, "main", query, use_fts and _chat_log_fts_ready("snapshots"), chat_id, limit, sort
+            ))
         if mode in ("all", "audit", "edit", "delete"):
-            where = [
-                "(COALESCE(e.text,'') LIKE ? OR COALESCE(e.old_text,'') LIKE ? OR COALESCE(e.sender_name,'') LIKE ?)",
-                "e.event_type IN ('edit', 'delete')",
-                """(
-                    e.event_type!='edit'
-                    OR (
-                        COALESCE(TRIM(e.old_text),'')!=''
-                        AND COALESCE(TRIM(e.old_text),'')!='[非文本/空]'
-                        AND COALESCE(TRIM(e.old_text),'')!=COALESCE(TRIM(e.text),'')
-                    )
-                )"""
-            ]
-            params = [like, like, like]
-            if chat_id:
-                where.append("e.chat_id=?")
-                params.append(chat_id)
-            if mode in ("edit", "delete"):
-                where.append("e.event_type=?")
-                params.append(mode)
-            params.append(limit)
-            audits = conn.execute(
-                f"""SELECT e.id, e.ts, e.chat_id, e.message_id, e.event_type, e.sender_id, e.sender_name,
-                          e.text, e.old_text, COALESCE(e.original_ts, s.first_ts) AS original_ts,
-                          e.sender_role, e.msg_type, e.raw, e.reply_to_msg_id, e.grouped_id
-                   FROM chat_events e
-                   LEFT JOIN chat_message_snapshots s ON s.chat_id=e.chat_id AND s.message_id=e.message_id
-                   WHERE {" AND ".join(where)}
-                   ORDER BY e.ts DESC, e.id DESC LIMIT ?""",
-                tuple(params)
-            ).fetchall()
-            for r in audits:
-                item = dict(r)
-                item["source"] = "audit"
-                rows.append(item)
+            rows.extend(_search_audit_rows(
+                conn, "main", query, use_fts and _chat_log_fts_ready("audit"), chat_id, limit, mode, sort
+            ))
+        # 分区按月从新到旧扫描；按时间排序时某一族凑够 limit 条即可停止，按相关度排序需扫完全部分区
+        for family in ("context", "audit"):
+            if family == "context" and mode not in ("all", "context"):
+                continue
+            if family == "audit" and mode not in ("all", "audit", "edit", "delete"):
+                continue
+            found = 0
+            for key in chat_log_partitions.keys(family, newest_first=True):
+                with chat_log_partitions.mounted(conn, [(family, key)]) as (schema,):
+                    if not schema:
+                        continue
+                    if family == "context":
+                        part = _search_snapshot_rows(conn, schema, query, use_fts, chat_id, limit, sort)
+                    else:
+                        part = _search_audit_rows(conn, schema, query, use_fts, chat_id, limit, mode, sort)
+                rows.extend(part)
+                found += len(part)
+                if sort != "rank" and found >= limit:
+                    break
+    finally:
+        conn.close()
 
+    if sort == "rank":
+        # bm25 越小越相关；LIKE 回退的行没有分数，排在最后并按时间倒序
+        rows.sort(key=lambda row: (row.get("rank") is None, row.get("rank") or 0, -(row.get("ts") or 0)))
+        return rows[:limit]
     rows.sort(key=lambda row: (row.get("ts") or 0, str(row.get("id") or "")))
     return rows[-limit:]
 
@@ -610,196 +1721,139 @@ def _day_start_ts(date_text):
     return day.replace(tzinfo=timezone(timedelta(hours=8))).timestamp()
 
 def _rows_from_ts(start_ts, chat_id=None, limit=1000, mode="all"):
-    rows = []
-    with sqlite3.connect(CHAT_LOG_DB) as conn:
-        conn.row_factory = sqlite3.Row
-        if mode in ("all", "context"):
-            where = ["first_ts >= ?"]
-            params = [float(start_ts)]
-            if chat_id:
-                where.append("chat_id=?")
-                params.append(chat_id)
-            params.append(limit)
-            snapshots = conn.execute(
-                f"""SELECT chat_id, message_id, first_ts, last_ts, sender_id, sender_name,
-                          sender_role, text, msg_type, reply_to_msg_id, grouped_id, is_deleted
-                   FROM chat_message_snapshots
-                   WHERE {" AND ".join(where)}
-                   ORDER BY first_ts ASC LIMIT ?""",
-                tuple(params)
-            ).fetchall()
-            for r in snapshots:
-                row = dict(r)
-                rows.append({
-                    "id": f"ctx:{row['chat_id']}:{row['message_id']}",
-                    "source": "context",
-                    "ts": row["first_ts"],
-                    "chat_id": row["chat_id"],
-                    "message_id": row["message_id"],
-                    "event_type": "new",
-                    "sender_id": row["sender_id"],
-                    "sender_name": row["sender_name"] or "Unknown",
-                    "text": row["text"] or "",
-                    "old_text": "",
-                    "original_ts": row["first_ts"],
-                    "sender_role": row["sender_role"] or "user",
-                    "msg_type": row["msg_type"] or "文本",
-                    "raw": f"[MSG] Msg={row['message_id']} | [{row['chat_id']}] {row['sender_name'] or 'Unknown'}: {row['text'] or ''} [{row['msg_type'] or '文本'}]",
-                    "reply_to_msg_id": row["reply_to_msg_id"],
-                    "grouped_id": row["grouped_id"],
-                    "is_deleted": row["is_deleted"] or 0,
-                })
-
-        if mode in ("all", "audit", "edit", "delete"):
-            where = [
-                "e.ts >= ?",
-                "e.event_type IN ('edit', 'delete')",
-                """(
-                    e.event_type!='edit'
-                    OR (
-                        COALESCE(TRIM(e.old_text),'')!=''
-                        AND COALESCE(TRIM(e.old_text),'')!='[非文本/空]'
-                        AND COALESCE(TRIM(e.old_text),'')!=COALESCE(TRIM(e.text),'')
-                    )
-                )"""
-            ]
-            params = [float(start_ts)]
-            if chat_id:
-                where.append("e.chat_id=?")
-                params.append(chat_id)
-            if mode in ("edit", "delete"):
-                where.append("e.event_type=?")
-                params.append(mode)
-            params.append(limit)
-            audits = conn.execute(
-                f"""SELECT e.id, e.ts, e.chat_id, e.message_id, e.event_type, e.sender_id, e.sender_name,
-                          e.text, e.old_text, COALESCE(e.original_ts, s.first_ts) AS original_ts,
-                          e.sender_role, e.msg_type, e.raw, e.reply_to_msg_id, e.grouped_id
-                   FROM chat_events e
-                   LEFT JOIN chat_message_snapshots s ON s.chat_id=e.chat_id AND s.message_id=e.message_id
-                   WHERE {" AND ".join(where)}
-                   ORDER BY e.ts ASC, e.id ASC LIMIT ?""",
-                tuple(params)
-            ).fetchall()
-            for r in audits:
-                item = dict(r)
-                item["source"] = "audit"
-                rows.append(item)
-
-    rows.sort(key=lambda row: (row.get("ts") or 0, str(row.get("id") or "")))
-    return rows[:limit]
+    rows, _ = _page_chat_event_rows(
+        chat_id=chat_id, limit=limit, mode=mode, cursor=(float(start_ts), -1, 0, 0), direction="after"
+    )
+    return rows
 
-def _message_parent_id(conn, chat_id, message_id):
-    row = conn.execute(
-        "SELECT reply_to_msg_id FROM chat_message_snapshots WHERE chat_id=? AND message_id=? LIMIT 1",
-        (chat_id, message_id)
-    ).fetchone()
+def _message_parent_id(conn, schemas, chat_id, message_id):
+    _, row = _find_snapshot(conn, schemas, chat_id, message_id, "reply_to_msg_id")
     if row and row["reply_to_msg_id"]:
         return int(row["reply_to_msg_id"])
-    row = conn.execute(
-        """SELECT reply_to_msg_id FROM chat_events
-           WHERE chat_id=? AND message_id=? AND reply_to_msg_id IS NOT NULL
-           ORDER BY ts ASC, id ASC LIMIT 1""",
-        (chat_id, message_id)
-    ).fetchone()
-    return int(row["reply_to_msg_id"]) if row and row["reply_to_msg_id"] else None
-
-def _message_exists(conn, chat_id, message_id):
-    row = conn.execute(
-        "SELECT 1 FROM chat_message_snapshots WHERE chat_id=? AND message_id=? LIMIT 1",
-        (chat_id, message_id)
-    ).fetchone()
+    for schema in schemas:
+        row = conn.execute(
+            f"""SELECT reply_to_msg_id FROM {schema}.chat_events
+               WHERE chat_id=? AND message_id=? AND reply_to_msg_id IS NOT NULL
+               ORDER BY ts ASC, id ASC LIMIT 1""",
+            (chat_id, message_id)
+        ).fetchone()
+        if row and row["reply_to_msg_id"]:
+            return int(row["reply_to_msg_id"])
+    return None
+
+def _message_exists(conn, schemas, chat_id, message_id):
+    _, row = _find_snapshot(conn, schemas, chat_id, message_id, "1")
     if row:
         return True
-    row = conn.execute(
-        "SELECT 1 FROM chat_events WHERE chat_id=? AND message_id=? LIMIT 1",
-        (chat_id, message_id)
-    ).fetchone()
-    return bool(row)
+    for schema in schemas:
+        row = conn.execute(
+            f"SELECT 1 FROM {schema}.chat_events WHERE chat_id=? AND message_id=? LIMIT 1",
+            (chat_id, message_id)
+        ).fetchone()
+        if row:
+            return True
+    return False
 
-def _thread_root_message_id(conn, chat_id, message_id):
+def _thread_root_message_id(conn, schemas, chat_id, message_id):
     current = int(message_id)
     seen = set()
     for _ in range(80):
         if current in seen:
             break
         seen.add(current)
-        parent_id = _message_parent_id(conn, chat_id, current)
-        if not parent_id or parent_id == current or not _message_exists(conn, chat_id, parent_id):
+        parent_id = _message_parent_id(conn, schemas, chat_id, current)
+        if not parent_id or parent_id == current or not _message_exists(conn, schemas, chat_id, parent_id):
             break
         current = parent_id
     return current
 
+_FLOW_SNAPSHOT_COLUMNS = """chat_id, message_id, first_ts, last_ts, sender_id, sender_name,
+    sender_role, text, msg_type, reply_to_msg_id, grouped_id, is_deleted"""
+
+def _legacy_thread_snapshots(conn, schemas, chat_id, message_id, limit):
+    """thread_root_id 尚未补齐时的回退：向上找根后逐层按 reply_to_msg_id 展开回复树。"""
+    root_id = _thread_root_message_id(conn, schemas, chat_id, message_id)
+    thread_ids = [root_id]
+    seen = {root_id}
+    frontier = [root_id]
+    while frontier and len(thread_ids) < limit:
+        placeholders = ",".join("?" for _ in frontier)
+        children = []
+        for schema in schemas:
+            children.extend(
+                int(r["message_id"])
+                for r in conn.execute(
+                    f"""SELECT message_id FROM {schema}.chat_message_snapshots
+                       WHERE chat_id=? AND reply_to_msg_id IN ({placeholders})""",
+                    tuple([chat_id] + frontier)
+                ).fetchall()
+            )
+        frontier = [child for child in dict.fromkeys(children) if child not in seen]
+        seen.update(frontier)
+        thread_ids.extend(frontier)
+    thread_ids = thread_ids[:limit]
+
+    placeholders = ",".join("?" for _ in thread_ids)
+    snapshots = []
+    for schema in schemas:
+        snapshots.extend(conn.execute(
+            f"""SELECT {_FLOW_SNAPSHOT_COLUMNS} FROM {schema}.chat_message_snapshots
+               WHERE chat_id=? AND message_id IN ({placeholders})
+               ORDER BY first_ts ASC LIMIT ?""",
+            tuple([chat_id] + thread_ids + [limit])
+        ).fetchall())
+    return snapshots, thread_ids
+
 def _flow_rows(chat_id, message_id, window_seconds=0, limit=300):
     if not chat_id or not message_id:
         return []
     message_id = int(message_id)
     rows = []
-    with sqlite3.connect(CHAT_LOG_DB) as conn:
-        conn.row_factory = sqlite3.Row
-        root_id = _thread_root_message_id(conn, chat_id, message_id)
-        thread_ids = [
-            int(r["message_id"])
-            for r in conn.execute(
-                """WITH RECURSIVE thread(message_id) AS (
-                       VALUES(?)
-                       UNION
-                       SELECT s.message_id
-                       FROM chat_message_snapshots s
-                       JOIN thread t ON s.reply_to_msg_id=t.message_id
-                       WHERE s.chat_id=?
-                   )
-                   SELECT message_id FROM thread LIMIT ?""",
-                (root_id, chat_id, limit)
-            ).fetchall()
-        ]
-        if not thread_ids and _message_exists(conn, chat_id, root_id):
-            thread_ids = [root_id]
-        if not thread_ids:
-            return []
-
-        placeholders = ",".join("?" for _ in thread_ids)
-        snapshots = conn.execute(
-            f"""SELECT chat_id, message_id, first_ts, last_ts, sender_id, sender_name,
-                      sender_role, text, msg_type, reply_to_msg_id, grouped_id, is_deleted
-               FROM chat_message_snapshots
-               WHERE chat_id=? AND message_id IN ({placeholders})
-               ORDER BY first_ts ASC LIMIT ?""",
-            tuple([chat_id] + thread_ids + [limit])
-        ).fetchall()
-
-        audits = conn.execute(
-            f"""SELECT e.id, e.ts, e.chat_id, e.message_id, e.event_type, e.sender_id, e.sender_name,
-                      e.text, e.old_text, COALESCE(e.original_ts, s.first_ts) AS original_ts,
-                      e.sender_role, e.msg_type, e.raw, e.reply_to_msg_id, e.grouped_id
-               FROM chat_events e
-               LEFT JOIN chat_message_snapshots s ON s.chat_id=e.chat_id AND s.message_id=e.message_id
-               WHERE e.chat_id=? AND e.event_type IN ('edit', 'delete')
-                 AND e.message_id IN ({placeholders})
-               ORDER BY e.ts ASC, e.id ASC LIMIT ?""",
-            tuple([chat_id] + thread_ids + [limit])
-        ).fetchall()
+    conn = _chat_log_reader()
+    try:
+        with chat_log_partitions.mounted(conn, _snapshot_read_items()) as mounted:
+            schemas = ["main"] + [schema for schema in mounted if schema]
+            _, hit = _find_snapshot(conn, schemas, chat_id, message_id, "thread_root_id")
+            if hit and hit["thread_root_id"] is not None:
+                # 整条回复链在每个分区都是 idx_snapshots_thread 上的一次范围扫描
+                snapshots = []
+                for schema in schemas:
+                    snapshots.extend(conn.execute(
+                        f"""SELECT {_FLOW_SNAPSHOT_COLUMNS} FROM {schema}.chat_message_snapshots
+                           WHERE chat_id=? AND thread_root_id=?
+                           ORDER BY first_ts ASC LIMIT ?""",
+                        (chat_id, hit["thread_root_id"], limit)
+                    ).fetchall())
+                snapshots.sort(key=lambda r: r["first_ts"])
+                snapshots = snapshots[:limit]
+                thread_ids = [int(r["message_id"]) for r in snapshots] or [message_id]
+            else:
+                snapshots, thread_ids = _legacy_thread_snapshots(conn, schemas, chat_id, message_id, limit)
+            placeholders = ",".join("?" for _ in thread_ids)
+
+        # 审计行只可能出现在线程最早一条消息所在月份及之后的分区
+        first_ts = min((r["first_ts"] for r in snapshots), default=None)
+        audit_keys = chat_log_partitions.keys("audit", start_ts=first_ts, newest_first=True)
+        audit_keys = audit_keys[:max(1, chat_log_partitions.max_attached - 1)]
+        audits = []
+        with chat_log_partitions.mounted(conn, [("audit", key) for key in audit_keys]) as mounted:
+            for schema in ["main"] + [schema for schema in mounted if schema]:
+                audits.extend(conn.execute(
+                    f"""SELECT e.id, e.ts, e.chat_id, e.message_id, e.event_type, e.sender_id, e.sender_name,
+                              e.text, e.old_text, COALESCE(e.original_ts, s.first_ts) AS original_ts,
+                              e.sender_role, e.msg_type, e.raw, e.reply_to_msg_id, e.grouped_id
+                       FROM {schema}.chat_events e
+                       LEFT JOIN {schema}.chat_message_snapshots s ON s.chat_id=e.chat_id AND s.message_id=e.message_id
+                       WHERE e.chat_id=? AND e.event_type IN ('edit', 'delete')
+                         AND e.message_id IN ({placeholders})
+                       ORDER BY e.ts ASC, e.id ASC LIMIT ?""",
+                    tuple([chat_id] + thread_ids + [limit])
+                ).fetchall())
+    finally:
+        conn.close()
 
     for r in snapshots:
-        row = dict(r)
-        rows.append({
-            "id": f"ctx:{row['chat_id']}:{row['message_id']}",
-            "source": "context",
-            "ts": row["first_ts"],
-            "chat_id": row["chat_id"],
-            "message_id": row["message_id"],
-            "event_type": "new",
-            "sender_id": row["sender_id"],
-            "sender_name": row["sender_name"] or "Unknown",
-            "text": row["text"] or "",
-            "old_text": "",
-            "sender_role": row["sender_role"] or "user",
-            "msg_type": row["msg_type"] or "文本",
-            "raw": f"[MSG] Msg={row['message_id']} | [{row['chat_id']}] {row['sender_name'] or 'Unknown'}: {row['text'] or ''} [{row['msg_type'] or '文本'}]",
-            "reply_to_msg_id": row["reply_to_msg_id"],
-            "grouped_id": row["grouped_id"],
-            "is_deleted": row["is_deleted"] or 0,
-        })
+        rows.append(_snapshot_row_dict(r))
     for r in audits:
         item = dict(r)
         item["source"] = "audit"
@@ -807,15 +1861,28 @@ def _flow_rows(chat_id, message_id, window_seconds=0, limit=300):
     rows.sort(key=lambda row: (row.get("ts") or 0, str(row.get("id") or "")))
     return rows[:limit]
 
+def _lookup_message_snapshot(chat_id, message_id, columns):
+    """逐个挂载最近的 context 分区查快照，命中即停；主库旧表最先查。"""
+    conn = _chat_log_reader()
+    try:
+        _, row = _find_snapshot(conn, ["main"], chat_id, message_id, columns)
+        if row:
+            return row
+        for item in _snapshot_read_items():
+            with chat_log_partitions.mounted(conn, [item]) as schemas:
+                _, row = _find_snapshot(conn, schemas, chat_id, message_id, columns)
+            if row:
+                return row
+        return None
+    finally:
+        conn.close()
+
 def get_last_stored_message_text(chat_id, message_id):
     try:
+        row = _lookup_message_snapshot(chat_id, message_id, "text")
+        if row:
+            return row[0] or ""
         with sqlite3.connect(CHAT_LOG_DB) as conn:
-            row = conn.execute(
-                "SELECT text FROM chat_message_snapshots WHERE chat_id=? AND message_id=? LIMIT 1",
-                (chat_id, message_id)
-            ).fetchone()
-            if row:
-                return row[0] or ""
             row = conn.execute(
                 """SELECT text FROM chat_events
                    WHERE chat_id=? AND message_id=? AND event_type IN ('new', 'edit')
@@ -828,72 +1895,98 @@ def get_last_stored_message_text(chat_id, message_id):
 
 def get_message_snapshot_info(chat_id, message_id):
     try:
-        with sqlite3.connect(CHAT_LOG_DB) as conn:
-            conn.row_factory = sqlite3.Row
-            row = conn.execute(
-                """SELECT first_ts, last_ts, sender_id, sender_name, text, msg_type, sender_role,
-                          reply_to_msg_id, grouped_id
-                   FROM chat_message_snapshots WHERE chat_id=? AND message_id=? LIMIT 1""",
-                (chat_id, message_id)
-            ).fetchone()
-            return dict(row) if row else {}
+        row = _lookup_message_snapshot(
+            chat_id, message_id,
+            "first_ts, last_ts, sender_id, sender_name, text, msg_type, sender_role, reply_to_msg_id, grouped_id"
+        )
+        return dict(row) if row else {}
     except Exception:
         return {}
 
 _CHAT_ID_RE = re.compile(r'\[(-100\d+)\]')
-_MSG_TYPE_MAP = [
-    ('[MSG]', 'user'), ('[ALERT]', 'alert'), ('[AUDIT]', 'audit'),
-    ('[DELETED]', 'deleted'), ('客服操作', 'cs'),
-]
 
 class SQLiteLogHandler(logging.Handler):
+    """只落库带 chat_log_type 标签（由 log_tree 在调用方打上）的记录，sys 日志在格式化前就被过滤掉。"""
+
+    def filter(self, record):
+        return getattr(record, "chat_log_type", None) is not None and super().filter(record)
+
     def emit(self, record):
         try:
             raw = self.format(record)
             ts = record.created
             m = _CHAT_ID_RE.search(raw)
             chat_id = int(m.group(1)) if m else None
-            msg_type = 'sys'
-            for marker, t in _MSG_TYPE_MAP:
-                if marker in raw:
-                    msg_type = t
-                    break
-            if msg_type == 'sys':
-                return
-            with _db_lock:
-                with sqlite3.connect(CHAT_LOG_DB) as conn:
-                    conn.execute(
-                        "INSERT INTO chat_logs(ts, chat_id, msg_type, raw) VALUES(?,?,?,?)",
-                        (ts, chat_id, msg_type, raw)
-                    )
-                    conn.commit()
+            msg_type = record.chat_log_type
+            key = chat_log_partitions.month_key(ts)
+            chat_log_writer.submit(
+                lambda conn: conn.execute(
+                    f"INSERT INTO {chat_log_partitions.schema('context', key)}.chat_logs(ts, chat_id, msg_type, raw) VALUES(?,?,?,?)",
+                    (ts, chat_id, msg_type, raw)
+                ),
+                prepare=lambda conn: chat_log_partitions.attach_for_write(conn, "context", key),
+            )
         except Exception:
             pass
 
 _sqlite_handler = SQLiteLogHandler()
 _sqlite_handler.setLevel(logging.DEBUG)
 _sqlite_handler.setFormatter(file_fmt)
-logger.addHandler(_sqlite_handler)
+_log_listener.handlers = _log_listener.handlers + (_sqlite_handler,)
+# atexit 后注册先执行：日志线程先排空队列，写线程再做最后一次提交
+chat_log_writer.start()
+atexit.register(_log_listener.stop)
 
 _group_name_cache = {}
+_group_title_listeners = []
+
+def on_group_title_change(callback):
+    """注册群名变更回调 callback(chat_id, old_title, new_title)；首次获知群名不算变更。"""
+    _group_title_listeners.append(callback)
+    return callback
+
+def _remember_group_title(chat_id, title):
+    if not chat_id or not title or _group_name_cache.get(chat_id) == title:
+        return False
+    old_title = _group_name_cache.get(chat_id)
+    _group_name_cache[chat_id] = title
+    # 解析失败时占位写入的是 str(chat_id)，不当作旧群名
+    if old_title and old_title != str(chat_id):
+        for callback in list(_group_title_listeners):
+            try:
+                callback(chat_id, old_title, title)
+            except Exception as e:
+                logger.error(f"❌ 群名变更回调失败 Chat={chat_id}: {e}")
+
+    def write(conn):
+        conn.execute(
+            """INSERT INTO main.chat_group_stats(chat_id, title) VALUES(?, ?)
+               ON CONFLICT(chat_id) DO UPDATE SET title=excluded.title""",
+            (chat_id, title)
+        )
+
+    try:
+        chat_log_writer.submit(write)
+    except Exception:
+        pass
+    return True
 
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 logging.getLogger('telethon').setLevel(logging.WARNING)
 
 _sys_opt = os.environ.get("OPTIMIZATION_LEVEL", "normal").lower() == "debug"
 
-def log_tree(level, msg):
-    prefix = ""
-    if level == 0:   prefix = "[MSG] "
-    elif level == 1: prefix = "  [+] "
-    elif level == 2: prefix = "  [-] "
-    elif level == 3: prefix = "[ALERT] "
-    elif level == 4: prefix = "[AUDIT] "
-    elif level == 9: prefix = "[ERROR] "
-    
-    full_msg = f"{prefix}{msg}"
-    if _sys_opt or level >= 2: logger.info(full_msg)
-    else: logger.debug(full_msg)
+_LOG_TREE_PREFIXES = {0: "[MSG] ", 1: "  [+] ", 2: "  [-] ", 3: "[ALERT] ", 4: "[AUDIT] ", 9: "[ERROR] "}
+# 写入 chat_logs 的分类标签，替代原先对格式化后文本做子串匹配
+_LOG_TREE_TAGS = {0: "user", 3: "alert", 4: "audit"}
+
+def log_tree(level, msg, *args):
+    """msg 可写成 %s 占位符并把变量放进 args：级别被过滤时不做任何格式化，格式化本身也在日志线程完成。"""
+    log_level = logging.INFO if _sys_opt or level >= 2 else logging.DEBUG
+    if not logger.isEnabledFor(log_level):
+        return
+    tag = _LOG_TREE_TAGS.get(level)
+    logger.log(log_level, _LOG_TREE_PREFIXES.get(level, "") + msg, *args, extra={"chat_log_type": tag} if tag else None)
 
 # ==========================================
 # 动态模块加载 (Stats & Responder)
@@ -1091,15 +2184,13 @@ def resolve_wait_alert_config(wait_signatures):
     return extract_signature_set(raw), {}, source
 
 def match_signature(text, signatures):
+    """返回 text 中出现的最长签名（等长时取字典序最小）；编译结果按签名集合缓存，配置变更后自动重建。"""
     if not text or not signatures: return None
-    for signature in sorted(signatures, key=len, reverse=True):
-        if signature and signature in text:
-            return signature
-    return None
+    return compile_signatures(signatures).match(text)
 
 def get_wait_alert_signatures():
     with wait_alert_config_lock:
-        return set(WAIT_ALERT_SIGNATURES)
+        return WAIT_ALERT_SIGNATURES
 
 def get_wait_alert_routes():
     with wait_alert_config_lock:
@@ -1461,8 +2552,10 @@ try:
     BOT_ALLOWED_USER_IDS = extract_all_id_set(bot_allowed_user_ids_env)
     
     wait_keywords_env = os.environ["WAIT_KEYWORDS"]
-    WAIT_SIGNATURES = extract_signature_set(wait_keywords_env)
+    # 签名集合一律冻结：不会被原地修改，作为 match_signature 的缓存键时哈希只算一次
+    WAIT_SIGNATURES = frozenset(extract_signature_set(wait_keywords_env))
     WAIT_ALERT_SIGNATURES, WAIT_ALERT_ROUTES, WAIT_ALERT_SOURCE = resolve_wait_alert_config(WAIT_SIGNATURES)
+    WAIT_ALERT_SIGNATURES = frozenset(WAIT_ALERT_SIGNATURES)
     unknown_alert_wait = WAIT_ALERT_SIGNATURES - WAIT_SIGNATURES
     if unknown_alert_wait:
         logger.warning(f"⚠️ {WAIT_ALERT_SOURCE} 中有 {len(unknown_alert_wait)} 个词不在 WAIT_KEYWORDS 内，不会触发稍等预警: {sorted(list(unknown_alert_wait))}")
@@ -1476,7 +2569,7 @@ try:
         keep_clean = keep_keywords_env.replace("，", ",")
         keep_list = keep_clean.split(',')
         
-    KEEP_SIGNATURES = {x.strip() for x in keep_list if x.strip()}
+    KEEP_SIGNATURES = frozenset(x.strip() for x in keep_list if x.strip())
     
     log_tree(0, f"🔍 关键词配置: CS_GROUPS={len(CONFIGURED_CS_GROUP_IDS)} | WAIT={len(WAIT_SIGNATURES)} | WAIT_ALERT={len(WAIT_ALERT_SIGNATURES)} ({WAIT_ALERT_SOURCE}) | KEEP={len(KEEP_SIGNATURES)}")
 
@@ -1511,9 +2604,15 @@ REPLY_TIMEOUT = 5 * 60
 SELF_REPLY_TIMEOUT = 3 * 60 
 
 MAX_CACHE_SIZE = 50000 
+MAX_GROUP_CACHE_SIZE = 5000
+# 消息级缓存只服务于几小时内的倒计时与回复溯源，过期后再用到会回落到 API 查询
+MSG_CACHE_TTL_SECONDS = int(os.environ.get("MSG_CACHE_TTL_SECONDS", str(24 * 3600)) or "0") or None
+MSG_CONTENT_CACHE_MAX_MB = int(os.environ.get("MSG_CONTENT_CACHE_MAX_MB", "64") or "64")
 WAIT_CHECK_ALL_RATE_LIMIT_SECONDS = 60 * 60
 WAIT_CHECK_ALL_RATE_LIMIT_REDIS_KEY = "wait_check_all_rate_limit_v1"
 
+# 各 *_tasks 里存的是 alert_timers 的句柄（接口同 asyncio.Task）：倒计时期间只占一个堆条目，到期才起 task
+alert_timers = TimerService(logger)
 wait_tasks = {}
 followup_tasks = {} 
 reply_tasks = {}
@@ -1525,20 +2624,28 @@ followup_timers = {}
 reply_timers = {}
 self_reply_timers = {} 
 
-# [重要] 映射表：CS回复的消息ID -> 客户原始消息ID
-wait_msg_map = {}        
-followup_msg_map = {} 
+# [重要] 映射表：CS回复的消息ID -> 客户原始消息ID（带反查，按客户消息删除映射是 O(1)）
+wait_msg_map = ReverseIndexedMap()
+followup_msg_map = ReverseIndexedMap()
 deleted_cache = deque(maxlen=10000)
 self_reply_dedup = deque(maxlen=1000) 
 
-chat_user_active_msgs = {}
-chat_thread_active_msgs = {}
+# 计时中消息的索引；下面两个 dict 是它的只读视图，修改只走 register_task / remove_task_record
+active_msgs = ActiveMessageIndex()
+chat_user_active_msgs = active_msgs.by_user
+chat_thread_active_msgs = active_msgs.by_thread
+
+def _msg_content_size(info):
+    return 120 + 4 * (len(info.get('name') or '') + len(info.get('text') or ''))
 
-msg_to_user_cache = {} 
-msg_content_cache = {}
-msg_group_cache = {}
-group_to_user_cache = {}
-group_to_msg_ids_cache = {}
+msg_to_user_cache = BoundedCache("msg_to_user", MAX_CACHE_SIZE, ttl=MSG_CACHE_TTL_SECONDS)
+msg_content_cache = BoundedCache(
+    "msg_content", MAX_CACHE_SIZE, ttl=MSG_CACHE_TTL_SECONDS,
+    max_bytes=MSG_CONTENT_CACHE_MAX_MB * 1024 * 1024, sizeof=_msg_content_size
+)
+msg_group_cache = BoundedCache("msg_group", MAX_CACHE_SIZE, ttl=MSG_CACHE_TTL_SECONDS)
+group_to_user_cache = BoundedCache("group_to_user", MAX_GROUP_CACHE_SIZE, ttl=MSG_CACHE_TTL_SECONDS)
+group_to_msg_ids_cache = BoundedCache("group_to_msg_ids", MAX_GROUP_CACHE_SIZE, ttl=MSG_CACHE_TTL_SECONDS)
 
 cs_activity_log = {}
 
@@ -1548,6 +2655,12 @@ bot_loop = None
 stop_work_lock = None
 wait_check_all_rate_lock = Lock()
 wait_check_all_last_request_ts = 0.0
+# 漏回检测/下班巡检任务结束后结果保留多久：期间同样的请求直接回放，不重新扫描
+WAIT_CHECK_JOB_RETENTION_SECONDS = int(os.environ.get("WAIT_CHECK_JOB_RETENTION_SECONDS", "900") or "0")
+job_manager = JobManager(retention=WAIT_CHECK_JOB_RETENTION_SECONDS, logger=logger)
+# 增量检测断点的有效期：超过后下一次检测退回全量扫描
+WAIT_CHECK_CHECKPOINT_TTL_SECONDS = int(os.environ.get("WAIT_CHECK_CHECKPOINT_TTL_SECONDS", str(2 * 3600)) or "0")
+wait_check_checkpoints = WaitCheckCheckpoints(ttl=WAIT_CHECK_CHECKPOINT_TTL_SECONDS)
 
 BEIJING_TZ = timezone(timedelta(hours=8))
 ZC_BATCH_STATE = {}
@@ -1580,6 +2693,9 @@ WAIT_CHECK_SHIFT_WINDOWS = {
 }
 WAIT_CHECK_APPROVAL_MISSED_KEYWORD = "同意遗漏"
 WAIT_CHECK_LOOKBACK_HOURS = 12
+# 漏回检测同时拉取历史的群数，以及每个群拉取与判定之间最多缓冲的消息数
+WAIT_CHECK_GROUP_CONCURRENCY = max(1, int(os.environ.get("WAIT_CHECK_GROUP_CONCURRENCY", "4") or "4"))
+WAIT_CHECK_PIPELINE_DEPTH = 500
 WAIT_CHECK_REPLY_CONTINUATION_MAX_MESSAGES = 3
 WAIT_CHECK_REPLY_CONTINUATION_SECONDS = 180
 WAIT_CHECK_CONTINUATION_PHRASES = [
@@ -2084,24 +3200,11 @@ def try_acquire_wait_check_all_slot():
 
 def update_msg_cache(chat_id, msg_id, user_id, grouped_id=None):
     key = (chat_id, msg_id)
-    if len(msg_to_user_cache) >= MAX_CACHE_SIZE:
-        try: msg_to_user_cache.pop(next(iter(msg_to_user_cache)))
-        except StopIteration: pass
     msg_to_user_cache[key] = user_id
     if grouped_id:
         g_key = (chat_id, grouped_id)
         msg_group_cache[key] = grouped_id
-        if len(group_to_user_cache) >= 5000:
-             if g_key not in group_to_user_cache:
-                 try: group_to_user_cache.pop(next(iter(group_to_user_cache)))
-                 except StopIteration: pass
         group_to_user_cache[g_key] = user_id
-        if len(group_to_msg_ids_cache) >= 5000 and g_key not in group_to_msg_ids_cache:
-            try:
-                old_group_key = next(iter(group_to_msg_ids_cache))
-                del group_to_msg_ids_cache[old_group_key]
-            except StopIteration:
-                pass
         group_to_msg_ids_cache.setdefault(g_key, set()).add(msg_id)
 
 def get_cached_album_msg_ids(chat_id, msg_id):
@@ -2150,9 +3253,6 @@ def get_related_album_msg_ids(chat_id, msg_id):
 
 def update_content_cache(chat_id, msg_id, name, text):
     key = (chat_id, msg_id)
-    if len(msg_content_cache) >= MAX_CACHE_SIZE:
-        try: msg_content_cache.pop(next(iter(msg_content_cache)))
-        except StopIteration: pass
     safe_text = text[:100].replace('\n', ' ') if text else "[非文本/空]"
     msg_content_cache[key] = {'name': name, 'text': safe_text}
 
@@ -2178,7 +3278,7 @@ async def is_official_cs(message):
     sender_id = message.sender_id
     if (sender_id == MY_ID) or (sender_id in OTHER_CS_IDS): return True
     try:
-        sender = await message.get_sender()
+        sender = await entity_cache.sender_of(message)
         if not sender: return False
         name = getattr(sender, 'first_name', '') or ''
         for prefix in CS_NAME_PREFIXES:
@@ -2195,7 +3295,7 @@ async def get_cs_message_signature(message, signatures):
         is_cs = True
     else:
         try:
-            sender = await message.get_sender()
+            sender = await entity_cache.sender_of(message)
             if sender and getattr(sender, 'first_name', '').startswith(tuple(CS_NAME_PREFIXES)):
                 is_cs = True
         except Exception:
@@ -2205,21 +3305,42 @@ async def get_cs_message_signature(message, signatures):
         return None
     return match_signature(message.text, signatures)
 
+async def recent_history(chat_id, limit, thread_id=None, until_ts=None):
+    """最近消息（从新到旧）：本地窗口能给出完整结果时直接用，否则按原参数请求 iter_messages。"""
+    local = local_history.recent(chat_id, limit, until_ts=until_ts, thread_id=thread_id)
+    if local is not None:
+        return local
+    kwargs = {'limit': limit}
+    if thread_id:
+        kwargs['reply_to'] = thread_id
+    history = []
+    async for m in client.iter_messages(chat_id, **kwargs):
+        history.append(m)
+        if until_ts is not None and m.date and m.date.timestamp() <= until_ts:
+            break
+    return history
+
+async def get_message_cached(chat_id, msg_id):
+    exists = local_history.exists(chat_id, msg_id)
+    if exists is False:
+        return None
+    if exists:
+        return local_history.get(chat_id, msg_id)
+    return await message_batcher.get(chat_id, msg_id)
+
 async def find_wait_keyword_in_history(chat_id, thread_id=None, limit=30, signatures=None):
     try:
         target_signatures = WAIT_SIGNATURES if signatures is None else signatures
         if not target_signatures:
             return None
 
-        kwargs = {'limit': limit}
         if thread_id:
-            root_msg = await client.get_messages(chat_id, ids=thread_id)
+            root_msg = await get_message_cached(chat_id, thread_id)
             root_keyword = await get_cs_message_signature(root_msg, target_signatures)
             if root_keyword:
                 return root_keyword
-            kwargs['reply_to'] = thread_id
-             
-        async for m in client.iter_messages(chat_id, **kwargs):
+
+        for m in await recent_history(chat_id, limit, thread_id=thread_id):
             keyword = await get_cs_message_signature(m, target_signatures)
             if keyword:
                 return keyword
@@ -2242,6 +3363,9 @@ async def maintenance_task():
             now = time.time()
             expired_keys = [k for k, v in cs_activity_log.items() if now - v > 3600]
             for k in expired_keys: del cs_activity_log[k]
+            purge_expired_caches()
+            ai_verdict_cache.purge_expired()
+            await asyncio.get_event_loop().run_in_executor(None, entity_cache.save)
         except Exception as e: logger.error(f"维护任务出错: {e}")
 
 # ==========================================
@@ -2765,6 +3889,9 @@ WAIT_CHECK_HTML = """
                     <label>指定日期 (北京时间，可选；选择后扫描当天 00:00-24:00)</label>
                     <input type="date" id="checkDate">
                 </div>
+                <div class="form-group">
+                    <label><input type="checkbox" id="forceRescan" style="width:auto;margin-right:6px">全量重扫 (默认只拉取上次检测后的新消息并复核未闭环项)</label>
+                </div>
                 <button onclick="startCheck()" id="btn-search">
                     <svg class="icon" viewBox="0 0 24 24"><circle cx="11" cy="11" r="8"/><line x1="21" y1="21" x2="16.65" y2="16.65"/></svg> 开始排查
                 </button>
@@ -2818,6 +3945,7 @@ WAIT_CHECK_HTML = """
             try {
                 const params = new URLSearchParams({keyword});
                 if (checkDate) params.set('date', checkDate);
+                if (document.getElementById('forceRescan').checked) params.set('force', '1');
                 const response = await fetch(`/api/wait_check_stream?${params.toString()}`);
                 if (!response.ok) {
                     const errorText = await response.text();
@@ -2844,7 +3972,9 @@ WAIT_CHECK_HTML = """
                         if (!line.trim()) continue; // 忽略为了防反向代理缓冲而补充的空白行
                         try {
                             const data = JSON.parse(line);
-                            if (data.type === 'progress') {
+                            if (data.type === 'job') {
+                                if (data.attached) pText.innerText = data.status === 'running' ? '已有相同检测正在进行，接入并回放进度...' : '回放最近一次相同检测的结果...';
+                            } else if (data.type === 'progress') {
                                 pFill.style.width = data.percent + '%';
                                 pText.innerText = data.msg;
                             } else if (data.type === 'result') {
@@ -3909,6 +5039,22 @@ def log_db():
         mode = "all"
     limit = min(request.args.get('limit', 600, type=int), 5000)
     before_ts = request.args.get('before_ts', type=float)
+    if 'cursor' in request.args:
+        # 游标分页：cursor 为空表示从最新一页开始，返回 {"rows": [...], "next_cursor": ...}
+        try:
+            cursor = _decode_log_cursor(request.args.get('cursor'))
+        except ValueError:
+            return jsonify({"rows": [], "next_cursor": None, "error": "invalid cursor"}), 400
+        if cursor is None and before_ts:
+            cursor = (before_ts, -1, 0, 0)
+        try:
+            rows, next_cursor = _page_chat_event_rows(chat_id=chat_id, limit=max(limit, 1), mode=mode, cursor=cursor)
+            if not rows and cursor is None and mode == "all":
+                rows = _legacy_chat_log_rows(chat_id=chat_id, limit=max(limit, 1))
+            return jsonify({"rows": rows, "next_cursor": next_cursor})
+        except Exception as e:
+            logger.error(f"❌ log_db 查询失败: {e}")
+            return jsonify({"rows": [], "next_cursor": None})
     try:
         data = _chat_event_rows(chat_id=chat_id, limit=limit, mode=mode, before_ts=before_ts)
         if not data and mode == "all":
@@ -3924,9 +5070,12 @@ def log_search():
     mode = (request.args.get('mode') or 'all').lower()
     if mode not in {"all", "audit", "edit", "delete", "context"}:
         mode = "all"
+    sort = (request.args.get('sort') or 'recent').lower()
+    if sort not in {"recent", "rank"}:
+        sort = "recent"
     limit = min(max(request.args.get('limit', 300, type=int), 1), 1000)
     try:
-        return jsonify(_search_log_rows(q, chat_id=chat_id, limit=limit, mode=mode))
+        return jsonify(_search_log_rows(q, chat_id=chat_id, limit=limit, mode=mode, sort=sort))
     except Exception as e:
         logger.error(f"❌ log_search 查询失败: {e}")
         return jsonify([])
@@ -3939,6 +5088,22 @@ def log_day():
     if mode not in {"all", "audit", "edit", "delete", "context"}:
         mode = "all"
     limit = min(max(request.args.get('limit', 1000, type=int), 1), 5000)
+    if 'cursor' in request.args:
+        # 游标分页：首页按日期定位，之后按 next_cursor 继续向后翻
+        try:
+            cursor = _decode_log_cursor(request.args.get('cursor'))
+        except ValueError:
+            return jsonify({"rows": [], "next_cursor": None, "error": "invalid cursor"}), 400
+        try:
+            if cursor is None:
+                cursor = (_day_start_ts(date_text), -1, 0, 0)
+            rows, next_cursor = _page_chat_event_rows(
+                chat_id=chat_id, limit=limit, mode=mode, cursor=cursor, direction="after"
+            )
+            return jsonify({"rows": rows, "next_cursor": next_cursor})
+        except Exception as e:
+            logger.error(f"❌ log_day 查询失败: {e}")
+            return jsonify({"rows": [], "next_cursor": None})
     try:
         start_ts = _day_start_ts(date_text)
         return jsonify(_rows_from_ts(start_ts, chat_id=chat_id, limit=limit, mode=mode))
@@ -3946,40 +5111,49 @@ def log_day():
         logger.error(f"❌ log_day 查询失败: {e}")
         return jsonify([])
 
+def _log_stream_matches(meta, chat_id, mode):
+    row_chat_id, source, event_type = meta
+    if chat_id and row_chat_id != chat_id:
+        return False
+    if mode == "audit":
+        return source == "audit"
+    if mode in ("edit", "delete"):
+        return event_type == mode
+    if mode == "context":
+        return source != "audit"
+    return True
+
 @app.route('/log_stream')
 def log_stream():
     chat_id = request.args.get('chat_id', type=int)
     mode = (request.args.get('mode') or 'all').lower()
+    # EventSource 断线重连时自动带上 Last-Event-ID，从共享缓冲续传断线期间的事件
+    resume_id = request.headers.get('Last-Event-ID') or request.args.get('last_id')
+    try:
+        after_id = int(resume_id) if resume_id else None
+    except ValueError:
+        after_id = None
 
     def generate():
-        q = queue.Queue(maxsize=200)
-        with _sse_clients_lock:
-            _sse_clients.append(q)
-        try:
-            yield ": connected\n\n"
-            while True:
-                try:
-                    payload = q.get(timeout=25)
-                    row = json.loads(payload)
-                    if chat_id and row.get("chat_id") != chat_id:
-                        continue
-                    if mode == "audit" and row.get("source") != "audit":
-                        continue
-                    if mode == "edit" and row.get("event_type") != "edit":
-                        continue
-                    if mode == "delete" and row.get("event_type") != "delete":
-                        continue
-                    if mode == "context" and row.get("source") == "audit":
-                        continue
-                    yield f"data: {payload}\n\n"
-                except queue.Empty:
-                    yield ": ping\n\n"
-        finally:
-            with _sse_clients_lock:
-                try:
-                    _sse_clients.remove(q)
-                except ValueError:
-                    pass
+        cursor = chat_event_hub.last_id if after_id is None else after_id
+        yield "retry: 3000\n: connected\n\n"
+        while True:
+            events, next_cursor, reset = chat_event_hub.read(cursor, timeout=25)
+            if reset:
+                yield f"id: {next_cursor}\nevent: reset\ndata: {{}}\n\n"
+            elif not events:
+                yield ": ping\n\n"
+            else:
+                frames = [
+                    f"id: {event_id}\ndata: {payload}\n\n"
+                    for event_id, meta, payload in events
+                    if _log_stream_matches(meta, chat_id, mode)
+                ]
+                if not _log_stream_matches(events[-1][1], chat_id, mode):
+                    # 被过滤掉的事件也要推进客户端的 Last-Event-ID；没有 data 的帧不会触发 onmessage
+                    frames.append(f"id: {next_cursor}\n\n")
+                yield "".join(frames)
+            cursor = next_cursor
 
     return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
@@ -3995,30 +5169,133 @@ def log_flow():
         logger.error(f"❌ log_flow 查询失败: {e}")
         return jsonify([])
 
+def _scan_log_groups(conn):
+    """群组统计表首次重建完成前的回退：逐库扫描快照与审计事件取各群最近活动时间。"""
+    latest = {}
+
+    def scan(schema, families):
+        queries = []
+        if "context" in families:
+            queries.append(
+                f"SELECT chat_id, MAX(first_ts) FROM {schema}.chat_message_snapshots WHERE chat_id IS NOT NULL GROUP BY chat_id"
+            )
+        if "audit" in families:
+            queries.append(
+                f"""SELECT chat_id, MAX(ts) FROM {schema}.chat_events
+                   WHERE chat_id IS NOT NULL AND event_type IN ('edit', 'delete') GROUP BY chat_id"""
+            )
+        for sql in queries:
+            for chat_id, last_ts in conn.execute(sql).fetchall():
+                if last_ts is not None and last_ts > latest.get(chat_id, float("-inf")):
+                    latest[chat_id] = last_ts
+
+    scan("main", ("context", "audit"))
+    for family in ("context", "audit"):
+        for key in chat_log_partitions.keys(family):
+            with chat_log_partitions.mounted(conn, [(family, key)]) as (schema,):
+                if schema:
+                    scan(schema, (family,))
+    return [{"chat_id": chat_id, "last_ts": last_ts} for chat_id, last_ts in latest.items()]
+
 @app.route('/log_groups')
 def log_groups():
     try:
-        with sqlite3.connect(CHAT_LOG_DB) as conn:
-            rows = conn.execute(
-                """SELECT chat_id, MAX(last_ts) AS last_ts FROM (
-                    SELECT chat_id, MAX(first_ts) AS last_ts FROM chat_message_snapshots WHERE chat_id IS NOT NULL GROUP BY chat_id
-                    UNION ALL
-                    SELECT chat_id, MAX(ts) AS last_ts FROM chat_events WHERE chat_id IS NOT NULL AND event_type IN ('edit', 'delete') GROUP BY chat_id
-                ) GROUP BY chat_id ORDER BY last_ts DESC"""
-            ).fetchall()
-            if not rows:
-                rows = conn.execute(
-                    "SELECT chat_id, MAX(ts) as last_ts FROM chat_logs WHERE chat_id IS NOT NULL GROUP BY chat_id ORDER BY last_ts DESC"
-                ).fetchall()
-        # Try to get group names from Telegram client
-        result = []
-        for chat_id, _ in rows:
-            name = _group_name_cache.get(chat_id, str(chat_id))
-            result.append({"chat_id": chat_id, "name": name})
-        return jsonify(result)
+        conn = _chat_log_reader()
+        try:
+            if _chat_group_stats_state["ready"]:
+                groups = [
+                    dict(row) for row in conn.execute(
+                        """SELECT chat_id, title, last_ts, message_count, edit_count, delete_count
+                           FROM chat_group_stats WHERE last_ts IS NOT NULL"""
+                    ).fetchall()
+                ]
+            else:
+                groups = _scan_log_groups(conn)
+            if not groups:
+                groups = [
+                    {"chat_id": chat_id, "last_ts": last_ts}
+                    for chat_id, last_ts in conn.execute(
+                        "SELECT chat_id, MAX(ts) as last_ts FROM chat_logs WHERE chat_id IS NOT NULL GROUP BY chat_id"
+                    ).fetchall()
+                ]
+        finally:
+            conn.close()
+        groups.sort(key=lambda item: item["last_ts"] or 0, reverse=True)
+        for item in groups:
+            title = item.pop("title", None)
+            item["name"] = _group_name_cache.get(item["chat_id"]) or title or str(item["chat_id"])
+        return jsonify(groups)
     except Exception as e:
         return jsonify([])
 
+@app.route('/log_group_stats')
+def log_group_stats():
+    chat_id = request.args.get('chat_id', type=int)
+    days = min(max(request.args.get('days', 30, type=int), 1), 400)
+    start_day = (datetime.now(timezone(timedelta(hours=8))) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    try:
+        conn = _chat_log_reader()
+        try:
+            where_sql = "WHERE day >= ?" + (" AND chat_id=?" if chat_id else "")
+            params = (start_day, chat_id) if chat_id else (start_day,)
+            daily = [
+                dict(row) for row in conn.execute(
+                    f"""SELECT chat_id, day, message_count, edit_count, delete_count
+                       FROM chat_group_daily_stats {where_sql} ORDER BY chat_id, day""",
+                    params
+                ).fetchall()
+            ]
+            totals = [
+                dict(row) for row in conn.execute(
+                    "SELECT chat_id, title, last_ts, message_count, edit_count, delete_count FROM chat_group_stats"
+                    + (" WHERE chat_id=?" if chat_id else ""),
+                    (chat_id,) if chat_id else ()
+                ).fetchall()
+            ]
+        finally:
+            conn.close()
+        return jsonify({"ok": True, "ready": _chat_group_stats_state["ready"], "groups": totals, "daily": daily})
+    except Exception as e:
+        logger.error(f"❌ log_group_stats 查询失败: {e}")
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+@app.route('/api/runtime_stats')
+def api_runtime_stats():
+    return jsonify({
+        "ok": True,
+        "chat_log_writer": chat_log_writer.stats(),
+        "chat_log_fts": _chat_log_fts_state,
+        "chat_log_partitions": chat_log_partitions.stats(),
+        "chat_log_migration": _chat_log_migration_state,
+        "chat_log_snapshot_backfill": _chat_log_backfill_state,
+        "chat_log_thread_backfill": _chat_log_thread_backfill_state,
+        "chat_group_stats": _chat_group_stats_state,
+        "chat_event_hub": chat_event_hub.stats(),
+        "alert_timers": alert_timers.counts(),
+        "pending_timers": pending_timer_stats(),
+        "caches": cache_stats(),
+        "message_batcher": message_batcher.stats(),
+        "entity_cache": entity_cache.stats(),
+        "local_history": local_history.stats(),
+        "ai_verdict_cache": ai_verdict_cache.stats(),
+        "ai_classifier": ai_classifier.stats(),
+        "jobs": job_manager.stats(),
+        "wait_check_checkpoints": wait_check_checkpoints.stats(),
+        "gemini_rate_limiter": gemini_rate_limiter.stats(),
+        "group_metadata": dict(group_metadata_state),
+        "loop_monitor": loop_monitor.stats(),
+    })
+
+@app.route('/api/loop_offenders')
+def api_loop_offenders():
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    return jsonify({"ok": True, "offenders": loop_monitor.top_offenders(limit)})
+
+@app.route('/api/jobs')
+def api_jobs():
+    kind = request.args.get('kind', '').strip() or None
+    return jsonify({"ok": True, "jobs": job_manager.list(kind), "stats": job_manager.stats()})
+
 @app.after_request
 def add_header(response):
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
@@ -4069,7 +5346,7 @@ def api_wait_alerts():
     routes = normalize_alert_routes(data.get("alert_routes", {}), WAIT_SIGNATURES)
 
     with wait_alert_config_lock:
-        WAIT_ALERT_SIGNATURES = set(selected)
+        WAIT_ALERT_SIGNATURES = frozenset(selected)
         WAIT_ALERT_ROUTES = dict(routes)
 
     persisted, store_status = persist_wait_alert_config(selected, routes)
@@ -4085,22 +5362,45 @@ def api_wait_alerts():
         "ignored_keywords": sorted(list(unknown)),
     })
 
+def start_wait_check_job(keyword, date_text="", refresh=False, force=False):
+    """
+    同一 (关键词, 日期) 的检测进行中或刚结束时直接接到已有任务上；refresh 只在旧任务已结束时重新跑。
+    force 忽略增量断点全量重扫（同时视为 refresh）。
+    """
+    return job_manager.start(
+        "wait_check",
+        (keyword, date_text),
+        lambda job: asyncio.run_coroutine_threadsafe(
+            check_wait_keyword_logic(keyword, job, date_text=date_text, force=force), bot_loop
+        ),
+        params={"keyword": keyword, "date": date_text, "force": force},
+        refresh=refresh or force,
+    )
+
 @app.route('/api/wait_check_stream')
 def wait_check_stream():
+    job_id = request.args.get('job', '').strip()
     keyword = request.args.get('keyword', '').strip()
     date_text = request.args.get('date', '').strip()
-    if not keyword: return "Keyword required", 400
-    if not bot_loop:
-        return jsonify({"ok": False, "error": "Bot loop not ready"}), 503
+    if job_id:
+        job = job_manager.get(job_id)
+        if not job:
+            return jsonify({"ok": False, "error": "任务不存在或已过期"}), 404
+        created = False
+    else:
+        if not keyword: return "Keyword required", 400
+        if not bot_loop:
+            return jsonify({"ok": False, "error": "Bot loop not ready"}), 503
+        job, created = start_wait_check_job(
+            keyword, date_text,
+            refresh=request.args.get('refresh') == '1',
+            force=request.args.get('force') == '1',
+        )
     def generate():
-        result_queue = queue.Queue()
-        asyncio.run_coroutine_threadsafe(check_wait_keyword_logic(keyword, result_queue, date_text=date_text), bot_loop)
-        
         yield (" " * 4096) + "\n"
+        yield json.dumps({"type": "job", "id": job.id, "attached": not created, "status": job.status}) + "\n"
         
-        while True:
-            data = result_queue.get()
-            if data is None: break
+        for data in job.follow():
             yield data + "\n" + (" " * 4096) + "\n"
             
     response = Response(stream_with_context(generate()), mimetype='text/plain')
@@ -4118,10 +5418,33 @@ def run_web():
 # ==========================================
 
 GEMINI_API_ROOT = "https://generativelanguage.googleapis.com/v1beta"
+# Gemini 每分钟请求配额；所有 AI 调用共用一个令牌桶，0 表示不限速
+GEMINI_RPM = float(os.environ.get("GEMINI_RPM", "60") or "0")
+# 漏回检测 AI 研判：同时在途的请求数、每次请求打包的判定条数（1 表示不打包）、每条判定的截止时间
+AI_CLASSIFY_CONCURRENCY = max(1, int(os.environ.get("AI_CLASSIFY_CONCURRENCY", "4") or "4"))
+AI_CLASSIFY_BATCH_SIZE = max(1, int(os.environ.get("AI_CLASSIFY_BATCH_SIZE", "4") or "1"))
+AI_CLASSIFY_BATCH_WINDOW_MS = 50
+AI_CLASSIFY_DEADLINE_SECONDS = float(os.environ.get("AI_CLASSIFY_DEADLINE_SECONDS", "120") or "120")
+
+gemini_rate_limiter = TokenBucket(GEMINI_RPM / 60.0, burst=AI_CLASSIFY_CONCURRENCY)
+
+ai_verdict_cache = VerdictCache(
+    lambda: sqlite3.connect(CHAT_LOG_DB),
+    lambda job: chat_log_writer.submit(job),
+    ttl=AI_VERDICT_CACHE_TTL_SECONDS,
+    logger=logger,
+)
 
-def _gemini_generate_json(prompt, timeout=60):
+def _gemini_generate_json(prompt, timeout=60, deadline=None):
+    """deadline 为 time.monotonic() 时刻：排队等令牌和 HTTP 请求都不会超过它。"""
     if not GEMINI_API_KEY:
         raise RuntimeError("GEMINI_API_KEY 未配置")
+    if not gemini_rate_limiter.acquire(deadline):
+        raise DeadlineExceeded("等待 Gemini 配额超时")
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.monotonic())
+        if timeout <= 0:
+            raise DeadlineExceeded("Gemini 判定已超时")
 
     url = f"{GEMINI_API_ROOT}/models/{GEMINI_MODEL}:generateContent"
     payload = {
@@ -4145,18 +5468,82 @@ def _gemini_generate_json(prompt, timeout=60):
         raise RuntimeError("Gemini返回为空")
     return json.loads(raw_content)
 
-def _ai_check_reply_needed(text):
+def _gemini_verdict(kind, prompt, timeout=60, ref=None, stats=None):
+    """带持久缓存的 _gemini_generate_json；ref=(chat_id, message_id) 为判定对象，stats 收集本次任务的命中情况。"""
+    key = verdict_key(kind, GEMINI_MODEL, prompt)
+    decision = ai_verdict_cache.get(key)
+    if stats is not None:
+        stats.record(kind, decision is not None)
+    if decision is not None:
+        return decision
+    decision = _gemini_generate_json(prompt, timeout=timeout)
+    chat_id, message_id = ref or (None, None)
+    ai_verdict_cache.put(key, kind, GEMINI_MODEL, decision, chat_id, message_id)
+    return decision
+
+def _gemini_classify_batch(kind, prompts, deadline):
+    """
+    把多条独立判定打包成一次请求，按 task 序号拆回；返回与 prompts 对齐的列表，没拿到的为 None（由调用方逐条重试）。
+    每条任务保留完整原始 prompt，判定口径与单条请求一致。
+    """
+    tasks = "\n\n".join(f"===== 任务 {idx + 1} =====\n{prompt.strip()}" for idx, prompt in enumerate(prompts))
+    packed = f"""
+    下面有 {len(prompts)} 个互相独立的判定任务，每个任务都带有完整的说明和上下文。
+    请逐个独立判断，不要让一个任务的内容影响另一个任务的结论。
+
+    {tasks}
+
+    请输出 JSON 格式: {{"results": [{{"task": 任务序号, ...该任务要求输出的全部字段}}, ...]}}，每个任务一项。
+    """
+    decision = _gemini_generate_json(packed, timeout=AI_CLASSIFY_DEADLINE_SECONDS, deadline=deadline)
+    results = [None] * len(prompts)
+    items = decision.get("results") if isinstance(decision, dict) else decision
+    for item in items if isinstance(items, list) else ():
+        if not isinstance(item, dict):
+            continue
+        try:
+            idx = int(item.pop("task")) - 1
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 <= idx < len(results) and results[idx] is None:
+            results[idx] = item
+    return results
+
+ai_classifier = BatchClassifier(
+    lambda prompt, deadline: _gemini_generate_json(prompt, timeout=AI_CLASSIFY_DEADLINE_SECONDS, deadline=deadline),
+    _gemini_classify_batch,
+    concurrency=AI_CLASSIFY_CONCURRENCY,
+    max_batch=AI_CLASSIFY_BATCH_SIZE,
+    window_ms=AI_CLASSIFY_BATCH_WINDOW_MS,
+    deadline=AI_CLASSIFY_DEADLINE_SECONDS,
+    logger=logger,
+)
+
+async def _gemini_verdict_async(kind, prompt, timeout=None, ref=None, stats=None):
+    """_gemini_verdict 的管线版：缓存未命中的判定交给 ai_classifier 并发/打包请求。"""
+    key = verdict_key(kind, GEMINI_MODEL, prompt)
+    decision = await asyncio.get_event_loop().run_in_executor(None, ai_verdict_cache.get, key)
+    if stats is not None:
+        stats.record(kind, decision is not None)
+    if decision is not None:
+        return decision
+    decision = await ai_classifier.classify(kind, prompt, timeout=timeout)
+    chat_id, message_id = ref or (None, None)
+    ai_verdict_cache.put(key, kind, GEMINI_MODEL, decision, chat_id, message_id)
+    return decision
+
+def _ai_check_reply_needed(text, ref=None, stats=None):
     # 交由 AI 判断是否需要回复，避免本地关键词规则过度干预。
     prompt = f"判断客户消息是否需要回复。消息: '{text}'\n如果是礼貌结束语(如：好、好的、谢谢、收到、ok等)或无意义，返回false。如果是问题或业务请求，返回true。\nJSON: {{'reason': '...', 'need_reply': true/false}}"
     try:
-        decision = _gemini_generate_json(prompt, timeout=60)
+        decision = _gemini_verdict("reply_needed", prompt, timeout=60, ref=ref, stats=stats)
         return (decision.get("need_reply", True), decision.get("reason", "AI Decision"))
     except: pass
     return (True, "⚠️ AI出错，请人工核查")
 
-def _ai_check_orphan_context(target_text, context_text_list, target_label="User"):
+async def _ai_check_orphan_context(target_text, context_text_list, target_label="User", ref=None, stats=None):
     """
-    [Sync Function] [Ver 45.20/22]
+    [Ver 45.20/22]
     让 AI 自由思考上下文，移除死板规则。
     """
     if not target_text or len(target_text) < 1: return (True, "忽略空消息") 
@@ -4190,7 +5577,7 @@ def _ai_check_orphan_context(target_text, context_text_list, target_label="User"
     """
 
     try:
-        decision = _gemini_generate_json(prompt, timeout=60)
+        decision = await _gemini_verdict_async("orphan_context", prompt, ref=ref, stats=stats)
         is_exempt = decision.get("is_exempt", False)
         reason = decision.get("reason", "AI Decision")
         log_tree(2, log_prefix + f"✅ AI判定: 豁免={is_exempt} | {reason}")
@@ -4199,7 +5586,7 @@ def _ai_check_orphan_context(target_text, context_text_list, target_label="User"
         log_tree(9, log_prefix + f"❌ AI Check Failed: {e}，标记人工核查")
         return (False, f"⚠️ AI出错，请人工核查")
 
-def _ai_check_wait_check_context_resolution(target_text, context_text_list, target_label="User"):
+async def _ai_check_wait_check_context_resolution(target_text, context_text_list, target_label="User", ref=None, stats=None):
     """
     连续发言/相邻上下文覆盖不能只靠代码闭环；由 AI 判断是否同一事件且已处理。
     """
@@ -4226,7 +5613,7 @@ def _ai_check_wait_check_context_resolution(target_text, context_text_list, targ
     """
 
     try:
-        decision = _gemini_generate_json(prompt, timeout=60)
+        decision = await _gemini_verdict_async("context_resolution", prompt, ref=ref, stats=stats)
         is_exempt = decision.get("is_exempt", False)
         reason = decision.get("reason", "AI Decision")
         log_tree(2, log_prefix + f"✅ AI判定连续上下文闭环: 豁免={is_exempt} | {reason}")
@@ -4235,7 +5622,7 @@ def _ai_check_wait_check_context_resolution(target_text, context_text_list, targ
         log_tree(9, log_prefix + f"❌ AI连续上下文判定失败: {e}，标记人工核查")
         return (False, f"⚠️ AI出错，请人工核查")
 
-def _ai_check_reply_continuation(anchor_text, followup_texts):
+async def _ai_check_reply_continuation(anchor_text, followup_texts, ref=None, stats=None):
     if not followup_texts:
         return True, "无补充消息"
 
@@ -4257,13 +5644,13 @@ def _ai_check_reply_continuation(anchor_text, followup_texts):
     """
 
     try:
-        decision = _gemini_generate_json(prompt, timeout=30)
+        decision = await _gemini_verdict_async("reply_continuation", prompt, timeout=30, ref=ref, stats=stats)
         return decision.get("is_continuation", False), decision.get("reason", "AI Decision")
     except Exception as e:
         log_tree(9, f"❌ AI补充判定失败: {e}，按新问题处理")
     return False, "AI补充判定失败，按新问题处理"
 
-async def _check_is_closed_logic(latest_msg):
+async def _check_is_closed_logic(latest_msg, verdict_stats=None):
     is_closed = False
     reason = ""
     last_sender_id = latest_msg.sender_id
@@ -4271,19 +5658,22 @@ async def _check_is_closed_logic(latest_msg):
     if last_sender_id in ([MY_ID] + OTHER_CS_IDS): last_sender_is_cs = True
     else:
          try:
-             s = await latest_msg.get_sender()
+             s = await entity_cache.sender_of(latest_msg)
              if s and getattr(s, 'first_name', '').startswith(tuple(CS_NAME_PREFIXES)): last_sender_is_cs = True
          except: pass
     
     if not last_sender_is_cs:
         if not latest_msg.text or not latest_msg.text.strip(): is_closed = False; reason = "最后消息非文本实体"
         else:
-            need_reply, ai_reason = await asyncio.get_event_loop().run_in_executor(None, lambda: _ai_check_reply_needed(latest_msg.text))
+            ref = (getattr(latest_msg, "chat_id", None), latest_msg.id)
+            need_reply, ai_reason = await asyncio.get_event_loop().run_in_executor(
+                None, lambda: _ai_check_reply_needed(latest_msg.text, ref=ref, stats=verdict_stats)
+            )
             if not need_reply: is_closed = True; reason = f"系统识别已闭环：{ai_reason}"
             else: is_closed = False; reason = f"待处理：{ai_reason}"
     else:
         last_text = latest_msg.text or ""
-        is_wait = any(k in last_text for k in WAIT_SIGNATURES)
+        is_wait = match_signature(last_text, WAIT_SIGNATURES) is not None
         is_keep = last_text.strip() in KEEP_SIGNATURES
         if is_wait or is_keep:
             is_closed = False; reason = f"流程挂起中: 包含{'稍等' if is_wait else '跟进'}指令"
@@ -4295,7 +5685,34 @@ async def _check_is_closed_logic(latest_msg):
         else: is_closed = True
     return is_closed, reason
 
-async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
+class _OrderedScanOutput:
+    """多群并发检测的结果出口：第 k 个群的结果要等前面的群都结束后才放行，输出顺序与逐群串行时一致。"""
+
+    def __init__(self, result_queue, count):
+        self.result_queue = result_queue
+        self.buffers = [[] for _ in range(count)]
+        self.done = [False] * count
+        self.next = 0
+        self.finished = 0
+
+    def result(self, position, payload):
+        if position == self.next:
+            self.result_queue.put(payload)
+        else:
+            self.buffers[position].append(payload)
+
+    def finish(self, position):
+        self.done[position] = True
+        self.finished += 1
+        while self.next < len(self.done):
+            for payload in self.buffers[self.next]:
+                self.result_queue.put(payload)
+            self.buffers[self.next] = []
+            if not self.done[self.next]:
+                break
+            self.next += 1
+
+async def check_wait_keyword_logic(keyword, result_queue, date_text="", force=False):
     try:
         cutoff_hours = WAIT_CHECK_LOOKBACK_HOURS
         limit_count = 6000
@@ -4353,21 +5770,98 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
         
         found_count = 0
         closed_count = 0
+        verdict_stats = VerdictStats()
+        scan_items = [(idx, chat_id) for idx, chat_id in enumerate(CS_GROUP_IDS) if chat_id not in EXCLUDED_GROUPS]
+        output = _OrderedScanOutput(result_queue, len(scan_items))
+        fetch_semaphore = asyncio.Semaphore(WAIT_CHECK_GROUP_CONCURRENCY)
+
+        # 上次同样检测的断点：只拉新消息、只复核新消息和上次未闭环的候选；force 时全量重扫
+        checkpoint_key = (keyword, date_text)
+        previous_run = None if force else wait_check_checkpoints.load(checkpoint_key, scan_start_time)
+        current_run = RunCheckpoint(scan_start_time)
+        if previous_run:
+            result_queue.put(json.dumps({
+                "type": "progress",
+                "percent": 2,
+                "msg": f"沿用 {format_wait_seconds(time.time() - previous_run.created_at)} 前的检测断点：只拉取新消息，已闭环结果直接沿用，未闭环候选重新判定。"
+            }))
 
-        for idx, chat_id in enumerate(CS_GROUP_IDS):
-            if chat_id in EXCLUDED_GROUPS: continue
-            
-            percent = int((idx / total_groups) * 100)
-            result_queue.put(json.dumps({"type": "progress", "percent": percent, "msg": f"正在同步通信群组 {chat_id} ({idx+1}/{total_groups})..."}))
+        def progress_percent():
+            return int((output.finished / max(1, len(scan_items))) * 100)
+
+        async def stream_history(chat_id, previous=None, checkpoint=None):
+            """
+            后台任务逐页拉取、边拉边交给调用方；拉取并发受 fetch_semaphore 限制，异常在消费端重新抛出。
+            有 previous 断点时只向 Telegram 拉 last_id 之后的消息，更早的部分从断点缓存里接着给出；
+            交出的每条消息都记进 checkpoint，供下一次增量检测使用。
+            """
+            pipe = asyncio.Queue(maxsize=WAIT_CHECK_PIPELINE_DEPTH)
+
+            async def produce():
+                try:
+                    async with fetch_semaphore:
+                        fetched = 0
+                        min_id = previous.last_id if previous else 0
+                        async for m in client.iter_messages(chat_id, limit=limit_count, min_id=min_id):
+                            fetched += 1
+                            if m.date and m.date > analysis_end_time:
+                                continue
+                            if m.date and m.date < scan_start_time: break
+                            if getattr(m, 'action', None): continue # 过滤拉人、置顶等系统服务消息
+                            await pipe.put(m)
+                    # 新消息已占满 limit 时全量扫描同样拉不到更早的消息
+                    for m in (previous.messages[:limit_count - fetched] if previous and fetched < limit_count else ()):
+                        if m.date and m.date > analysis_end_time:
+                            continue
+                        if m.date and m.date < scan_start_time: break
+                        await pipe.put(m)
+                except Exception as e:
+                    await pipe.put(e)
+                    return
+                await pipe.put(None)
 
+            producer = asyncio.ensure_future(produce())
             try:
-                history = []
-                async for m in client.iter_messages(chat_id, limit=limit_count):
-                    if m.date and m.date > analysis_end_time:
-                        continue
-                    if m.date and m.date < scan_start_time: break
-                    if getattr(m, 'action', None): continue # 过滤拉人、置顶等系统服务消息
-                    history.append(m)
+                while True:
+                    item = await pipe.get()
+                    if item is None:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    if checkpoint is not None:
+                        checkpoint.messages.append(item)
+                        checkpoint.last_id = max(checkpoint.last_id or 0, item.id)
+                    yield item
+            finally:
+                producer.cancel()
+
+        async def scan_group(position, idx, chat_id):
+            nonlocal found_count, closed_count
+            result_queue.put(json.dumps({"type": "progress", "percent": progress_percent(), "msg": f"正在同步通信群组 {chat_id} ({idx+1}/{total_groups})..."}))
+
+            previous = wait_check_checkpoints.group(previous_run, chat_id)
+            checkpoint = GroupCheckpoint(previous.last_id if previous else None)
+
+            def emit_result(msg_id, is_closed, payload, basis=None):
+                checkpoint.results[msg_id] = (is_closed, payload, basis)
+                output.result(position, payload)
+
+            def reuse(msg_id, basis=None):
+                """上次依据相同且已定论的消息返回 True 跳过判定；其中已闭环的结果原样沿用。"""
+                nonlocal found_count, closed_count
+                if previous is None or not previous.settled(msg_id, basis):
+                    return False
+                payload = previous.carried(msg_id, basis)
+                if payload:
+                    found_count += 1
+                    closed_count += 1
+                    emit_result(msg_id, True, payload, basis)
+                return True
+
+            try:
+                if keyword == WAIT_CHECK_APPROVAL_MISSED_KEYWORD or is_all_wait_check_keyword(keyword):
+                    async with contextlib.aclosing(stream_history(chat_id, previous, checkpoint)) as stream:
+                        history = [m async for m in stream]
 
                 if keyword == WAIT_CHECK_APPROVAL_MISSED_KEYWORD:
                     message_by_id = {m.id: m for m in history if getattr(m, "id", None)}
@@ -4375,6 +5869,8 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                     for approval_msg in history:
                         if not is_wait_check_message_in_window(approval_msg, scan_start_time, scan_end_time):
                             continue
+                        if reuse(approval_msg.id):
+                            continue
                         if not is_wait_check_approval_message(approval_msg):
                             continue
                         approval_target_id = get_direct_reply_target_id(approval_msg)
@@ -4391,14 +5887,14 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
 
                         group_name = str(chat_id)
                         try:
-                            g = await client.get_entity(chat_id)
+                            g = await entity_cache.entity(client, chat_id)
                             group_name = g.title
                         except Exception:
                             pass
 
                         sender_name = "未知发送者"
                         try:
-                            sender = await approval_msg.get_sender()
+                            sender = await entity_cache.sender_of(approval_msg)
                             sender_name = getattr(sender, "first_name", "") or getattr(sender, "username", "") or sender_name
                         except Exception:
                             pass
@@ -4406,7 +5902,7 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                         beijing_time = approval_msg.date.astimezone(BEIJING_TZ).strftime('%Y-%m-%d %H:%M:%S')
                         real_chat_id = str(chat_id).replace('-100', '')
                         link = f"https://t.me/c/{real_chat_id}/{approval_msg.id}"
-                        result_queue.put(json.dumps({
+                        emit_result(approval_msg.id, is_closed, json.dumps({
                             "type": "result",
                             "is_closed": is_closed,
                             "reason": f"代码判定(已闭环): {followup_reason}" if is_closed else "领导已回复同意，但后续同一申请未找到非等待处理进展。",
@@ -4416,7 +5912,7 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                             "latest_text": "同一申请已有处理进展" if is_closed else "同一申请未见处理进展",
                             "link": link
                         }))
-                    continue
+                    return
                 
                 if is_all_wait_check_keyword(keyword):
                     msg_grouped_map = {}
@@ -4441,6 +5937,9 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                     for approval_msg in history:
                         if not is_wait_check_message_in_window(approval_msg, scan_start_time, scan_end_time):
                             continue
+                        # 沿用的闭环结果统一在下面的孤立消息循环里输出，这里只跳过
+                        if previous is not None and previous.settled(approval_msg.id):
+                            continue
                         if not is_wait_check_approval_message(approval_msg):
                             continue
                         if is_wait_check_cs_message(approval_msg):
@@ -4457,11 +5956,17 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                         if not has_wait_check_approval_followup(history, approval_msg, approval_target_id, message_by_id):
                             approval_missed_tasks.append((approval_msg, approval_target_msg))
 
-                    orphan_tasks = []
-                    reply_continuation_ai_cache = {}
+                    candidates = []
+                    continuation_checks = {}
                     for i, m in enumerate(history):
                         if not is_wait_check_message_in_window(m, scan_start_time, scan_end_time):
                             continue
+                        if previous is not None and previous.settled(m.id):
+                            # 沿用的闭环结果和本次新判定的结果一起按历史顺序输出，与全量扫描一致
+                            carried = previous.carried(m.id)
+                            if carried:
+                                candidates.append((i, m, None, None, carried))
+                            continue
                         if is_wait_check_cs_message(m): continue
 
                         if m.sticker or m.gif:
@@ -4469,6 +5974,9 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
 
                         if m.reply_to and m.reply_to.reply_to_msg_id: continue
 
+                        if m.id in replied_to_ids: continue
+                        if m.grouped_id and m.grouped_id in replied_grouped_ids: continue
+
                         code_exempt_reason = get_wait_check_preclosed_reason(m)
 
                         previous_customer_reply = None
@@ -4497,36 +6005,38 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                             if all(is_obvious_reply_continuation(text) for text in grouped_followups):
                                 continue
                             if not any(is_obvious_new_question(text) for text in grouped_followups):
-                                cache_key = (chat_id, previous_customer_reply.id, tuple(grouped_followups))
-                                if cache_key not in reply_continuation_ai_cache:
-                                    is_continuation, continuation_reason = await asyncio.get_event_loop().run_in_executor(
-                                        None,
-                                        lambda anchor=previous_customer_reply.text or "[媒体/图片]", texts=list(grouped_followups): _ai_check_reply_continuation(anchor, texts)
+                                continuation_key = (previous_customer_reply.id, tuple(grouped_followups))
+                                if continuation_key not in continuation_checks:
+                                    continuation_checks[continuation_key] = _ai_check_reply_continuation(
+                                        previous_customer_reply.text or "[媒体/图片]", list(grouped_followups),
+                                        ref=(chat_id, previous_customer_reply.id), stats=verdict_stats
                                     )
-                                    reply_continuation_ai_cache[cache_key] = (is_continuation, continuation_reason)
-                                else:
-                                    is_continuation, continuation_reason = reply_continuation_ai_cache[cache_key]
-                                if is_continuation:
-                                    log_tree(2, f"🧩 引用后补充豁免 Msg={m.id}: {continuation_reason}")
-                                    continue
-
-                        is_orphan = True
-                        if m.id in replied_to_ids: is_orphan = False
-                        elif m.grouped_id and m.grouped_id in replied_grouped_ids: is_orphan = False
-                            
-                        if is_orphan:
-                            orphan_tasks.append((i, m, code_exempt_reason))
+                                candidates.append((i, m, code_exempt_reason, continuation_key, None))
+                                continue
+
+                        candidates.append((i, m, code_exempt_reason, None, None))
+
+                    # 引用后补充判定互不依赖，一次性并发提交给 ai_classifier
+                    continuation_results = dict(zip(continuation_checks, await asyncio.gather(*continuation_checks.values())))
+                    orphan_tasks = []
+                    for i, m, code_exempt_reason, continuation_key, carried in candidates:
+                        if continuation_key is not None:
+                            is_continuation, continuation_reason = continuation_results[continuation_key]
+                            if is_continuation:
+                                log_tree(2, f"🧩 引用后补充豁免 Msg={m.id}: {continuation_reason}")
+                                continue
+                        orphan_tasks.append((i, m, code_exempt_reason, carried))
                     
                     # 核心修复 3: 如果发现孤立消息，提前发出一个进度提示，避免 AI 耗时导致界面长时间假死
                     potential_count = len(orphan_tasks) + len(approval_missed_tasks)
                     if potential_count:
-                        result_queue.put(json.dumps({"type": "progress", "percent": percent, "msg": f"群组 {chat_id} 发现 {potential_count} 条潜在漏回消息，正在进行规则豁免和 AI 研判..."}))
+                        result_queue.put(json.dumps({"type": "progress", "percent": progress_percent(), "msg": f"群组 {chat_id} 发现 {potential_count} 条潜在漏回消息，正在进行规则豁免和 AI 研判..."}))
 
                     for approval_msg, approval_target_msg in approval_missed_tasks:
                         found_count += 1
 
                         group_name = str(chat_id)
-                        try: g = await client.get_entity(chat_id); group_name = g.title
+                        try: g = await entity_cache.entity(client, chat_id); group_name = g.title
                         except: pass
 
                         target_text = (approval_target_msg.text or "[媒体/空]")[:60].replace('\n', ' ')
@@ -4534,7 +6044,7 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                         real_chat_id = str(chat_id).replace('-100', '')
                         link = f"https://t.me/c/{real_chat_id}/{approval_msg.id}"
 
-                        result_queue.put(json.dumps({
+                        emit_result(approval_msg.id, False, json.dumps({
                             "type": "result",
                             "is_closed": False,
                             "reason": "领导已回复同意，但后续同一申请未找到非等待处理进展。",
@@ -4545,11 +6055,7 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                             "link": link
                         }))
 
-                    for orphan_idx, (i, m, preclosed_reason) in enumerate(orphan_tasks):
-                        # 核心修复 4: 每完成 5 条 AI 判定推送一次进度
-                        if orphan_idx > 0 and orphan_idx % 5 == 0:
-                            result_queue.put(json.dumps({"type": "progress", "percent": percent, "msg": f"群组 {chat_id} AI 深度研判中 (进度: {orphan_idx}/{len(orphan_tasks)})..."}))
-
+                    async def judge_orphan(i, m, preclosed_reason):
                         start = max(0, i - 30) 
                         end = min(len(history), i + 15)
                         context_slice = history[start:end]
@@ -4609,8 +6115,6 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
 
                             beijing_time_str = cm.date.astimezone(timezone(timedelta(hours=8))).strftime('%H:%M:%S')
                             context_txts.append(f"[{beijing_time_str}] {c_label}{reply_tag}: {c_txt}{marker}")
-                        
-                        found_count += 1
 
                         distinct_unquoted_reason = get_wait_check_distinct_unquoted_reason(history, i, m)
                         case_resolution_reason = get_wait_check_case_resolution_reason(history, i, m, message_by_id)
@@ -4619,15 +6123,12 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                             display_reason = f"代码判定(需跟进): {distinct_unquoted_reason}"
                             latest_label = "无人引用回复"
                         elif case_resolution_reason:
-                            is_exempt, ai_reason = await asyncio.get_event_loop().run_in_executor(
-                                None,
-                                lambda: _ai_check_wait_check_context_resolution(
-                                    m.text or "[媒体/图片]", context_txts, target_label
-                                )
+                            is_exempt, ai_reason = await _ai_check_wait_check_context_resolution(
+                                m.text or "[媒体/图片]", context_txts, target_label,
+                                ref=(chat_id, m.id), stats=verdict_stats
                             )
                             if is_exempt:
                                 is_result_closed = True
-                                closed_count += 1
                                 display_reason = f"AI判定(豁免): {ai_reason}"
                             else:
                                 is_result_closed = False
@@ -4635,19 +6136,17 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                             latest_label = "无人引用回复"
                         elif preclosed_reason:
                             is_result_closed = True
-                            closed_count += 1
                             display_reason = f"代码判定(豁免): {preclosed_reason}，无需客服回复。"
                             latest_label = "无人引用回复"
                         else:
                             # 返回的变成了 is_exempt(是否豁免), 不再是倒错逻辑的 is_slip_up
-                            is_exempt, ai_reason = await asyncio.get_event_loop().run_in_executor(
-                                None, lambda: _ai_check_orphan_context(m.text or "[Media]", context_txts, target_label)
+                            is_exempt, ai_reason = await _ai_check_orphan_context(
+                                m.text or "[Media]", context_txts, target_label, ref=(chat_id, m.id), stats=verdict_stats
                             )
 
                             # 保留 AI 判定原因，方便人工复核误判来源。
                             if is_exempt:
                                 is_result_closed = True
-                                closed_count += 1
                                 display_reason = f"AI判定(豁免): {ai_reason}"
                             else:
                                 is_result_closed = False
@@ -4655,7 +6154,7 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                             latest_label = "无人引用回复"
                         
                         group_name = str(chat_id)
-                        try: g = await client.get_entity(chat_id); group_name = g.title
+                        try: g = await entity_cache.entity(client, chat_id); group_name = g.title
                         except: pass
 
                         safe_text = (m.text or "[媒体/空]")[:100].replace('\n', ' ')
@@ -4663,7 +6162,7 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                         real_chat_id = str(chat_id).replace('-100', '')
                         link = f"https://t.me/c/{real_chat_id}/{m.id}"
                         
-                        result_queue.put(json.dumps({
+                        return is_result_closed, json.dumps({
                             "type": "result",
                             "is_closed": is_result_closed,
                             "reason": display_reason,
@@ -4672,73 +6171,111 @@ async def check_wait_keyword_logic(keyword, result_queue, date_text=""):
                             "found_text": safe_text,
                             "latest_text": latest_label,
                             "link": link
-                        }))
-                            
-                    continue 
+                        })
 
-                thread_latest_msg = {}
-                for m in history:
-                    t_id = None
-                    if m.reply_to:
-                        t_id = m.reply_to.reply_to_top_id 
-                        if not t_id: t_id = m.reply_to.reply_to_msg_id
-                    if not t_id: t_id = m.id
-                    if t_id not in thread_latest_msg:
-                        thread_latest_msg[t_id] = m
+                    # 各条孤立消息同时研判（ai_classifier 负责限速和打包），结果仍按原顺序输出
+                    judgements = [
+                        None if carried else asyncio.ensure_future(judge_orphan(i, m, preclosed_reason))
+                        for i, m, preclosed_reason, carried in orphan_tasks
+                    ]
+                    try:
+                        for orphan_idx, ((_, m, _, carried), judgement) in enumerate(zip(orphan_tasks, judgements)):
+                            # 核心修复 4: 每完成 5 条 AI 判定推送一次进度
+                            if orphan_idx > 0 and orphan_idx % 5 == 0:
+                                result_queue.put(json.dumps({"type": "progress", "percent": progress_percent(), "msg": f"群组 {chat_id} AI 深度研判中 (进度: {orphan_idx}/{len(orphan_tasks)})..."}))
+                            is_result_closed, payload = (True, carried) if carried else await judgement
+                            found_count += 1
+                            if is_result_closed:
+                                closed_count += 1
+                            emit_result(m.id, is_result_closed, payload)
+                    finally:
+                        for judgement in judgements:
+                            if judgement is not None:
+                                judgement.cancel()
+                    return
 
-                for m in history:
-                    if not m.text: continue
-                    if keyword in m.text: 
-                        found_count += 1
+                # 单关键词模式边拉边判：消息从新到旧到达，同一消息流里更新的消息一定先到，
+                # 判定到 m 时 thread_latest_msg 里的值已与拉完整个窗口后相同
+                thread_latest_msg = {}
+                async with contextlib.aclosing(stream_history(chat_id, previous, checkpoint)) as stream:
+                    async for m in stream:
                         t_id = None
                         if m.reply_to:
-                            t_id = m.reply_to.reply_to_top_id or m.reply_to.reply_to_msg_id
+                            t_id = m.reply_to.reply_to_top_id 
+                            if not t_id: t_id = m.reply_to.reply_to_msg_id
                         if not t_id: t_id = m.id
+                        if t_id not in thread_latest_msg:
+                            thread_latest_msg[t_id] = m
+
+                        if not m.text: continue
+                        if keyword in m.text: 
+                            t_id = None
+                            if m.reply_to:
+                                t_id = m.reply_to.reply_to_top_id or m.reply_to.reply_to_msg_id
+                            if not t_id: t_id = m.id
                         
-                        latest_msg = thread_latest_msg.get(t_id, m)
-                        is_closed, reason = await _check_is_closed_logic(latest_msg)
-                        if is_closed: closed_count += 1
-
-                        group_name = str(chat_id)
-                        try: g = await client.get_entity(chat_id); group_name = g.title
-                        except: pass
+                            latest_msg = thread_latest_msg.get(t_id, m)
+                            # 闭环看的是消息流最新一条：断点之后流里有了新消息（如客户追问）就必须重新判定
+                            if reuse(m.id, latest_msg.id): continue
+                            found_count += 1
+                            is_closed, reason = await _check_is_closed_logic(latest_msg, verdict_stats)
+                            if is_closed: closed_count += 1
+
+                            group_name = str(chat_id)
+                            try: g = await entity_cache.entity(client, chat_id); group_name = g.title
+                            except: pass
                         
-                        safe_text = (m.text or "")[:100].replace('\n', ' ')
-                        beijing_time = m.date.astimezone(timezone(timedelta(hours=8))).strftime('%Y-%m-%d %H:%M:%S')
+                            safe_text = (m.text or "")[:100].replace('\n', ' ')
+                            beijing_time = m.date.astimezone(timezone(timedelta(hours=8))).strftime('%Y-%m-%d %H:%M:%S')
                         
-                        link = ""
-                        real_chat_id = str(chat_id).replace('-100', '')
-                        url_thread_id = None
-                        target_msg_for_link = latest_msg if not is_closed else m
+                            link = ""
+                            real_chat_id = str(chat_id).replace('-100', '')
+                            url_thread_id = None
+                            target_msg_for_link = latest_msg if not is_closed else m
                         
-                        if "(客户删消息)" not in reason:
-                            if target_msg_for_link.reply_to:
-                                url_thread_id = target_msg_for_link.reply_to.reply_to_top_id or target_msg_for_link.reply_to.reply_to_msg_id
+                            if "(客户删消息)" not in reason:
+                                if target_msg_for_link.reply_to:
+                                    url_thread_id = target_msg_for_link.reply_to.reply_to_top_id or target_msg_for_link.reply_to.reply_to_msg_id
                         
-                        if url_thread_id: link = f"https://t.me/c/{real_chat_id}/{target_msg_for_link.id}?thread={url_thread_id}"
-                        else: link = f"https://t.me/c/{real_chat_id}/{target_msg_for_link.id}"
+                            if url_thread_id: link = f"https://t.me/c/{real_chat_id}/{target_msg_for_link.id}?thread={url_thread_id}"
+                            else: link = f"https://t.me/c/{real_chat_id}/{target_msg_for_link.id}"
                         
-                        latest_content = (latest_msg.text or "[媒体]")[:60].replace('\n', ' ')
-
-                        result_queue.put(json.dumps({
-                            "type": "result",
-                            "is_closed": is_closed,
-                            "reason": reason,
-                            "time": beijing_time,
-                            "group_name": group_name,
-                            "found_text": safe_text,
-                            "latest_text": latest_content, 
-                            "link": link
-                        }))
+                            latest_content = (latest_msg.text or "[媒体]")[:60].replace('\n', ' ')
+
+                            emit_result(m.id, is_closed, json.dumps({
+                                "type": "result",
+                                "is_closed": is_closed,
+                                "reason": reason,
+                                "time": beijing_time,
+                                "group_name": group_name,
+                                "found_text": safe_text,
+                                "latest_text": latest_content, 
+                                "link": link
+                            }), latest_msg.id)
 
             except Exception as e:
+                checkpoint = None
                 logger.error(f"Group {chat_id} check failed: {e}")
-
+            finally:
+                # 扫描失败的群不留断点，下次全量
+                if checkpoint is not None:
+                    current_run.groups[chat_id] = checkpoint
+                output.finish(position)
+                result_queue.put(json.dumps({"type": "progress", "percent": progress_percent(), "msg": f"群组 {chat_id} 检测完成 ({output.finished}/{len(scan_items)})"}))
+
+        # 各群并发拉取、拉到即判；结果按 CS_GROUP_IDS 顺序放行，输出与逐群串行时一致
+        await asyncio.gather(*(scan_group(position, idx, chat_id) for position, (idx, chat_id) in enumerate(scan_items)))
+        wait_check_checkpoints.save(checkpoint_key, current_run)
+
+        ai_cache = verdict_stats.summary()
+        log_tree(4, f"漏回检测[{keyword}] AI 缓存: 命中 {ai_cache['hits']} / 调用 {ai_cache['misses']}")
         result_queue.put(json.dumps({
             "type": "done", 
             "total": found_count, 
             "closed": closed_count, 
-            "open": found_count - closed_count
+            "open": found_count - closed_count,
+            "ai_cache": ai_cache,
+            "incremental": previous_run is not None
         }))
         result_queue.put(None) 
 
@@ -5807,6 +7344,9 @@ def install_shutdown_signal_handlers(loop):
         telegram_runtime_lock.request_stop()
         await async_disconnect_all_telegram_clients()
         release_telegram_runtime_lock()
+        # os._exit 不走 atexit：先把写线程里排队的日志和倒计时、实体名称缓存落盘
+        await asyncio.get_event_loop().run_in_executor(None, chat_log_writer.flush, 3.0)
+        entity_cache.save()
         os._exit(0)
 
     def _handle_shutdown(signum, _frame):
@@ -6794,10 +8334,24 @@ async def send_alert(text, link, extra_log="", target_ids=None):
         tasks.append(loop.run_in_executor(None, lambda p=payload: _post_request(url, p)))
     if tasks: await asyncio.gather(*tasks)
 
+def _snapshot_marked_deleted(chat_id, msg_id):
+    try:
+        row = _lookup_message_snapshot(chat_id, msg_id, "is_deleted")
+        return bool(row and row[0])
+    except Exception:
+        return False
+
 async def check_msg_exists(channel_id, msg_id):
     try:
-        msg = await client.get_messages(channel_id, ids=msg_id)
-        if not msg: 
+        exists = local_history.exists(channel_id, msg_id)
+        # 快照查询要同步打开 SQLite 并逐个挂载月分区，放到线程池里，不占事件循环
+        if exists is None and await asyncio.get_event_loop().run_in_executor(
+            None, _snapshot_marked_deleted, channel_id, msg_id
+        ):
+            exists = False
+        if exists is None:
+            exists = bool(await message_batcher.get(channel_id, msg_id))
+        if not exists: 
             log_tree(2, f"❌ 检查发现消息 {msg_id} 已物理删除")
             return False 
         return True
@@ -6808,16 +8362,20 @@ async def check_msg_exists(channel_id, msg_id):
 # ==========================================
 # 模块 6: 任务管理与核心逻辑
 # ==========================================
-async def audit_pending_tasks():
+async def audit_pending_tasks(job=None):
+    # job 不为空时把每个关键词的巡检结果写进去，结束后可在 /api/jobs 回看
+    emit = job.put if job is not None else (lambda item: None)
     log_tree(4, "开始执行【下班巡检】(扫描全部稍等关键词)...")
     
     all_keywords = sorted(list(WAIT_SIGNATURES))
     all_keywords = sorted(list(set(all_keywords)), key=lambda x: (len(x), x), reverse=True) 
     if not all_keywords:
         log_tree(4, "下班巡检跳过：WAIT_KEYWORDS 为空")
+        emit(json.dumps({"type": "done", "total_issues": 0, "keywords": 0}))
         return
     
     history_cache = {}
+    verdict_stats = VerdictStats()
     cutoff_time = datetime.now(timezone.utc) - timedelta(hours=10) 
     
     EXCLUDED_GROUPS = [-1002807120955, -1002169616907]
@@ -6838,9 +8396,10 @@ async def audit_pending_tasks():
     total_issues = 0
     notified_targets = set()
 
-    for keyword in all_keywords:
+    for keyword_idx, keyword in enumerate(all_keywords):
         if not keyword.strip():
             continue
+        emit(json.dumps({"type": "progress", "percent": int(keyword_idx * 100 / len(all_keywords)), "msg": f"巡检关键词: {keyword}"}, ensure_ascii=False))
         keyword_targets = get_alert_targets_for_keyword(keyword)
         kw_issues = []
         found_count = 0
@@ -6864,7 +8423,7 @@ async def audit_pending_tasks():
                     is_cs_sender = False
                     if m.sender_id in ([MY_ID] + OTHER_CS_IDS): is_cs_sender = True
                     else:
-                        sender = await m.get_sender()
+                        sender = await entity_cache.sender_of(m)
                         name = getattr(sender, 'first_name', '') or ''
                         if name.startswith(tuple(CS_NAME_PREFIXES)): is_cs_sender = True
                     
@@ -6878,14 +8437,14 @@ async def audit_pending_tasks():
                     if not t_id: t_id = m.id
                     
                     latest_msg = thread_latest_msg.get(t_id, m)
-                    is_closed, reason = await _check_is_closed_logic(latest_msg)
+                    is_closed, reason = await _check_is_closed_logic(latest_msg, verdict_stats)
                     
                     if is_closed:
                         closed_count += 1
                     else:
                         cs_name_display = "未知客服"
                         try:
-                            s = await m.get_sender()
+                            s = await entity_cache.sender_of(m)
                             if s: cs_name_display = getattr(s, 'first_name', 'Unknown')
                         except: pass
 
@@ -6918,6 +8477,14 @@ async def audit_pending_tasks():
                             'link': link
                         })
 
+        emit(json.dumps({
+            "type": "keyword",
+            "keyword": keyword,
+            "total": found_count,
+            "closed": closed_count,
+            "open": found_count - closed_count,
+            "issues": kw_issues,
+        }, ensure_ascii=False))
         if kw_issues:
             total_issues += len(kw_issues)
             open_count = found_count - closed_count
@@ -6948,6 +8515,10 @@ async def audit_pending_tasks():
         else:
             log_tree(4, f"关键词 '{keyword}' 巡检完成，无异常 (总数: {found_count})")
 
+    ai_cache = verdict_stats.summary()
+    if ai_cache["hits"] or ai_cache["misses"]:
+        log_tree(4, f"下班巡检 AI 缓存: 命中 {ai_cache['hits']} / 调用 {ai_cache['misses']} (命中率 {ai_cache['hit_rate']:.0%})")
+    emit(json.dumps({"type": "done", "total_issues": total_issues, "keywords": len(all_keywords), "ai_cache": ai_cache}, ensure_ascii=False))
     if total_issues:
         log_tree(4, f"下班巡检结束：总计发现 {total_issues} 个未闭环问题，已推送到 {len(notified_targets)} 个接收人")
     else:
@@ -6968,14 +8539,16 @@ async def perform_stop_work():
             return
 
         IS_WORKING = False
-        await audit_pending_tasks()
+        audit_job, _ = job_manager.start(
+            "audit", "stop_work", lambda job: asyncio.ensure_future(audit_pending_tasks(job)), refresh=True
+        )
+        await audit_job.future
         for t in list(wait_tasks.values()) + list(followup_tasks.values()) + list(reply_tasks.values()) + list(self_reply_tasks.values()): t.cancel()
         wait_tasks.clear(); followup_tasks.clear(); reply_tasks.clear(); self_reply_tasks.clear()
         wait_task_keywords.clear()
         wait_timers.clear(); followup_timers.clear(); reply_timers.clear(); self_reply_timers.clear()
         wait_msg_map.clear(); followup_msg_map.clear()
-        chat_user_active_msgs.clear()
-        chat_thread_active_msgs.clear()
+        active_msgs.clear()
         msg_to_user_cache.clear()
         msg_content_cache.clear()
         group_to_user_cache.clear()
@@ -6995,27 +8568,12 @@ async def perform_start_work():
     log_tree(2, "🟢 已切换为：工作模式 (网页/指令)")
 
 def register_task(chat_id, user_id, msg_id, thread_id=None):
+    active_msgs.add(chat_id, msg_id, user_id, thread_id)
     if user_id:
-        u_key = (chat_id, user_id)
-        if u_key not in chat_user_active_msgs: chat_user_active_msgs[u_key] = set()
-        chat_user_active_msgs[u_key].add(msg_id)
         update_msg_cache(chat_id, msg_id, user_id)
-    if thread_id:
-        t_key = (chat_id, thread_id)
-        if t_key not in chat_thread_active_msgs: chat_thread_active_msgs[t_key] = set()
-        chat_thread_active_msgs[t_key].add(msg_id)
 
 def remove_task_record(chat_id, user_id, msg_id, thread_id=None):
-    if user_id:
-        u_key = (chat_id, user_id)
-        if u_key in chat_user_active_msgs:
-            chat_user_active_msgs[u_key].discard(msg_id)
-            if not chat_user_active_msgs[u_key]: del chat_user_active_msgs[u_key]
-    if thread_id:
-        t_key = (chat_id, thread_id)
-        if t_key in chat_thread_active_msgs:
-            chat_thread_active_msgs[t_key].discard(msg_id)
-            if not chat_thread_active_msgs[t_key]: del chat_thread_active_msgs[t_key]
+    active_msgs.discard(chat_id, msg_id, user_id, thread_id)
 
 def cancel_tasks(chat_id, user_id, thread_id=None, target_msg_id=None, reason="未知", types=None):
     if types is None: types = ['wait', 'followup', 'reply', 'self_reply'] 
@@ -7040,9 +8598,7 @@ def cancel_tasks(chat_id, user_id, thread_id=None, target_msg_id=None, reason="
             hit_specific = True
 
     if not hit_specific and thread_id:
-        t_key = (chat_id, thread_id)
-        if t_key in chat_thread_active_msgs:
-            targets.update(chat_thread_active_msgs[t_key])
+        targets.update(active_msgs.thread_msgs(chat_id, thread_id))
 
     if not targets: return
 
@@ -7077,9 +8633,12 @@ def cancel_disabled_wait_tasks(enabled_signatures):
     return cancelled
 
 def remove_map_entries_by_value(mapping, value):
-    for key, mapped_value in list(mapping.items()):
-        if mapped_value == value:
-            del mapping[key]
+    if isinstance(mapping, ReverseIndexedMap):
+        return mapping.remove_value(value)
+    keys = [key for key, mapped_value in mapping.items() if mapped_value == value]
+    for key in keys:
+        del mapping[key]
+    return len(keys)
 
 def check_recent_activity_safe(chat_id, task_start_time, user_ids=None, thread_id=None, buffer_seconds=10):
     if user_ids:
@@ -7094,217 +8653,499 @@ def check_recent_activity_safe(chat_id, task_start_time, user_ids=None, thread_i
     return False, None
 
 async def has_cs_reply_after(chat_id, target_msg_id, trigger_timestamp, thread_id=None, limit=80):
-    target_ids = get_related_album_msg_ids(chat_id, target_msg_id)
-    if not target_ids:
+    if not get_related_album_msg_ids(chat_id, target_msg_id):
         return False, None
 
     try:
-        async for m in client.iter_messages(chat_id, limit=limit):
-            if getattr(m, 'action', None):
-                continue
-            if m.date and m.date.timestamp() <= trigger_timestamp:
-                break
-            if not await is_official_cs(m):
-                continue
-
-            reply_ids = get_ordered_reply_target_ids(m)
-            if target_ids.intersection(reply_ids):
-                return True, f"客服 Msg={m.id} 已引用回复 Msg={target_msg_id}"
-
-            if thread_id and thread_id in reply_ids:
-                text = m.text or ""
-                if not match_signature(text, WAIT_SIGNATURES) and text.strip() not in KEEP_SIGNATURES:
-                    return True, f"客服 Msg={m.id} 已在同一消息流回复"
+        history = await recent_history(chat_id, limit, until_ts=trigger_timestamp)
+        return await _cs_reply_in_history(history, chat_id, target_msg_id, trigger_timestamp, thread_id)
     except Exception as e:
         log_tree(9, f"漏回二次校验失败 Msg={target_msg_id}: {e}")
     return False, None
 
+async def _cs_reply_in_history(history, chat_id, target_msg_id, trigger_timestamp, thread_id=None):
+    """在一段从新到旧的历史里找触发之后客服对目标消息（或同一消息流）的回复；同一群的多条目标可共用一次拉取。"""
+    target_ids = get_related_album_msg_ids(chat_id, target_msg_id)
+    if not target_ids:
+        return False, None
+    for m in history:
+        if getattr(m, 'action', None):
+            continue
+        if m.date and m.date.timestamp() <= trigger_timestamp:
+            break
+        if not await is_official_cs(m):
+            continue
+
+        reply_ids = get_ordered_reply_target_ids(m)
+        if target_ids.intersection(reply_ids):
+            return True, f"客服 Msg={m.id} 已引用回复 Msg={target_msg_id}"
+
+        if thread_id and thread_id in reply_ids:
+            text = m.text or ""
+            if not match_signature(text, WAIT_SIGNATURES) and text.strip() not in KEEP_SIGNATURES:
+                return True, f"客服 Msg={m.id} 已在同一消息流回复"
+    return False, None
+
 # ==========================================
 # 模块 7: 倒计时任务
 # ==========================================
-async def task_wait_timeout(key_id, agent_name, original_text, link, my_msg_id, chat_id, user_ids_list, trigger_timestamp, thread_id=None, wait_keyword=None):
+# 写队列满时倒计时的持久化不能静默丢掉：按 token 暂存、稍后按原顺序重试；同一 token 后来的删除覆盖此前未写入的操作
+PENDING_TIMER_RETRY_SECONDS = 2.0
+_pending_timer_backlog = {}  # token -> [write, ...]
+_pending_timer_retry_handle = None
+pending_timer_state = {"dropped": 0, "retried": 0}
+
+def _submit_pending_timer_write(token, write, replace=False):
+    queued = _pending_timer_backlog.get(token)
+    if queued is not None:
+        # 前面的操作还没写进去，后来的必须排在它后面
+        if replace:
+            queued[:] = [write]
+        else:
+            queued.append(write)
+        return
+    if not _submit_pending_timer_job(write):
+        _defer_pending_timer_write(token, write)
+
+def _submit_pending_timer_job(write):
     try:
-        current_task = asyncio.current_task() 
-        ids_str = f"Msg={key_id}"
-        if user_ids_list: ids_str += " " + " ".join([f"User={u}" for u in user_ids_list])
-        
-        log_tree(1, f"启动 [稍等] 倒计时 (12m) {ids_str} | Thread={thread_id}")
-        
-        end_time = trigger_timestamp + WAIT_TIMEOUT
-        wait_timers[key_id] = {'ts': end_time, 'user': agent_name, 'url': link, 'keyword': wait_keyword or ''}
-        for uid in user_ids_list: register_task(chat_id, uid, key_id, thread_id)
+        return chat_log_writer.submit(write)
+    except Exception as e:
+        logger.error(f"❌ 倒计时持久化提交失败: {e}")
+        return False
 
-        await asyncio.sleep(WAIT_TIMEOUT)
-        
-        if not IS_WORKING: return
-        if not is_wait_keyword_alert_enabled(wait_keyword):
-            log_tree(1, f"🛡️ 拦截 [稍等] 超时预警 Msg={key_id} | 关键词={wait_keyword} 已从网页预警名单取消")
-            return
-        if my_msg_id and not await check_msg_exists(chat_id, my_msg_id): return
+def _defer_pending_timer_write(token, write):
+    pending_timer_state["dropped"] += 1
+    logger.warning(f"⚠️ 写队列已满，倒计时持久化稍后重试 Token={token}")
+    _pending_timer_backlog[token] = [write]
+    _schedule_pending_timer_retry()
+
+def _schedule_pending_timer_retry():
+    global _pending_timer_retry_handle
+    if _pending_timer_retry_handle is None:
+        _pending_timer_retry_handle = asyncio.get_event_loop().call_later(PENDING_TIMER_RETRY_SECONDS, _retry_pending_timer_writes)
+
+def _retry_pending_timer_writes():
+    global _pending_timer_retry_handle
+    _pending_timer_retry_handle = None
+    for token, writes in list(_pending_timer_backlog.items()):
+        def write(conn, writes=tuple(writes)):
+            for job in writes:
+                job(conn)
+
+        if not _submit_pending_timer_job(write):
+            break
+        del _pending_timer_backlog[token]
+        pending_timer_state["retried"] += 1
+    if _pending_timer_backlog:
+        _schedule_pending_timer_retry()
+
+def pending_timer_stats():
+    data = dict(pending_timer_state)
+    data["backlog"] = len(_pending_timer_backlog)
+    return data
 
-        is_safe, safe_reason = check_recent_activity_safe(chat_id, trigger_timestamp, user_ids_list, thread_id)
-        if is_safe:
-            log_tree(2, f"🛡️ 拦截误报 [稍等] {ids_str} | 原因: {safe_reason} (客服已处理)")
-            return
+def _save_pending_timer(kind, key_id, chat_id, delay, payload, token=None, stage=""):
+    token = token or secrets.token_hex(8)
+    now = time.time()
+    row = (token, kind, key_id, chat_id, now + delay, stage, json.dumps(payload, ensure_ascii=False), now)
 
-        log_tree(2, f"触发 [稍等] 超时 Msg={key_id}")
-        await send_alert(format_alert_message(
-            "🚨 **稍等超时预警**",
-            [
-                ("客服", agent_name),
-                ("关键词", wait_keyword),
-                ("状态", f"已过 {WAIT_TIMEOUT // 60} 分钟，无后续客服回复"),
-            ],
-            "消息", original_text,
-            link
-        ), link, ids_str, target_ids=get_alert_targets_for_keyword(wait_keyword))
-
-        CRITICAL_TIMEOUT = 10 * 60
-        await asyncio.sleep(CRITICAL_TIMEOUT)
-        
-        if not IS_WORKING: return
-        if not is_wait_keyword_alert_enabled(wait_keyword):
-            log_tree(1, f"🛡️ 拦截 [稍等] 严重超时 Msg={key_id} | 关键词={wait_keyword} 已从网页预警名单取消")
-            return
-        if my_msg_id and not await check_msg_exists(chat_id, my_msg_id): return
-
-        is_safe_2, safe_reason_2 = check_recent_activity_safe(chat_id, trigger_timestamp, user_ids_list, thread_id)
-        if is_safe_2:
-             log_tree(2, f"🛡️ 拦截严重误报 [稍等] {ids_str} | 原因: {safe_reason_2}")
-             return
-
-        log_tree(3, f"🔥 触发 [稍等] 严重超时 Msg={key_id}")
-        await send_alert(format_alert_message(
-            f"🔥 **稍等严重超时（{int((WAIT_TIMEOUT+CRITICAL_TIMEOUT)/60)}分钟）**",
-            [
-                ("客服", agent_name),
-                ("关键词", wait_keyword),
-                ("状态", "第一次预警后 10 分钟仍无后续客服回复"),
-            ],
-            "原消息", original_text,
-            link
-        ), link, ids_str, target_ids=get_alert_targets_for_keyword(wait_keyword))
-
-    except asyncio.CancelledError: pass 
-    finally:
-        if key_id in wait_tasks and wait_tasks[key_id] == current_task:
+    def write(conn):
+        conn.execute(
+            """INSERT OR REPLACE INTO pending_timers(token, kind, key_id, chat_id, deadline, stage, payload, updated_at)
+               VALUES(?, ?, ?, ?, ?, ?, ?, ?)""",
+            row
+        )
+
+    _submit_pending_timer_write(token, write)
+    return token
+
+def _advance_pending_timer(token, delay, stage):
+    now = time.time()
+
+    def write(conn):
+        conn.execute("UPDATE pending_timers SET deadline=?, stage=?, updated_at=? WHERE token=?", (now + delay, stage, now, token))
+
+    _submit_pending_timer_write(token, write)
+
+def _pending_timer_delete(token):
+    return lambda conn: conn.execute("DELETE FROM pending_timers WHERE token=?", (token,))
+
+def _drop_pending_timer(*tokens):
+    fresh = []
+    for token in tokens:
+        if token in _pending_timer_backlog:
+            _submit_pending_timer_write(token, _pending_timer_delete(token), replace=True)
+        else:
+            fresh.append(token)
+    if not fresh:
+        return
+
+    def write(conn):
+        conn.executemany("DELETE FROM pending_timers WHERE token=?", [(token,) for token in fresh])
+
+    if not _submit_pending_timer_job(write):
+        for token in fresh:
+            _defer_pending_timer_write(token, _pending_timer_delete(token))
+
+def schedule_wait_timeout(key_id, agent_name, original_text, link, my_msg_id, chat_id, user_ids_list, trigger_timestamp, thread_id=None, wait_keyword=None, delay=None, token=None, critical=False, msg_verified=False):
+    ids_str = f"Msg={key_id}"
+    if user_ids_list: ids_str += " " + " ".join([f"User={u}" for u in user_ids_list])
+
+    log_tree(1, f"启动 [稍等] 倒计时 (12m) {ids_str} | Thread={thread_id}")
+
+    end_time = trigger_timestamp + WAIT_TIMEOUT
+    wait_timers[key_id] = {'ts': end_time, 'user': agent_name, 'url': link, 'keyword': wait_keyword or ''}
+    for uid in user_ids_list: register_task(chat_id, uid, key_id, thread_id)
+
+    delay = WAIT_TIMEOUT if delay is None else delay
+    token = _save_pending_timer("wait", key_id, chat_id, delay, {
+        "agent_name": agent_name, "original_text": original_text, "link": link, "my_msg_id": my_msg_id,
+        "user_ids_list": list(user_ids_list), "trigger_timestamp": trigger_timestamp, "thread_id": thread_id, "wait_keyword": wait_keyword,
+    }, token=token, stage="critical" if critical else "")
+    handle = alert_timers.call_later(
+        "wait", delay, _wait_timeout_critical if critical else _wait_timeout_fired,
+        key_id, agent_name, original_text, link, None if msg_verified else my_msg_id, chat_id, user_ids_list, trigger_timestamp, thread_id, wait_keyword, ids_str, token
+    )
+
+    def cleanup(done_handle):
+        _drop_pending_timer(token)
+        if key_id in wait_tasks and wait_tasks[key_id] is done_handle:
             del wait_tasks[key_id]
             if key_id in wait_timers: del wait_timers[key_id]
             if key_id in wait_task_keywords: del wait_task_keywords[key_id]
             if my_msg_id in wait_msg_map: del wait_msg_map[my_msg_id]
             for uid in user_ids_list: remove_task_record(chat_id, uid, key_id, thread_id)
 
-async def task_followup_timeout(key_id, agent_name, original_text, link, my_msg_id, chat_id, user_ids_list, trigger_timestamp, thread_id=None, wait_keyword=None):
-    try:
-        current_task = asyncio.current_task()
-        ids_str = f"Msg={key_id}"
-        if user_ids_list: ids_str += " " + " ".join([f"User={u}" for u in user_ids_list])
-
-        log_tree(1, f"启动 [跟进] 倒计时 (15m) {ids_str} | Thread={thread_id}")
-        end_time = trigger_timestamp + FOLLOWUP_TIMEOUT
-        followup_timers[key_id] = {'ts': end_time, 'user': agent_name, 'url': link}
-        for uid in user_ids_list: register_task(chat_id, uid, key_id, thread_id)
-
-        await asyncio.sleep(FOLLOWUP_TIMEOUT)
-        if not IS_WORKING: return
-        if my_msg_id and not await check_msg_exists(chat_id, my_msg_id): return
-
-        # 跟进只检查 thread 级别活动，不检查 user 级别：
-        # 同一用户可能同时有多个不相关投诉，对其他 thread 的回复不能消除当前 thread 的跟进警告
-        is_safe, safe_reason = check_recent_activity_safe(chat_id, trigger_timestamp, thread_id=thread_id)
-        if is_safe:
-            log_tree(2, f"🛡️ 拦截误报 [跟进] {ids_str} | 原因: {safe_reason}")
-            return
+    handle.add_done_callback(cleanup)
+    return handle
 
-        log_tree(2, f"触发 [跟进] 超时 Msg={key_id}")
-        await send_alert(format_alert_message(
-            "🚨 **跟进超时预警**",
-            [
-                ("客服", agent_name),
-                ("关键词", wait_keyword),
-                ("状态", f"反馈核实内容 {FOLLOWUP_TIMEOUT // 60} 分钟未跟进回复"),
-            ],
-            "消息", original_text,
-            link
-        ), link, ids_str, target_ids=get_alert_targets_for_keyword(wait_keyword))
-    except asyncio.CancelledError: pass
-    finally:
-        if key_id in followup_tasks and followup_tasks[key_id] == current_task:
+WAIT_CRITICAL_TIMEOUT = 10 * 60
+
+async def _wait_timeout_fired(handle, key_id, agent_name, original_text, link, my_msg_id, chat_id, user_ids_list, trigger_timestamp, thread_id, wait_keyword, ids_str, token):
+    if not IS_WORKING: return
+    if not is_wait_keyword_alert_enabled(wait_keyword):
+        log_tree(1, f"🛡️ 拦截 [稍等] 超时预警 Msg={key_id} | 关键词={wait_keyword} 已从网页预警名单取消")
+        return
+    if my_msg_id and not await check_msg_exists(chat_id, my_msg_id): return
+
+    is_safe, safe_reason = check_recent_activity_safe(chat_id, trigger_timestamp, user_ids_list, thread_id)
+    if is_safe:
+        log_tree(2, f"🛡️ 拦截误报 [稍等] {ids_str} | 原因: {safe_reason} (客服已处理)")
+        return
+
+    log_tree(2, f"触发 [稍等] 超时 Msg={key_id}")
+    await send_alert(format_alert_message(
+        "🚨 **稍等超时预警**",
+        [
+            ("客服", agent_name),
+            ("关键词", wait_keyword),
+            ("状态", f"已过 {WAIT_TIMEOUT // 60} 分钟，无后续客服回复"),
+        ],
+        "消息", original_text,
+        link
+    ), link, ids_str, target_ids=get_alert_targets_for_keyword(wait_keyword))
+
+    # 同一个句柄再排一次严重超时，wait_tasks 里的引用与撤销逻辑保持不变
+    handle.rearm(WAIT_CRITICAL_TIMEOUT, _wait_timeout_critical)
+    _advance_pending_timer(token, WAIT_CRITICAL_TIMEOUT, "critical")
+
+async def _wait_timeout_critical(handle, key_id, agent_name, original_text, link, my_msg_id, chat_id, user_ids_list, trigger_timestamp, thread_id, wait_keyword, ids_str, token):
+    if not IS_WORKING: return
+    if not is_wait_keyword_alert_enabled(wait_keyword):
+        log_tree(1, f"🛡️ 拦截 [稍等] 严重超时 Msg={key_id} | 关键词={wait_keyword} 已从网页预警名单取消")
+        return
+    if my_msg_id and not await check_msg_exists(chat_id, my_msg_id): return
+
+    is_safe_2, safe_reason_2 = check_recent_activity_safe(chat_id, trigger_timestamp, user_ids_list, thread_id)
+    if is_safe_2:
+         log_tree(2, f"🛡️ 拦截严重误报 [稍等] {ids_str} | 原因: {safe_reason_2}")
+         return
+
+    log_tree(3, f"🔥 触发 [稍等] 严重超时 Msg={key_id}")
+    await send_alert(format_alert_message(
+        f"🔥 **稍等严重超时（{int((WAIT_TIMEOUT+WAIT_CRITICAL_TIMEOUT)/60)}分钟）**",
+        [
+            ("客服", agent_name),
+            ("关键词", wait_keyword),
+            ("状态", "第一次预警后 10 分钟仍无后续客服回复"),
+        ],
+        "原消息", original_text,
+        link
+    ), link, ids_str, target_ids=get_alert_targets_for_keyword(wait_keyword))
+
+def schedule_followup_timeout(key_id, agent_name, original_text, link, my_msg_id, chat_id, user_ids_list, trigger_timestamp, thread_id=None, wait_keyword=None, delay=None, token=None, msg_verified=False):
+    ids_str = f"Msg={key_id}"
+    if user_ids_list: ids_str += " " + " ".join([f"User={u}" for u in user_ids_list])
+
+    log_tree(1, f"启动 [跟进] 倒计时 (15m) {ids_str} | Thread={thread_id}")
+    end_time = trigger_timestamp + FOLLOWUP_TIMEOUT
+    followup_timers[key_id] = {'ts': end_time, 'user': agent_name, 'url': link}
+    for uid in user_ids_list: register_task(chat_id, uid, key_id, thread_id)
+
+    delay = FOLLOWUP_TIMEOUT if delay is None else delay
+    token = _save_pending_timer("followup", key_id, chat_id, delay, {
+        "agent_name": agent_name, "original_text": original_text, "link": link, "my_msg_id": my_msg_id,
+        "user_ids_list": list(user_ids_list), "trigger_timestamp": trigger_timestamp, "thread_id": thread_id, "wait_keyword": wait_keyword,
+    }, token=token)
+    handle = alert_timers.call_later(
+        "followup", delay, _followup_timeout_fired,
+        key_id, agent_name, original_text, link, None if msg_verified else my_msg_id, chat_id, trigger_timestamp, thread_id, wait_keyword, ids_str
+    )
+
+    def cleanup(done_handle):
+        _drop_pending_timer(token)
+        if key_id in followup_tasks and followup_tasks[key_id] is done_handle:
             del followup_tasks[key_id]
             if key_id in followup_timers: del followup_timers[key_id]
             if my_msg_id in followup_msg_map: del followup_msg_map[my_msg_id]
             for uid in user_ids_list: remove_task_record(chat_id, uid, key_id, thread_id)
 
-async def task_reply_timeout(trigger_msg_id, sender_name, content, link, chat_id, user_id, target_name, trigger_timestamp, thread_id=None, wait_keyword=None):
-    try:
-        current_task = asyncio.current_task()
-        ids_str = f"Msg={trigger_msg_id} User={user_id}"
-        log_tree(1, f"启动 [漏回] 监控 (5m) {ids_str} | Target={target_name} | Thread={thread_id}")
-        
-        end_time = trigger_timestamp + REPLY_TIMEOUT
-        reply_timers[trigger_msg_id] = {'ts': end_time, 'user': sender_name, 'url': link, 'target': target_name}
-        register_task(chat_id, user_id, trigger_msg_id, thread_id)
-        
-        await asyncio.sleep(REPLY_TIMEOUT)
-        if not IS_WORKING: return
-        if not is_configured_cs_group(chat_id):
-            log_tree(1, f"🛡️ 拦截 [漏回] 非CS_GROUP_IDS群组 Msg={trigger_msg_id} | Chat={chat_id}")
-            return
+    handle.add_done_callback(cleanup)
+    return handle
+
+async def _followup_timeout_fired(handle, key_id, agent_name, original_text, link, my_msg_id, chat_id, trigger_timestamp, thread_id, wait_keyword, ids_str):
+    if not IS_WORKING: return
+    if my_msg_id and not await check_msg_exists(chat_id, my_msg_id): return
+
+    # 跟进只检查 thread 级别活动，不检查 user 级别：
+    # 同一用户可能同时有多个不相关投诉，对其他 thread 的回复不能消除当前 thread 的跟进警告
+    is_safe, safe_reason = check_recent_activity_safe(chat_id, trigger_timestamp, thread_id=thread_id)
+    if is_safe:
+        log_tree(2, f"🛡️ 拦截误报 [跟进] {ids_str} | 原因: {safe_reason}")
+        return
+
+    log_tree(2, f"触发 [跟进] 超时 Msg={key_id}")
+    await send_alert(format_alert_message(
+        "🚨 **跟进超时预警**",
+        [
+            ("客服", agent_name),
+            ("关键词", wait_keyword),
+            ("状态", f"反馈核实内容 {FOLLOWUP_TIMEOUT // 60} 分钟未跟进回复"),
+        ],
+        "消息", original_text,
+        link
+    ), link, ids_str, target_ids=get_alert_targets_for_keyword(wait_keyword))
+
+def schedule_reply_timeout(trigger_msg_id, sender_name, content, link, chat_id, user_id, target_name, trigger_timestamp, thread_id=None, wait_keyword=None, delay=None, token=None, reply_verified=False):
+    ids_str = f"Msg={trigger_msg_id} User={user_id}"
+    log_tree(1, f"启动 [漏回] 监控 (5m) {ids_str} | Target={target_name} | Thread={thread_id}")
+
+    end_time = trigger_timestamp + REPLY_TIMEOUT
+    reply_timers[trigger_msg_id] = {'ts': end_time, 'user': sender_name, 'url': link, 'target': target_name}
+    register_task(chat_id, user_id, trigger_msg_id, thread_id)
+
+    delay = REPLY_TIMEOUT if delay is None else delay
+    token = _save_pending_timer("reply", trigger_msg_id, chat_id, delay, {
+        "sender_name": sender_name, "content": content, "link": link, "user_id": user_id, "target_name": target_name,
+        "trigger_timestamp": trigger_timestamp, "thread_id": thread_id, "wait_keyword": wait_keyword,
+    }, token=token)
+    handle = alert_timers.call_later(
+        "reply", delay, _reply_timeout_fired,
+        trigger_msg_id, sender_name, content, link, chat_id, target_name, trigger_timestamp, thread_id, wait_keyword, ids_str, reply_verified
+    )
+
+    def cleanup(done_handle):
+        _drop_pending_timer(token)
+        if trigger_msg_id in reply_tasks and reply_tasks[trigger_msg_id] is done_handle:
+            del reply_tasks[trigger_msg_id]
+            if trigger_msg_id in reply_timers: del reply_timers[trigger_msg_id]
+            remove_task_record(chat_id, user_id, trigger_msg_id, thread_id)
+
+    handle.add_done_callback(cleanup)
+    return handle
 
+async def _reply_timeout_fired(handle, trigger_msg_id, sender_name, content, link, chat_id, target_name, trigger_timestamp, thread_id, wait_keyword, ids_str, reply_verified=False):
+    if not IS_WORKING: return
+    if not is_configured_cs_group(chat_id):
+        log_tree(1, f"🛡️ 拦截 [漏回] 非CS_GROUP_IDS群组 Msg={trigger_msg_id} | Chat={chat_id}")
+        return
+
+    # 启动恢复时已批量确认过没有客服回复的，不再逐条扫历史
+    if not reply_verified:
         replied, replied_reason = await has_cs_reply_after(chat_id, trigger_msg_id, trigger_timestamp, thread_id)
         if replied:
             log_tree(2, f"🛡️ 拦截误报 [漏回] Msg={trigger_msg_id} | 原因: {replied_reason}")
             return
-        
-        log_tree(2, f"触发 [漏回] 报警 Msg={trigger_msg_id}")
-        await send_alert(format_alert_message(
-            "🔔 **漏回消息提醒**",
-            [
-                ("用户", sender_name),
-                ("回复客服", target_name),
-                ("关键词", wait_keyword),
-                ("状态", f"已 {REPLY_TIMEOUT // 60} 分钟未回复"),
-            ],
-            "内容", content,
-            link
-        ), link, ids_str, target_ids=get_alert_targets_for_keyword(wait_keyword))
-    except asyncio.CancelledError: pass 
-    finally:
-        if trigger_msg_id in reply_tasks and reply_tasks[trigger_msg_id] == current_task:
-            del reply_tasks[trigger_msg_id]
-            if trigger_msg_id in reply_timers: del reply_timers[trigger_msg_id]
-            remove_task_record(chat_id, user_id, trigger_msg_id, thread_id)
 
-async def task_self_reply_timeout(trigger_msg_id, user_name, content, link, chat_id, user_id, trigger_timestamp, thread_id=None, wait_keyword=None):
-    try:
-        current_task = asyncio.current_task()
-        ids_str = f"Msg={trigger_msg_id} User={user_id}"
-        log_tree(1, f"启动 [自回] 监控 (3m) {ids_str} | Thread={thread_id}")
-        
-        end_time = trigger_timestamp + SELF_REPLY_TIMEOUT
-        self_reply_timers[trigger_msg_id] = {'ts': end_time, 'user': user_name, 'url': link}
-        
-        await asyncio.sleep(SELF_REPLY_TIMEOUT)
-        if not IS_WORKING: return
-        
-        log_tree(2, f"触发 [自回] 报警 Msg={trigger_msg_id}")
-        await send_alert(format_alert_message(
-            "🔔 **自回防漏监测**",
-            [
-                ("用户", user_name),
-                ("关键词", wait_keyword),
-                ("状态", f"自行追加消息后 {SELF_REPLY_TIMEOUT // 60} 分钟未处理"),
-            ],
-            "内容", content,
-            link
-        ), link, ids_str, target_ids=get_alert_targets_for_keyword(wait_keyword))
-    except asyncio.CancelledError: pass 
-    finally:
-        if trigger_msg_id in self_reply_tasks and self_reply_tasks[trigger_msg_id] == current_task:
+    log_tree(2, f"触发 [漏回] 报警 Msg={trigger_msg_id}")
+    await send_alert(format_alert_message(
+        "🔔 **漏回消息提醒**",
+        [
+            ("用户", sender_name),
+            ("回复客服", target_name),
+            ("关键词", wait_keyword),
+            ("状态", f"已 {REPLY_TIMEOUT // 60} 分钟未回复"),
+        ],
+        "内容", content,
+        link
+    ), link, ids_str, target_ids=get_alert_targets_for_keyword(wait_keyword))
+
+def schedule_self_reply_timeout(trigger_msg_id, user_name, content, link, chat_id, user_id, trigger_timestamp, thread_id=None, wait_keyword=None, delay=None, token=None):
+    ids_str = f"Msg={trigger_msg_id} User={user_id}"
+    log_tree(1, f"启动 [自回] 监控 (3m) {ids_str} | Thread={thread_id}")
+
+    end_time = trigger_timestamp + SELF_REPLY_TIMEOUT
+    self_reply_timers[trigger_msg_id] = {'ts': end_time, 'user': user_name, 'url': link}
+
+    delay = SELF_REPLY_TIMEOUT if delay is None else delay
+    token = _save_pending_timer("self_reply", trigger_msg_id, chat_id, delay, {
+        "user_name": user_name, "content": content, "link": link, "user_id": user_id,
+        "trigger_timestamp": trigger_timestamp, "thread_id": thread_id, "wait_keyword": wait_keyword,
+    }, token=token)
+    handle = alert_timers.call_later(
+        "self_reply", delay, _self_reply_timeout_fired,
+        trigger_msg_id, user_name, content, link, wait_keyword, ids_str
+    )
+
+    def cleanup(done_handle):
+        _drop_pending_timer(token)
+        if trigger_msg_id in self_reply_tasks and self_reply_tasks[trigger_msg_id] is done_handle:
              del self_reply_tasks[trigger_msg_id]
              if trigger_msg_id in self_reply_timers: del self_reply_timers[trigger_msg_id]
              remove_task_record(chat_id, user_id, trigger_msg_id, thread_id)
 
+    handle.add_done_callback(cleanup)
+    return handle
+
+async def _self_reply_timeout_fired(handle, trigger_msg_id, user_name, content, link, wait_keyword, ids_str):
+    if not IS_WORKING: return
+
+    log_tree(2, f"触发 [自回] 报警 Msg={trigger_msg_id}")
+    await send_alert(format_alert_message(
+        "🔔 **自回防漏监测**",
+        [
+            ("用户", user_name),
+            ("关键词", wait_keyword),
+            ("状态", f"自行追加消息后 {SELF_REPLY_TIMEOUT // 60} 分钟未处理"),
+        ],
+        "内容", content,
+        link
+    ), link, ids_str, target_ids=get_alert_targets_for_keyword(wait_keyword))
+
+def _load_pending_timers():
+    try:
+        with sqlite3.connect(CHAT_LOG_DB) as conn:
+            return conn.execute(
+                "SELECT token, kind, key_id, chat_id, deadline, stage, payload FROM pending_timers ORDER BY deadline"
+            ).fetchall()
+    except sqlite3.Error:
+        return []
+
+async def _existing_msg_ids(chat_id, msg_ids):
+    """按群批量确认消息是否还在；网络失败时与 check_msg_exists 一样按存在处理（防漏报）。"""
+    present = set()
+    ids = sorted(msg_ids)
+    for i in range(0, len(ids), 100):
+        chunk = ids[i:i + 100]
+        try:
+            msgs = await client.get_messages(chat_id, ids=chunk)
+            present.update(m.id for m in msgs if m)
+        except Exception as e:
+            log_tree(2, f"⚠️ 倒计时恢复批量校验失败 Chat={chat_id} ({e}) -> 强制防漏报")
+            present.update(chunk)
+    return present
+
+async def _replied_reply_timers(chat_id, items, limit=80):
+    """items 为同一群已到期的 (触发消息 id, payload)；返回已被客服回复的触发消息 id。拉取失败时返回 None，交给到期回调逐条校验。"""
+    try:
+        until_ts = min(data.get("trigger_timestamp") or 0 for _, data in items)
+        history = await recent_history(chat_id, limit, until_ts=until_ts)
+        replied = set()
+        for key_id, data in items:
+            hit, reason = await _cs_reply_in_history(
+                history, chat_id, key_id, data.get("trigger_timestamp") or 0, data.get("thread_id")
+            )
+            if hit:
+                log_tree(2, f"🛡️ 拦截误报 [漏回] Msg={key_id} | 原因: {reason}")
+                replied.add(key_id)
+        return replied
+    except Exception as e:
+        log_tree(2, f"⚠️ 倒计时恢复漏回批量校验失败 Chat={chat_id} ({e})")
+        return None
+
+async def restore_pending_timers():
+    """启动时把上次进程留下的倒计时重新挂回；已到期的一次性批量校验后立即处理，不再依赖下班巡检重扫历史。"""
+    rows = _load_pending_timers()
+    if not rows:
+        return
+
+    tasks_by_kind = {"wait": wait_tasks, "followup": followup_tasks, "reply": reply_tasks, "self_reply": self_reply_tasks}
+    now = time.time()
+    pending = []
+    discard = []
+    for token, kind, key_id, chat_id, deadline, stage, payload in rows:
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            discard.append(token)
+            continue
+        if kind not in tasks_by_kind or (PENDING_TIMER_MAX_AGE_SECONDS > 0 and deadline < now - PENDING_TIMER_MAX_AGE_SECONDS):
+            discard.append(token)
+            continue
+        pending.append((token, kind, key_id, chat_id, deadline, stage, data))
+
+    checks = {}
+    reply_checks = {}
+    for token, kind, key_id, chat_id, deadline, stage, data in pending:
+        if deadline <= now and kind in ("wait", "followup") and data.get("my_msg_id"):
+            checks.setdefault(chat_id, set()).add(data["my_msg_id"])
+        elif deadline <= now and kind == "reply" and IS_WORKING and is_configured_cs_group(chat_id):
+            reply_checks.setdefault(chat_id, []).append((key_id, data))
+    present = {}
+    for chat_id, msg_ids in checks.items():
+        present[chat_id] = await _existing_msg_ids(chat_id, msg_ids)
+    # 已到期的漏回监控：每个群只拉一次最近历史，逐条判断触发后客服是否已回复
+    replied = {}
+    for chat_id, items in reply_checks.items():
+        result = await _replied_reply_timers(chat_id, items)
+        if result is not None:
+            replied[chat_id] = result
+
+    restored = expired = 0
+    now = time.time()
+    for token, kind, key_id, chat_id, deadline, stage, data in pending:
+        # 启动后新消息已经重新挂上同一任务的，以新的为准
+        if key_id in tasks_by_kind[kind]:
+            discard.append(token)
+            continue
+        delay = max(0.0, deadline - now)
+        my_msg_id = data.get("my_msg_id")
+        msg_verified = False
+        reply_verified = False
+        if delay == 0:
+            if kind in ("wait", "followup") and my_msg_id:
+                if my_msg_id not in present.get(chat_id, ()):
+                    discard.append(token)
+                    continue
+                msg_verified = True
+            elif kind == "reply" and chat_id in replied:
+                if key_id in replied[chat_id]:
+                    discard.append(token)
+                    continue
+                reply_verified = True
+            expired += 1
+
+        if kind == "wait":
+            wait_tasks[key_id] = schedule_wait_timeout(
+                key_id, chat_id=chat_id, delay=delay, token=token, critical=stage == "critical", msg_verified=msg_verified, **data
+            )
+            wait_task_keywords[key_id] = data.get("wait_keyword")
+            if my_msg_id: wait_msg_map[my_msg_id] = key_id
+        elif kind == "followup":
+            followup_tasks[key_id] = schedule_followup_timeout(key_id, chat_id=chat_id, delay=delay, token=token, msg_verified=msg_verified, **data)
+            if my_msg_id: followup_msg_map[my_msg_id] = key_id
+        elif kind == "reply":
+            reply_tasks[key_id] = schedule_reply_timeout(key_id, chat_id=chat_id, delay=delay, token=token, reply_verified=reply_verified, **data)
+        else:
+            register_task(chat_id, data.get("user_id"), key_id, data.get("thread_id"))
+            self_reply_tasks[key_id] = schedule_self_reply_timeout(key_id, chat_id=chat_id, delay=delay, token=token, **data)
+        restored += 1
+
+    if discard:
+        _drop_pending_timer(*discard)
+    log_tree(2, f"♻️ 倒计时恢复完成 | 恢复: {restored} (已到期立即处理: {expired}) | 丢弃: {len(discard)}")
+
 def build_main_string_session():
     global MAIN_SESSION_READY
     try:
@@ -7326,6 +9167,37 @@ client = TelegramClient(
     **telegram_proxy_client_kwargs()
 )
 
+# 用户/群名称缓存：启动时从磁盘恢复，维护任务定期落盘
+entity_cache = EntityCache(data_path('entity_cache.json'), ttl=ENTITY_CACHE_TTL_SECONDS, logger=logger)
+entity_cache.load()
+atexit.register(entity_cache.save)
+
+# 阻塞归因到这些入口协程；都不在栈上时归到项目内最外层的函数
+loop_monitor = LoopMonitor(
+    interval=LOOP_MONITOR_INTERVAL_MS / 1000,
+    threshold=LOOP_LAG_THRESHOLD_MS / 1000,
+    tags=(
+        "handler", "handler_deleted", "command_handler", "multi_rule_handler", "execute_rule_steps",
+        "check_wait_keyword_logic", "audit_pending_tasks", "backfill_chat_history", "restore_pending_timers",
+        "preload_group_metadata", "maintenance_task", "bot_command_polling_task",
+    ),
+    root=os.path.dirname(os.path.abspath(__file__)),
+    logger=logger,
+)
+
+# 最近消息的内存窗口：历史探测先查这里，有缺口再请求 Telegram
+local_history = LocalHistory(
+    LOCAL_HISTORY_WINDOW,
+    remember_sender=entity_cache.remember,
+    lookup_sender=lambda peer_id: entity_cache.get(peer_id, allow_stale=True),
+)
+
+message_batcher = MessageBatcher(
+    lambda chat_id, ids: client.get_messages(chat_id, ids=ids),
+    window_ms=GET_MESSAGES_BATCH_WINDOW_MS,
+    ttl=GET_MESSAGES_CACHE_TTL_SECONDS,
+)
+
 telegram_runtime_lock = TelegramRuntimeLock(
     get_wait_alert_redis_client,
     logger,
@@ -7351,7 +9223,10 @@ async def command_handler(event):
 async def handler_deleted(event):
     if not event.chat_id or not is_configured_cs_group(event.chat_id):
         return
+    local_history.mark_deleted(event.chat_id, event.deleted_ids)
+    wait_check_checkpoints.invalidate(event.chat_id, event.deleted_ids)
     for msg_id in event.deleted_ids:
+        message_batcher.invalidate(event.chat_id, msg_id)
         deleted_info = {'name': '未知', 'text': '未知'}
         deleted_info = msg_content_cache.get((event.chat_id, msg_id), deleted_info)
         snapshot_info = get_message_snapshot_info(event.chat_id, msg_id)
@@ -7412,14 +9287,13 @@ async def handler_deleted(event):
             log_tree(2, f"🗑️ 物理删除侦测 Msg={msg_id} | {sender_info_str} -> 🛑 撤销 [自回] 监控")
 
 async def get_traceable_sender(chat_id, reply_to_msg_id, current_recursion=0):
-    if (chat_id, reply_to_msg_id) in msg_to_user_cache:
-        return msg_to_user_cache[(chat_id, reply_to_msg_id)]
+    cached_user_id = msg_to_user_cache.get((chat_id, reply_to_msg_id))
+    if cached_user_id is not None:
+        return cached_user_id
 
     if current_recursion > 3: return None
     try:
-        msgs = await client.get_messages(chat_id, ids=[reply_to_msg_id])
-        if not msgs: return None
-        target_msg = msgs[0]
+        target_msg = await message_batcher.get(chat_id, reply_to_msg_id)
         if not target_msg: return None
         
         sender_id = target_msg.sender_id
@@ -7435,9 +9309,8 @@ async def get_traceable_sender(chat_id, reply_to_msg_id, current_recursion=0):
 async def get_context_users(chat_id, msg_id):
     users = set()
     try:
-        msgs = await client.get_messages(chat_id, ids=[msg_id])
-        if not msgs or not msgs[0]: return []
-        msg = msgs[0]
+        msg = await message_batcher.get(chat_id, msg_id)
+        if not msg: return []
         
         if msg.sender_id: 
             users.add(msg.sender_id)
@@ -7459,13 +9332,12 @@ async def get_replied_message_info(chat_id, reply_to_msg_id):
     if not reply_to_msg_id:
         return None, None, None
     try:
-        msgs = await client.get_messages(chat_id, ids=[reply_to_msg_id])
-        if not msgs or not msgs[0]:
+        replied_msg = await message_batcher.get(chat_id, reply_to_msg_id)
+        if not replied_msg:
             return None, None, None
-        replied_msg = msgs[0]
         target_id = replied_msg.sender_id
         target_name = "未知客服"
-        sender_obj = await replied_msg.get_sender()
+        sender_obj = await entity_cache.sender_of(replied_msg)
         if sender_obj:
             target_name = getattr(sender_obj, 'first_name', 'Unknown')
         return replied_msg, target_id, target_name
@@ -7498,7 +9370,7 @@ async def record_telegram_message_event(event, sender_name=None, msg_type=None,
     sender_name = sender_name or "Unknown"
     if sender_name == "Unknown":
         try:
-            sender = await event.get_sender()
+            sender = await entity_cache.sender_of(event)
             sender_name = getattr(sender, 'first_name', None) or getattr(sender, 'title', None) or "Unknown"
         except Exception:
             pass
@@ -7585,60 +9457,201 @@ async def record_telegram_message_event(event, sender_name=None, msg_type=None,
         broadcast=False,
     )
 
+def _history_snapshot_row(msg):
+    text = msg.text or ""
+    msg_type = "文本"
+    if msg.file:
+        msg_type = "文件/图片"
+        if not text:
+            text = "[媒体文件]"
+    if msg.sticker:
+        msg_type = "贴纸"
+        if not text:
+            text = "[贴纸]"
+    # iter_messages 已用同一页响应里附带的 users/chats 填好 msg.sender，无需逐条 get_sender()
+    sender = msg.sender
+    entity_cache.remember(sender)
+    sender_name = getattr(sender, 'first_name', None) or getattr(sender, 'title', None) or "Unknown"
+    return {
+        "message_id": msg.id,
+        "ts": msg.date.timestamp(),
+        "sender_id": msg.sender_id,
+        "sender_name": sender_name,
+        "sender_role": infer_sender_role(msg.sender_id, sender_name),
+        "text": text,
+        "msg_type": msg_type,
+        "reply_to_msg_id": get_primary_reply_target_id(msg),
+        "grouped_id": msg.grouped_id,
+    }
+
+async def _backfill_one_chat(chat_id, watermark, semaphore):
+    async with semaphore:
+        entity = await client.get_entity(chat_id)
+        entity_cache.remember(entity)
+        entity_id = getattr(entity, 'id', chat_id)
+        entity_title = getattr(entity, 'title', str(chat_id))
+        _group_name_cache[entity_id] = entity_title
+        if isinstance(entity_id, int) and entity_id > 0:
+            _remember_group_title(int(f"-100{entity_id}"), entity_title)
+        progress = {}
+        batch = []
+        chat_event_id = None
+        newest_id = watermark or 0
+        fetched = 0
+        seen = deque(maxlen=CHAT_HISTORY_BACKFILL_LIMIT)
+        # 首次回补只拉最新 LIMIT 条；有水位时从水位往新拉到最新，不设上限，否则水位与最旧一条之间的消息会永久漏掉。
+        # 一页一批、一批一个写事务；升序拉取时每批都带水位，写线程追上时就推进，中断后从已写入处继续
+        if watermark:
+            messages = client.iter_messages(entity, min_id=watermark, reverse=True)
+        else:
+            messages = client.iter_messages(entity, limit=CHAT_HISTORY_BACKFILL_LIMIT)
+        async for msg in messages:
+            if not msg:
+                continue
+            seen.append(msg)
+            newest_id = max(newest_id, msg.id)
+            if getattr(msg, "action", None):
+                continue
+            if chat_event_id is None:
+                chat_event_id = msg.chat_id or entity_id
+                if isinstance(chat_event_id, int) and chat_event_id > 0:
+                    chat_event_id = int(f"-100{chat_event_id}")
+            if len(batch) >= CHAT_HISTORY_BACKFILL_BATCH:
+                if not upsert_history_snapshots(
+                    chat_event_id, batch, progress, sync_chat_id=chat_id,
+                    watermark=max(row["message_id"] for row in batch) if watermark else None,
+                ):
+                    raise RuntimeError("写入队列已满")
+                batch = []
+            batch.append(_history_snapshot_row(msg))
+            fetched += 1
+        if batch:
+            if not upsert_history_snapshots(chat_event_id, batch, progress, sync_chat_id=chat_id, watermark=newest_id):
+                raise RuntimeError("写入队列已满")
+        elif newest_id > (watermark or 0) and not advance_chat_sync_watermark(chat_id, newest_id, progress):
+            raise RuntimeError("写入队列已满")
+        if seen:
+            # 有水位且 seen 没被挤掉时，水位之后的整段都已拉全，窗口可以从水位开始算覆盖
+            truncated = len(seen) >= CHAT_HISTORY_BACKFILL_LIMIT or not watermark
+            local_history.observe_history(seen[0].chat_id, seen, lo=None if truncated else watermark + 1)
+        return fetched
+
+group_metadata_state = {"groups": 0, "resolved": 0, "failed": 0, "requests": 0, "changes": 0, "refreshed_at": None, "duration_ms": None, "error": None}
+
+@on_group_title_change
+def _log_group_title_change(chat_id, old_title, new_title):
+    group_metadata_state["changes"] += 1
+    log_tree(1, f"🏷️ 群名变更 | Chat={chat_id} | {old_title} -> {new_title}")
+
+def _metadata_group_ids():
+    ids = set()
+    for raw_id in CS_GROUP_IDS:
+        ids.add(int(f"-100{raw_id}") if raw_id > 0 else raw_id)
+    try:
+        import monitor_responder as _monitor_responder
+        with _monitor_responder.current_config_lock:
+            rules = list(_monitor_responder.current_config.get("rules", []))
+        for rule in rules:
+            ids.update(_monitor_responder.clean_group_ids(rule.get("groups", [])))
+    except Exception:
+        pass
+    return ids
+
+async def _fetch_group_metadata(request_cls, ids, counters):
+    """
+    整批请求：任何一个群私有/被封/access_hash 过期都会让整批报错，此时逐个重试，只跳过出错的那个群。
+    FloodWait 直接抛出，拆开重试只会更糟。
+    """
+    counters["requests"] += 1
+    try:
+        return list((await client(request_cls(id=ids))).chats)
+    except FloodWaitError:
+        raise
+    except Exception as e:
+        if len(ids) == 1:
+            counters["failed"] += 1
+            log_tree(9, f"群资料预取跳过 {ids[0]}: {e}")
+            return []
+        log_tree(2, f"⚠️ 群资料批量预取失败，逐个重试 ({len(ids)} 个): {e}")
+    chats = []
+    for item in ids:
+        chats.extend(await _fetch_group_metadata(request_cls, [item], counters))
+    return chats
+
+async def preload_group_metadata():
+    """
+    把 CS 群和监控规则里的群一次性解析好：超级群每 GROUP_METADATA_BATCH 个一次 GetChannelsRequest，
+    普通群合并成一次 GetChatsRequest。结果写入 entity_cache 与群名表，逐条消息的 get_entity 不再需要联网。
+    """
+    started = time.monotonic()
+    channels, chats = [], []
+    group_ids = _metadata_group_ids()
+    for chat_id in sorted(group_ids):
+        try:
+            # 只查 session 里已有的 access_hash，主账号不在的群直接跳过
+            peer = await client.get_input_entity(chat_id)
+        except Exception:
+            continue
+        if isinstance(peer, types.InputPeerChannel):
+            channels.append(types.InputChannel(peer.channel_id, peer.access_hash))
+        elif isinstance(peer, types.InputPeerChat):
+            chats.append(peer.chat_id)
+
+    counters = {"requests": 0, "failed": 0}
+    resolved = []
+    for i in range(0, len(channels), GROUP_METADATA_BATCH):
+        resolved.extend(await _fetch_group_metadata(functions.channels.GetChannelsRequest, channels[i:i + GROUP_METADATA_BATCH], counters))
+    if chats:
+        resolved.extend(await _fetch_group_metadata(functions.messages.GetChatsRequest, chats, counters))
+
+    for chat in resolved:
+        entity_cache.remember(chat)
+        title = getattr(chat, "title", None)
+        if title:
+            _remember_group_title(utils.get_peer_id(chat), title)
+
+    group_metadata_state.update(
+        groups=len(group_ids),
+        resolved=len(resolved),
+        failed=counters["failed"],
+        requests=group_metadata_state["requests"] + counters["requests"],
+        refreshed_at=time.time(),
+        duration_ms=round((time.monotonic() - started) * 1000, 1),
+        error=None,
+    )
+    return len(resolved)
+
+async def group_metadata_task():
+    while True:
+        try:
+            resolved = await preload_group_metadata()
+            log_tree(0, f"🏷️ 群资料预取完成: {resolved}/{group_metadata_state['groups']} 个群, 耗时 {group_metadata_state['duration_ms']}ms")
+        except Exception as e:
+            group_metadata_state["error"] = str(e)
+            log_tree(9, f"群资料预取失败: {e}")
+        if GROUP_METADATA_REFRESH_SECONDS <= 0:
+            return
+        await asyncio.sleep(GROUP_METADATA_REFRESH_SECONDS)
+
 async def backfill_chat_history():
     if CHAT_HISTORY_BACKFILL_LIMIT <= 0:
         return
     try:
+        watermarks = _load_chat_sync_watermarks()
+        semaphore = asyncio.Semaphore(CHAT_HISTORY_BACKFILL_CONCURRENCY)
+        chat_ids = list(CS_GROUP_IDS)
+        results = await asyncio.gather(
+            *(_backfill_one_chat(chat_id, watermarks.get(chat_id, 0), semaphore) for chat_id in chat_ids),
+            return_exceptions=True,
+        )
         total = 0
-        for chat_id in CS_GROUP_IDS:
-            try:
-                entity = await client.get_entity(chat_id)
-                entity_id = getattr(entity, 'id', chat_id)
-                entity_title = getattr(entity, 'title', str(chat_id))
-                _group_name_cache[entity_id] = entity_title
-                if isinstance(entity_id, int) and entity_id > 0:
-                    _group_name_cache[int(f"-100{entity_id}")] = entity_title
-                async for msg in client.iter_messages(entity, limit=CHAT_HISTORY_BACKFILL_LIMIT):
-                    if not msg or getattr(msg, "action", None):
-                        continue
-                    text = msg.text or ""
-                    msg_type = "文本"
-                    if msg.file:
-                        msg_type = "文件/图片"
-                        if not text:
-                            text = "[媒体文件]"
-                    if msg.sticker:
-                        msg_type = "贴纸"
-                        if not text:
-                            text = "[贴纸]"
-                    sender_name = "Unknown"
-                    try:
-                        sender = await msg.get_sender()
-                        sender_name = getattr(sender, 'first_name', None) or getattr(sender, 'title', None) or "Unknown"
-                    except Exception:
-                        pass
-                    chat_event_id = msg.chat_id or getattr(entity, 'id', chat_id)
-                    if isinstance(chat_event_id, int) and chat_event_id > 0:
-                        chat_event_id = int(f"-100{chat_event_id}")
-                    row = upsert_message_snapshot(
-                        chat_event_id,
-                        msg.id,
-                        sender_id=msg.sender_id,
-                        sender_name=sender_name,
-                        text=text,
-                        msg_type=msg_type,
-                        ts=msg.date.timestamp(),
-                        reply_to_msg_id=get_primary_reply_target_id(msg),
-                        grouped_id=msg.grouped_id,
-                        sender_role=infer_sender_role(msg.sender_id, sender_name),
-                        broadcast=False
-                    )
-                    if row:
-                        total += 1
-            except Exception as e:
-                log_tree(9, f"历史消息回补失败 Chat={chat_id}: {e}")
+        for chat_id, result in zip(chat_ids, results):
+            if isinstance(result, Exception):
+                log_tree(9, f"历史消息回补失败 Chat={chat_id}: {result}")
+            else:
+                total += result
         if total:
-            log_tree(1, f"📥 历史消息回补完成: 新增 {total} 条")
+            log_tree(1, f"📥 历史消息回补完成: 拉取 {total} 条")
     except Exception as e:
         log_tree(9, f"历史消息回补任务失败: {e}")
 
@@ -7656,6 +9669,14 @@ async def handler(event):
                 log_tree(1, f"🛡️ 忽略非CS_GROUP_IDS群组消息 | Chat={chat_id} | Msg={event.id}")
             return
 
+        # 服务消息也要进窗口，否则 id 会出现缺口
+        if is_new_message_event(event):
+            local_history.observe(event.message, chat_id)
+        else:
+            local_history.observe_edit(event.message, chat_id)
+            ai_verdict_cache.invalidate_message(chat_id, event.id)
+            wait_check_checkpoints.invalidate(chat_id, [event.id])
+
         # 过滤服务消息
         if event.message.action:
             return
@@ -7673,7 +9694,8 @@ async def handler(event):
             if not text: text = "[贴纸]"
 
         sender_id = event.sender_id
-        sender = await event.get_sender()
+        entity_cache.remember(getattr(event, 'chat', None))
+        sender = await entity_cache.sender_of(event)
         sender_name = getattr(sender, 'first_name', 'Unknown')
         await record_telegram_message_event(event, sender_name=sender_name, msg_type=msg_type, text=text)
         update_content_cache(chat_id, event.id, sender_name, text)
@@ -7681,11 +9703,11 @@ async def handler(event):
         # 监听暂停时仍记录消息到数据库，然后直接返回
         if not IS_WORKING:
             if is_new_message_event(event):
-                log_tree(0, f"Msg={event.id} [T={msg_time_str}] | User={event.sender_id} | [{chat_id}] {text[:200].replace(chr(10),' ')} [{msg_type}][暂停]")
+                log_tree(0, "Msg=%s [T=%s] | User=%s | [%s] %s [%s][暂停]", event.id, msg_time_str, event.sender_id, chat_id, text[:200].replace(chr(10), ' '), msg_type)
                 if chat_id not in _group_name_cache:
                     try:
-                        _g = await client.get_entity(chat_id)
-                        _group_name_cache[chat_id] = _g.title
+                        _g = await entity_cache.entity(client, chat_id)
+                        _remember_group_title(chat_id, _g.title)
                     except Exception:
                         _group_name_cache[chat_id] = str(chat_id)
             return
@@ -7712,15 +9734,13 @@ async def handler(event):
 
         real_customer_id = None
         if reply_to_msg_id:
-            if (chat_id, reply_to_msg_id) in msg_to_user_cache:
-                real_customer_id = msg_to_user_cache[(chat_id, reply_to_msg_id)]
+            real_customer_id = msg_to_user_cache.get((chat_id, reply_to_msg_id))
             
             if not real_customer_id and reply_to_msg_id in wait_msg_map:
                 wait_origin_msg = wait_msg_map[reply_to_msg_id]
-                for (cid, uid), msg_set in chat_user_active_msgs.items():
-                    if cid == chat_id and wait_origin_msg in msg_set:
-                        real_customer_id = uid
-                        break
+                for uid in active_msgs.users_of(chat_id, wait_origin_msg):
+                    real_customer_id = uid
+                    break
             
             if not real_customer_id:
                 real_customer_id = await get_traceable_sender(chat_id, reply_to_msg_id)
@@ -7735,7 +9755,7 @@ async def handler(event):
                      is_latest = True
                      latest_found_id = event.id
                      if current_thread_id:
-                         async for m in client.iter_messages(chat_id, limit=30):
+                         for m in await recent_history(chat_id, 30):
                              is_in_thread = False
                              if m.reply_to:
                                  if m.reply_to.reply_to_top_id == current_thread_id: is_in_thread = True
@@ -7746,19 +9766,19 @@ async def handler(event):
                                      is_latest = False
                                      latest_found_id = m.id
                                      txt = m.text or ""
-                                     if not any(k in txt for k in WAIT_SIGNATURES):
+                                     if not match_signature(txt, WAIT_SIGNATURES):
                                          log_tree(1, f"🛡️ 编辑拦截 | Msg={event.id} 被新消息 Msg={m.id} 覆盖 (内容非稍等) -> 忽略")
                                          return 
                                      else:
                                          log_tree(1, f"⚠️ 编辑放行 | Msg={event.id} 虽非最新 (Top={m.id}) 但Top仍为稍等")
                                  break 
                          else:
-                             latest_batch = await client.get_messages(chat_id, limit=1)
+                             latest_batch = await recent_history(chat_id, 1)
                              if latest_batch:
                                  m = latest_batch[0]
                                  if m.id > event.id:
                                      txt = m.text or ""
-                                     if not any(k in txt for k in WAIT_SIGNATURES):
+                                     if not match_signature(txt, WAIT_SIGNATURES):
                                          log_tree(1, f"🛡️ 编辑拦截(主群) | Msg={event.id} 被新消息 Msg={m.id} 覆盖 -> 忽略")
                                          return
 
@@ -7816,12 +9836,12 @@ async def handler(event):
                                 if reply_to_msg_id in followup_timers: del followup_timers[reply_to_msg_id]
                                 remove_map_entries_by_value(followup_msg_map, reply_to_msg_id)
 
-                            task = asyncio.create_task(task_followup_timeout(
+                            task = schedule_followup_timeout(
                                 reply_to_msg_id, sender_name, text[:50], msg_link, event.id, chat_id, related_users, 
                                 trigger_timestamp=msg_timestamp,
                                 thread_id=current_thread_id,
                                 wait_keyword=history_wait_keyword
-                            ))
+                            )
                             followup_tasks[reply_to_msg_id] = task
                             followup_msg_map[event.id] = reply_to_msg_id
 
@@ -7843,12 +9863,12 @@ async def handler(event):
                                 if reply_to_msg_id in wait_task_keywords: del wait_task_keywords[reply_to_msg_id]
                                 remove_map_entries_by_value(wait_msg_map, reply_to_msg_id)
 
-                            task = asyncio.create_task(task_wait_timeout(
+                            task = schedule_wait_timeout(
                                 reply_to_msg_id, sender_name, text[:50], msg_link, event.id, chat_id, related_users,
                                 trigger_timestamp=msg_timestamp,
                                 thread_id=current_thread_id,
                                 wait_keyword=matched_alert_wait_keyword
-                            ))
+                            )
                             wait_tasks[reply_to_msg_id] = task
                             wait_task_keywords[reply_to_msg_id] = matched_alert_wait_keyword
                             wait_msg_map[event.id] = reply_to_msg_id
@@ -7860,11 +9880,11 @@ async def handler(event):
             update_msg_cache(chat_id, event.id, sender_id, grouped_id)
             cancel_tasks(chat_id, sender_id, current_thread_id, reason="客户发言: [已隐藏]", types=['reply'])
             
-            log_tree(0, f"Msg={event.id} [T={msg_time_str}] | User={sender_id} | [{chat_id}] {sender_name}: {text} [{msg_type}]")
+            log_tree(0, "Msg=%s [T=%s] | User=%s | [%s] %s: %s [%s]", event.id, msg_time_str, sender_id, chat_id, sender_name, text, msg_type)
             if chat_id not in _group_name_cache:
                 try:
-                    _g = await client.get_entity(chat_id)
-                    _group_name_cache[chat_id] = _g.title
+                    _g = await entity_cache.entity(client, chat_id)
+                    _remember_group_title(chat_id, _g.title)
                 except Exception:
                     _group_name_cache[chat_id] = str(chat_id)
 
@@ -7889,12 +9909,12 @@ async def handler(event):
                                  register_task(chat_id, sender_id, event.id, current_thread_id)
                                  log_tree(1, f"🔥 侦测到自回行为 | User={sender_name} | Msg={event.id} -> {reply_to_msg_id}")
                                  
-                                 task = asyncio.create_task(task_self_reply_timeout(
+                                 task = schedule_self_reply_timeout(
                                      event.id, sender_name, text[:50], msg_link, chat_id, sender_id, 
                                      trigger_timestamp=msg_timestamp,
                                      thread_id=current_thread_id,
                                      wait_keyword=history_wait_keyword
-                                 ))
+                                 )
                                  
                                  def cleanup_self_reply(_):
                                      if event.id in self_reply_tasks: del self_reply_tasks[event.id]
@@ -7926,12 +9946,12 @@ async def handler(event):
                             log_tree(1, f"🛡️ 豁免 [漏回-图集去重] | GroupID={grouped_id} | Msg={event.id} -> Active={reply_task_id}")
                             return
 
-                        task = asyncio.create_task(task_reply_timeout(
+                        task = schedule_reply_timeout(
                             reply_task_id, sender_name, text[:50], msg_link, chat_id, sender_id, target_name,
                             trigger_timestamp=msg_timestamp,
                             thread_id=current_thread_id,
                             wait_keyword=history_wait_keyword
-                        ))
+                        )
                         reply_tasks[reply_task_id] = task
                 except Exception as e:
                     log_tree(9, f"❌ Reply Check Error: {e}")
@@ -7948,6 +9968,10 @@ if __name__ == '__main__':
             
         bot_loop = asyncio.get_event_loop()
         install_shutdown_signal_handlers(bot_loop)
+        if LOOP_MONITOR_INTERVAL_MS > 0:
+            loop_monitor.start(bot_loop)
+            if LOOP_ASYNCIO_DEBUG:
+                loop_monitor.enable_slow_callback_log(bot_loop)
         bot_loop.create_task(maintenance_task())
         bot_loop.create_task(bot_command_polling_task())
         
@@ -7983,6 +10007,8 @@ if __name__ == '__main__':
             main_display = " ".join([x for x in [getattr(main_me, "first_name", ""), getattr(main_me, "last_name", "")] if x]).strip() or "Unknown"
             main_username = f"@{main_me.username}" if getattr(main_me, "username", None) else "无用户名"
             logger.info(f"✅ [Main] 主账号启动成功 | 登录身份: {main_display} ({main_me.id}) | {main_username} | Session来源: {SESSION_STRING_SOURCE}")
+        bot_loop.create_task(group_metadata_task())
+        bot_loop.create_task(restore_pending_timers())
         bot_loop.create_task(backfill_chat_history())
         client.run_until_disconnected()
         release_telegram_runtime_lock()
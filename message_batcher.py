@@ -0,0 +1,90 @@
+import asyncio
+
+from bounded_cache import BoundedCache
+
+
+class MessageBatcher:
+    """
+    按群合并 get_messages 按 id 查询：window_ms 内同一群的请求合成一次 fetch(chat_id, ids)，
+    同一条消息的并发请求共用一个 future，结果（包括已删除的 None）在 ttl 秒内直接复用。
+    fetch 抛出的异常会原样抛给本批的每个调用方。
+    """
+
+    def __init__(self, fetch, window_ms=5, max_batch=100, ttl=3.0, cache_size=5000):
+        self.fetch = fetch
+        self.window = max(0, int(window_ms)) / 1000.0
+        self.max_batch = max(1, int(max_batch))
+        self._cache = BoundedCache("message_batcher", cache_size, ttl=ttl)
+        self._pending = {}  # chat_id -> {msg_id: future}
+        self._inflight = {}  # (chat_id, msg_id) -> future
+        self._timers = {}
+        self._stats = {"requests": 0, "cache_hits": 0, "coalesced": 0, "batches": 0, "fetched_ids": 0, "errors": 0}
+
+    async def get(self, chat_id, msg_id):
+        self._stats["requests"] += 1
+        key = (chat_id, msg_id)
+        if key in self._cache:
+            self._stats["cache_hits"] += 1
+            return self._cache.get(key)
+        future = self._inflight.get(key)
+        if future is not None:
+            self._stats["coalesced"] += 1
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._inflight[key] = future
+        batch = self._pending.setdefault(chat_id, {})
+        batch[msg_id] = future
+        if len(batch) >= self.max_batch:
+            self._flush(chat_id)
+        elif chat_id not in self._timers:
+            self._timers[chat_id] = loop.call_later(self.window, self._flush, chat_id)
+        return await asyncio.shield(future)
+
+    def invalidate(self, chat_id, msg_id):
+        self._cache.pop((chat_id, msg_id), None)
+
+    def stats(self):
+        data = dict(self._stats)
+        data["avg_batch_size"] = round(data["fetched_ids"] / data["batches"], 2) if data["batches"] else 0.0
+        data["inflight"] = len(self._inflight)
+        data["cache"] = self._cache.stats()
+        return data
+
+    def _flush(self, chat_id):
+        timer = self._timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(chat_id, None)
+        if batch:
+            asyncio.get_event_loop().create_task(self._run(chat_id, batch))
+
+    async def _run(self, chat_id, batch):
+        ids = list(batch)
+        self._stats["batches"] += 1
+        self._stats["fetched_ids"] += len(ids)
+        try:
+            msgs = await self.fetch(chat_id, ids)
+            if not isinstance(msgs, (list, tuple)):
+                msgs = [msgs]
+            found = {getattr(msg, "id", None): msg for msg in msgs if msg}
+            for msg_id, future in batch.items():
+                msg = found.get(msg_id)
+                self._cache[(chat_id, msg_id)] = msg
+                if not future.done():
+                    future.set_result(msg)
+        except asyncio.CancelledError:
+            for future in batch.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            self._stats["errors"] += 1
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    # 没有调用方在等（都已取消）时也不要留下 "exception was never retrieved"
+                    future.exception()
+        finally:
+            for msg_id in ids:
+                self._inflight.pop((chat_id, msg_id), None)
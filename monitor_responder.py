@@ -19,6 +19,7 @@ from flask import request, jsonify, Response, render_template_string, session, r
 from telethon import events, TelegramClient, functions, types
 from telethon.sessions import StringSession
 from telethon.errors import AuthKeyDuplicatedError
+from bounded_cache import BoundedCache
 from telegram_proxy import telegram_proxy_client_kwargs
 from monitor_rules import (
     monitor_rule_account_name as resolve_monitor_rule_account_name,
@@ -104,11 +105,16 @@ except Exception:
     SETTLEMENT_TG_REPLY_TTL_SECONDS = 172800
 SETTLEMENT_TG_FORWARD_DEDUP_LIMIT = 5000
 settlement_tg_bridge_lock = threading.RLock()
-settlement_tg_bridge_memory = {}
+SETTLEMENT_TG_BRIDGE_MEMORY_LIMIT = 20000
+settlement_tg_bridge_memory = BoundedCache("settlement_tg_bridge", SETTLEMENT_TG_BRIDGE_MEMORY_LIMIT, ttl=SETTLEMENT_TG_REPLY_TTL_SECONDS)
 settlement_tg_forwarded_queue = deque()
 settlement_tg_forwarded_keys = set()
-ai_private_reply_latest = {}
-ai_private_reply_locks = {}
+# 私聊 AI 回复的防抖/串行状态：只有近期活跃的私聊需要保留
+AI_PRIVATE_REPLY_STATE_LIMIT = 5000
+AI_PRIVATE_REPLY_STATE_TTL_SECONDS = 24 * 3600
+ai_private_reply_latest = BoundedCache("ai_private_reply_latest", AI_PRIVATE_REPLY_STATE_LIMIT, ttl=AI_PRIVATE_REPLY_STATE_TTL_SECONDS)
+# 锁不能放进会淘汰的缓存：持有中的锁被淘汰后，同一会话的下一条消息会新建一把锁并发执行
+ai_private_reply_locks = {}  # key -> [asyncio.Lock, 使用中的协程数]
 
 DOMAIN_PIN_SOURCE_CHAT_IDS = [-1002819832851, -1002560892878]
 DOMAIN_PIN_TARGET_COMBINED_WITH_FOOTER = [
@@ -1064,30 +1070,41 @@ async def handle_ai_private_reply(event, account_name):
     if ai_private_reply_latest.get(key) != getattr(event, "id", None):
         return
 
-    lock = ai_private_reply_locks.get(key)
-    if lock is None:
-        lock = asyncio.Lock()
-        ai_private_reply_locks[key] = lock
+    entry = ai_private_reply_locks.get(key)
+    if entry is None:
+        entry = ai_private_reply_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            if ai_private_reply_latest.get(key) != getattr(event, "id", None):
+                return
+            reply = simple_ai_private_chat_reply(text)
+            if not reply:
+                context_text = await collect_ai_private_context(event.client, event.chat_id)
+                reply = await generate_ai_private_reply(account_name, account_config.get("prompt", ""), context_text)
+            if ai_private_reply_latest.get(key) != getattr(event, "id", None):
+                return
+            await event.client.send_message(event.chat_id, reply)
+            record_runtime_event(
+                "ai_private_reply",
+                "success",
+                "AI私聊回复已发送",
+                rule={"id": "__ai_private_reply__", "name": "AI私聊回复"},
+                event=event,
+                target_account=account_name,
+                action_count=1,
+            )
+    finally:
+        entry[1] -= 1
+        prune_ai_private_reply_locks()
 
-    async with lock:
-        if ai_private_reply_latest.get(key) != getattr(event, "id", None):
-            return
-        reply = simple_ai_private_chat_reply(text)
-        if not reply:
-            context_text = await collect_ai_private_context(event.client, event.chat_id)
-            reply = await generate_ai_private_reply(account_name, account_config.get("prompt", ""), context_text)
-        if ai_private_reply_latest.get(key) != getattr(event, "id", None):
-            return
-        await event.client.send_message(event.chat_id, reply)
-        record_runtime_event(
-            "ai_private_reply",
-            "success",
-            "AI私聊回复已发送",
-            rule={"id": "__ai_private_reply__", "name": "AI私聊回复"},
-            event=event,
-            target_account=account_name,
-            action_count=1,
-        )
+def prune_ai_private_reply_locks():
+    """超过上限两倍时清理：只删没有协程在用、且 ai_private_reply_latest 已不再保留的会话锁。"""
+    if len(ai_private_reply_locks) <= 2 * AI_PRIVATE_REPLY_STATE_LIMIT:
+        return
+    for key, (_, users) in list(ai_private_reply_locks.items()):
+        if users == 0 and key not in ai_private_reply_latest:
+            del ai_private_reply_locks[key]
 
 def create_ai_private_reply_handler(account_name):
     async def ai_private_reply_handler(event):
@@ -1752,10 +1769,8 @@ def save_settlement_tg_bridge(account_name, sent_message, post_data):
     keys = settlement_tg_bridge_keys(sent_chat_id, sent_message_id, account_name)
     if not keys:
         return
-    expires_at = time.time() + SETTLEMENT_TG_REPLY_TTL_SECONDS
-    with settlement_tg_bridge_lock:
-        for key in keys:
-            settlement_tg_bridge_memory[key] = {"payload": payload, "expires_at": expires_at}
+    for key in keys:
+        settlement_tg_bridge_memory[key] = payload
     if redis_client:
         raw = json.dumps(payload, ensure_ascii=False)
         for key in keys:
@@ -1770,24 +1785,16 @@ def save_settlement_tg_bridge(account_name, sent_message, post_data):
     )
 
 def load_settlement_tg_bridge(chat_id, message_id, account_name=""):
-    now = time.time()
     for key in settlement_tg_bridge_keys(chat_id, message_id, account_name):
-        with settlement_tg_bridge_lock:
-            item = settlement_tg_bridge_memory.get(key)
-            if item:
-                if float(item.get("expires_at") or 0) > now:
-                    return dict(item.get("payload") or {})
-                settlement_tg_bridge_memory.pop(key, None)
+        payload = settlement_tg_bridge_memory.get(key)
+        if payload:
+            return dict(payload)
         if redis_client:
             try:
                 raw = redis_client.get(key)
                 if raw:
                     payload = json.loads(raw)
-                    with settlement_tg_bridge_lock:
-                        settlement_tg_bridge_memory[key] = {
-                            "payload": payload,
-                            "expires_at": now + SETTLEMENT_TG_REPLY_TTL_SECONDS,
-                        }
+                    settlement_tg_bridge_memory[key] = payload
                     return payload
             except Exception as e:
                 logger.warning(f"⚠️ [SettlementBridge] Redis 读取关联失败: {e}")
@@ -0,0 +1,119 @@
+from collections.abc import MutableMapping
+
+
+class ReverseIndexedMap(MutableMapping):
+    """
+    key -> value 映射，同时维护 value -> {key} 反查，按值删除不用再整表扫描。
+    其余用法与 dict 相同（in / [] / del / get / pop / items / clear）。
+    """
+
+    def __init__(self):
+        self._forward = {}
+        self._reverse = {}
+
+    def __getitem__(self, key):
+        return self._forward[key]
+
+    def __setitem__(self, key, value):
+        if key in self._forward:
+            self._unlink(key, self._forward[key])
+        self._forward[key] = value
+        self._reverse.setdefault(value, set()).add(key)
+
+    def __delitem__(self, key):
+        value = self._forward.pop(key)
+        self._unlink(key, value)
+
+    def __contains__(self, key):
+        return key in self._forward
+
+    def __iter__(self):
+        return iter(self._forward)
+
+    def __len__(self):
+        return len(self._forward)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self._forward!r})"
+
+    def keys_for(self, value):
+        return set(self._reverse.get(value, ()))
+
+    def remove_value(self, value):
+        keys = self._reverse.pop(value, ())
+        for key in keys:
+            del self._forward[key]
+        return len(keys)
+
+    def clear(self):
+        self._forward.clear()
+        self._reverse.clear()
+
+    def _unlink(self, key, value):
+        keys = self._reverse.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._reverse[value]
+
+
+class ActiveMessageIndex:
+    """
+    正在计时的消息索引：(chat_id, user_id) / (chat_id, thread_id) -> {msg_id}，
+    并反查 (chat_id, msg_id) 属于哪些用户、哪些消息流，增删查都是 O(1)。
+    by_user / by_thread 直接暴露给旧代码当只读 dict 用，只能通过 add/discard/clear 修改。
+    """
+
+    def __init__(self):
+        self.by_user = {}
+        self.by_thread = {}
+        self._users_of = {}
+        self._threads_of = {}
+
+    def add(self, chat_id, msg_id, user_id=None, thread_id=None):
+        if user_id:
+            self._link(self.by_user, self._users_of, chat_id, user_id, msg_id)
+        if thread_id:
+            self._link(self.by_thread, self._threads_of, chat_id, thread_id, msg_id)
+
+    def discard(self, chat_id, msg_id, user_id=None, thread_id=None):
+        if user_id:
+            self._unlink(self.by_user, self._users_of, chat_id, user_id, msg_id)
+        if thread_id:
+            self._unlink(self.by_thread, self._threads_of, chat_id, thread_id, msg_id)
+
+    def users_of(self, chat_id, msg_id):
+        return set(self._users_of.get((chat_id, msg_id), ()))
+
+    def threads_of(self, chat_id, msg_id):
+        return set(self._threads_of.get((chat_id, msg_id), ()))
+
+    def thread_msgs(self, chat_id, thread_id):
+        return set(self.by_thread.get((chat_id, thread_id), ()))
+
+    def user_msgs(self, chat_id, user_id):
+        return set(self.by_user.get((chat_id, user_id), ()))
+
+    def clear(self):
+        self.by_user.clear()
+        self.by_thread.clear()
+        self._users_of.clear()
+        self._threads_of.clear()
+
+    @staticmethod
+    def _link(forward, reverse, chat_id, owner, msg_id):
+        forward.setdefault((chat_id, owner), set()).add(msg_id)
+        reverse.setdefault((chat_id, msg_id), set()).add(owner)
+
+    @staticmethod
+    def _unlink(forward, reverse, chat_id, owner, msg_id):
+        msgs = forward.get((chat_id, owner))
+        if msgs is not None:
+            msgs.discard(msg_id)
+            if not msgs:
+                del forward[(chat_id, owner)]
+        owners = reverse.get((chat_id, msg_id))
+        if owners is not None:
+            owners.discard(owner)
+            if not owners:
+                del reverse[(chat_id, msg_id)]
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from ai_pipeline import BatchClassifier, DeadlineExceeded, TokenBucket
+
+
+class Recorder:
+    def __init__(self, batch_results=None, batch_error=None, single_error=None):
+        self.lock = threading.Lock()
+        self.singles = []
+        self.batches = []
+        self.batch_results = batch_results
+        self.batch_error = batch_error
+        self.single_error = single_error
+
+    def run_single(self, prompt, deadline):
+        with self.lock:
+            self.singles.append(prompt)
+        if self.single_error:
+            raise self.single_error
+        return {"single": prompt}
+
+    def run_batch(self, kind, prompts, deadline):
+        with self.lock:
+            self.batches.append(list(prompts))
+        if self.batch_error:
+            raise self.batch_error
+        if self.batch_results is not None:
+            return self.batch_results(prompts)
+        return [{"batch": prompt} for prompt in prompts]
+
+
+def classify_all(classifier, kind, prompts):
+    async def main():
+        return await asyncio.gather(*(classifier.classify(kind, prompt) for prompt in prompts), return_exceptions=True)
+
+    return asyncio.run(main())
+
+
+def test_batch_results_are_returned_in_request_order():
+    recorder = Recorder()
+    classifier = BatchClassifier(recorder.run_single, recorder.run_batch, max_batch=3, window_ms=20)
+    results = classify_all(classifier, "k", ["a", "b", "c", "d"])
+    assert results == [{"batch": "a"}, {"batch": "b"}, {"batch": "c"}, {"single": "d"}]
+    # 满 3 条立即发出，剩下 1 条等窗口到期单独成批后走单条请求
+    assert recorder.batches == [["a", "b", "c"]]
+    assert recorder.singles == ["d"]
+    stats = classifier.stats()
+    assert stats["batches"] == 1 and stats["batched_items"] == 3 and stats["pending"] == 0
+
+
+def test_missing_items_fall_back_to_single_requests():
+    recorder = Recorder(batch_results=lambda prompts: [{"batch": prompts[0]}, None])
+    classifier = BatchClassifier(recorder.run_single, recorder.run_batch, max_batch=3, window_ms=10)
+    results = classify_all(classifier, "k", ["a", "b", "c"])
+    assert results == [{"batch": "a"}, {"single": "b"}, {"single": "c"}]
+    assert sorted(recorder.singles) == ["b", "c"]
+    assert classifier.stats()["batch_fallbacks"] == 2
+
+
+def test_failed_batch_retries_every_item_individually():
+    recorder = Recorder(batch_error=RuntimeError("bad batch"))
+    classifier = BatchClassifier(recorder.run_single, recorder.run_batch, max_batch=2, window_ms=10)
+    results = classify_all(classifier, "k", ["a", "b"])
+    assert results == [{"single": "a"}, {"single": "b"}]
+    assert classifier.stats()["errors"] == 1
+
+
+def test_kinds_are_batched_separately():
+    recorder = Recorder()
+    classifier = BatchClassifier(recorder.run_single, recorder.run_batch, max_batch=2, window_ms=10)
+
+    async def main():
+        return await asyncio.gather(
+            classifier.classify("x", "x1"), classifier.classify("y", "y1"),
+            classifier.classify("x", "x2"), classifier.classify("y", "y2"),
+        )
+
+    assert asyncio.run(main()) == [{"batch": "x1"}, {"batch": "y1"}, {"batch": "x2"}, {"batch": "y2"}]
+    assert sorted(recorder.batches) == [["x1", "x2"], ["y1", "y2"]]
+
+
+def test_single_errors_propagate_and_deadline_is_counted():
+    recorder = Recorder(single_error=DeadlineExceeded("late"))
+    classifier = BatchClassifier(recorder.run_single, window_ms=0)
+    results = classify_all(classifier, "k", ["a"])
+    assert isinstance(results[0], DeadlineExceeded)
+    assert classifier.stats()["deadline_exceeded"] == 1
+
+
+def test_without_run_batch_every_request_is_single():
+    recorder = Recorder()
+    classifier = BatchClassifier(recorder.run_single, max_batch=5, window_ms=10)
+    assert classify_all(classifier, "k", ["a", "b"]) == [{"single": "a"}, {"single": "b"}]
+    assert recorder.batches == []
+
+
+def test_token_bucket_burst_then_rate_limit():
+    bucket = TokenBucket(rate=20, burst=2)
+    assert bucket.acquire() and bucket.acquire()
+    started = time.monotonic()
+    assert bucket.acquire()
+    assert time.monotonic() - started >= 0.03
+    assert bucket.stats()["waited"] == 1
+
+
+def test_token_bucket_rejects_when_deadline_cannot_be_met():
+    bucket = TokenBucket(rate=1, burst=1)
+    assert bucket.acquire()
+    assert bucket.acquire(deadline=time.monotonic() + 0.1) is False
+    assert bucket.stats()["rejected"] == 1
+
+
+@pytest.mark.parametrize("rate", [0, -1])
+def test_token_bucket_disabled(rate):
+    bucket = TokenBucket(rate=rate)
+    assert all(bucket.acquire(deadline=time.monotonic()) for _ in range(5))
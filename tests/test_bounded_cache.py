@@ -0,0 +1,90 @@
+import pytest
+
+import bounded_cache
+from bounded_cache import BoundedCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bounded_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_lru_eviction_follows_access_order():
+    cache = BoundedCache("t_lru", maxsize=3)
+    for key in "abc":
+        cache[key] = key
+    assert cache.get("a") == "a"  # a 变成最新
+    cache["d"] = "d"
+    assert list(cache) == ["c", "a", "d"]
+    assert "b" not in cache
+    assert cache.stats()["evictions"] == 1
+
+
+def test_contains_and_peek_do_not_refresh_order():
+    cache = BoundedCache("t_peek", maxsize=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    assert "a" in cache
+    assert cache.peek("a") == 1
+    cache["c"] = 3
+    assert "a" not in cache
+    assert cache.stats()["hits"] == 0
+
+
+def test_default_and_per_entry_ttl(clock):
+    cache = BoundedCache("t_ttl", maxsize=10, ttl=10)
+    cache["short"] = 1
+    cache.set("long", 2, ttl=100)
+    cache.set("forever", 3, ttl=None)
+    clock[0] += 11
+    assert cache.get("short") is None
+    assert cache["long"] == 2
+    clock[0] += 100
+    assert "long" not in cache
+    assert cache["forever"] == 3
+    assert cache.stats()["expirations"] == 2
+
+
+def test_purge_expired_drops_only_expired(clock):
+    cache = BoundedCache("t_purge", maxsize=10, ttl=5)
+    cache["a"] = 1
+    clock[0] += 3
+    cache["b"] = 2
+    clock[0] += 3
+    assert cache.purge_expired() == 1
+    assert len(cache) == 1 and cache["b"] == 2
+
+
+def test_byte_limit_evicts_oldest_but_keeps_one_entry():
+    cache = BoundedCache("t_bytes", maxsize=100, max_bytes=10, sizeof=len)
+    cache["a"] = "xxxx"
+    cache["b"] = "yyyy"
+    cache["c"] = "zzzz"
+    assert "a" not in cache and cache.stats()["bytes"] == 8
+    cache["big"] = "x" * 50
+    assert list(cache) == ["big"]
+    assert cache.stats()["bytes"] == 50
+
+
+def test_overwrite_and_delete_keep_byte_accounting():
+    cache = BoundedCache("t_account", maxsize=10, max_bytes=100, sizeof=len)
+    cache["a"] = "xxxx"
+    cache["a"] = "xx"
+    assert cache.stats()["bytes"] == 2
+    del cache["a"]
+    assert cache.stats()["bytes"] == 0
+    assert cache.pop("missing", None) is None
+    with pytest.raises(KeyError):
+        cache["missing"]
+
+
+def test_setdefault_and_hit_rate():
+    cache = BoundedCache("t_stats", maxsize=10)
+    assert cache.setdefault("k", []) == []
+    cache.setdefault("k", None).append(1)
+    assert cache["k"] == [1]
+    stats = cache.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 1
+    assert stats["hit_rate"] == round(2 / 3, 4)
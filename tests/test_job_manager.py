@@ -0,0 +1,123 @@
+import json
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+import job_manager
+from job_manager import Job, JobManager
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(job_manager.time, "time", lambda: now[0])
+    return now
+
+
+def finished_runner(lines):
+    def runner(job):
+        for line in lines:
+            job.put(line)
+        job.put(None)
+    return runner
+
+
+def test_follow_replays_from_start_and_ends_with_the_job():
+    job = Job("wait_check", "k")
+    job.put("a")
+    received = []
+    follower = threading.Thread(target=lambda: received.extend(job.follow(poll=0.05)))
+    follower.start()
+    job.put("b")
+    job.put(None)
+    follower.join(1)
+    assert not follower.is_alive()
+    assert received == ["a", "b"]
+    assert list(job.follow(start=1)) == ["b"]
+    assert job.status == "done" and job.subscribers == 0
+
+
+def test_puts_after_finish_are_ignored():
+    job = Job("wait_check", "k")
+    job.finish()
+    job.put("late")
+    assert list(job.follow()) == []
+
+
+def test_only_progress_lines_are_dropped_when_full():
+    job = Job("wait_check", "k", max_events=3)
+    progress = json.dumps({"type": "progress", "n": 1})
+    job.put(progress)
+    job.put("result-1")
+    job.put("result-2")
+    job.put("result-3")
+    job.put(None)
+    assert list(job.follow()) == ["result-1", "result-2", "result-3"]
+    assert job.snapshot()["truncated"] == 1
+
+
+def test_same_key_attaches_until_retention_expires(clock):
+    manager = JobManager(retention=60)
+    calls = []
+
+    def runner(job):
+        calls.append(job.id)
+        job.put(None)
+
+    first, created = manager.start("audit", "k", runner)
+    assert created
+    again, created = manager.start("audit", "k", runner)
+    assert again is first and not created
+    other, created = manager.start("audit", "other", runner)
+    assert created and other is not first
+    clock[0] += 61
+    fresh, created = manager.start("audit", "k", runner)
+    assert created and fresh is not first
+    assert manager.get(first.id) is None
+    assert len(calls) == 3
+    assert manager.stats()["attached"] == 1
+
+
+def test_refresh_restarts_only_finished_jobs(clock):
+    manager = JobManager(retention=600)
+    running, _ = manager.start("audit", "k", lambda job: None)
+    same, created = manager.start("audit", "k", finished_runner([]), refresh=True)
+    assert same is running and not created
+    running.finish()
+    new, created = manager.start("audit", "k", finished_runner([]), refresh=True)
+    assert created and new is not running
+
+
+def test_future_outcome_finishes_the_job():
+    errors = []
+
+    class Logger:
+        def error(self, msg):
+            errors.append(msg)
+
+    manager = JobManager(logger=Logger())
+    future = Future()
+    job, _ = manager.start("audit", "k", lambda job: future)
+    assert job.status == "running"
+    future.set_exception(RuntimeError("scan failed"))
+    assert job.status == "failed" and "scan failed" in job.error
+    assert json.loads(list(job.follow())[-1]) == {"type": "error", "msg": "scan failed"}
+    assert manager.stats()["failed"] == 1 and len(errors) == 1
+
+    cancelled = Future()
+    job, _ = manager.start("audit", "c", lambda job: cancelled)
+    cancelled.cancel()
+    assert job.status == "failed"
+
+
+def test_runner_exception_fails_the_job():
+    manager = JobManager()
+
+    def runner(job):
+        raise ValueError("bad params")
+
+    job, created = manager.start("audit", "k", runner)
+    assert created and job.status == "failed" and job.error == "bad params"
+    assert [snapshot["id"] for snapshot in manager.list("audit")] == [job.id]
+    assert manager.list("wait_check") == []
@@ -0,0 +1,114 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from local_history import LocalHistory
+
+CHAT = -1001
+
+
+def msg(msg_id, ts=None, sender="cs", reply_to=None, top=None, action=None):
+    return SimpleNamespace(
+        id=msg_id,
+        chat_id=CHAT,
+        date=datetime.fromtimestamp(ts if ts is not None else 1000 + msg_id, timezone.utc),
+        sender_id=1,
+        sender=SimpleNamespace(name=sender) if sender else None,
+        text=f"m{msg_id}",
+        reply_to=SimpleNamespace(reply_to_msg_id=reply_to, reply_to_top_id=top) if reply_to else None,
+        grouped_id=None,
+        action=action,
+    )
+
+
+def ids(messages):
+    return [m.id for m in messages]
+
+
+def test_live_messages_are_covered_and_gaps_are_unknown():
+    history = LocalHistory(window=100)
+    for msg_id in (10, 11, 14):
+        history.observe(msg(msg_id))
+    assert history.exists(CHAT, 11) is True
+    assert history.exists(CHAT, 12) is None
+    assert history.exists(CHAT, 9) is None
+    assert history.recent(CHAT, 5) is None
+    history.observe(msg(12))
+    history.observe(msg(13))
+    assert history.exists(CHAT, 12) is True
+    assert ids(history.recent(CHAT, 3)) == [14, 13, 12]
+
+
+def test_history_fetch_marks_missing_ids_as_deleted():
+    history = LocalHistory(window=100)
+    history.observe_history(CHAT, [msg(20), msg(18), msg(15)])
+    assert history.exists(CHAT, 16) is False
+    assert history.exists(CHAT, 14) is None
+    # min_id 拉取且没被截断时，从 min_id + 1 起都算已观察
+    history.observe_history(CHAT, [msg(25), msg(22)], lo=21)
+    assert history.exists(CHAT, 21) is False
+    assert history.exists(CHAT, 25) is True
+
+
+def test_history_fetch_keeps_live_deletions():
+    history = LocalHistory(window=100)
+    history.observe(msg(30))
+    history.mark_deleted(CHAT, [30])
+    history.observe_history(CHAT, [msg(31), msg(30), msg(29)])
+    assert history.exists(CHAT, 30) is False
+    assert history.get(CHAT, 30) is None
+
+
+def test_recent_matches_iter_messages_semantics():
+    history = LocalHistory(window=100)
+    history.observe_history(CHAT, [msg(i) for i in range(1, 11)])
+    history.mark_deleted(CHAT, [9])
+    assert ids(history.recent(CHAT, 3)) == [10, 8, 7]
+    # until_ts：遇到不晚于该时间的消息即停止，该条不返回
+    assert ids(history.recent(CHAT, 10, until_ts=1000 + 6)) == [10, 8, 7]
+    # 整个群都在窗口内（first_id == 1）时不足 limit 也是完整结果
+    assert ids(history.recent(CHAT, 50)) == [10, 8, 7, 6, 5, 4, 3, 2, 1]
+
+
+def test_recent_is_unknown_when_window_does_not_reach_far_enough():
+    history = LocalHistory(window=100)
+    history.observe_history(CHAT, [msg(i) for i in range(50, 60)])
+    assert ids(history.recent(CHAT, 5)) == [59, 58, 57, 56, 55]
+    assert history.recent(CHAT, 20) is None
+
+
+def test_recent_thread_filter_and_complete_thread():
+    history = LocalHistory(window=100)
+    history.observe_history(CHAT, [
+        msg(40), msg(41, reply_to=40), msg(42), msg(43, reply_to=41, top=40), msg(44),
+    ])
+    assert ids(history.recent(CHAT, 10, thread_id=40)) == [43, 41]
+    # 消息流的根在窗口之外时结果可能不完整
+    assert history.recent(CHAT, 10, thread_id=30) is None
+
+
+def test_unknown_sender_falls_back_unless_lookup_knows_it():
+    history = LocalHistory(window=100)
+    history.observe_history(CHAT, [msg(1), msg(2, sender=None)])
+    assert history.recent(CHAT, 5) is None
+    named = LocalHistory(window=100, lookup_sender=lambda sender_id: SimpleNamespace(name="known"))
+    named.observe_history(CHAT, [msg(1), msg(2, sender=None)])
+    assert [m.sender.name for m in named.recent(CHAT, 5)] == ["known", "cs"]
+
+
+def test_eviction_moves_coverage_start():
+    history = LocalHistory(window=5)
+    for msg_id in range(1, 11):
+        history.observe(msg(msg_id))
+    assert history.exists(CHAT, 5) is None
+    assert history.exists(CHAT, 6) is True
+    assert ids(history.recent(CHAT, 5)) == [10, 9, 8, 7, 6]
+    assert history.recent(CHAT, 6) is None
+
+
+def test_far_jump_resets_the_window():
+    history = LocalHistory(window=5)
+    history.observe(msg(1))
+    history.observe(msg(100))
+    assert history.exists(CHAT, 1) is None
+    assert history.exists(CHAT, 100) is True
+    assert history.stats()["resets"] == 1
@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from message_batcher import MessageBatcher
+
+
+class Fetcher:
+    def __init__(self, deleted=(), error=None):
+        self.calls = []
+        self.deleted = set(deleted)
+        self.error = error
+
+    async def __call__(self, chat_id, ids):
+        self.calls.append((chat_id, list(ids)))
+        await asyncio.sleep(0)
+        if self.error:
+            raise self.error
+        return [None if msg_id in self.deleted else SimpleNamespace(id=msg_id, chat_id=chat_id) for msg_id in ids]
+
+
+def test_requests_in_window_share_one_fetch_per_chat():
+    fetch = Fetcher(deleted={3})
+    batcher = MessageBatcher(fetch, window_ms=10)
+
+    async def main():
+        return await asyncio.gather(
+            batcher.get(-1, 1), batcher.get(-1, 2), batcher.get(-2, 1), batcher.get(-1, 3), batcher.get(-1, 1),
+        )
+
+    results = asyncio.run(main())
+    assert [getattr(m, "id", None) for m in results] == [1, 2, 1, None, 1]
+    assert results[2].chat_id == -2
+    assert sorted(fetch.calls) == [(-2, [1]), (-1, [1, 2, 3])]
+    stats = batcher.stats()
+    assert stats["batches"] == 2 and stats["coalesced"] == 1 and stats["inflight"] == 0
+
+
+def test_results_including_deleted_are_cached_until_invalidated():
+    fetch = Fetcher(deleted={2})
+    batcher = MessageBatcher(fetch, window_ms=0)
+
+    async def main():
+        first = await batcher.get(-1, 2)
+        second = await batcher.get(-1, 2)
+        batcher.invalidate(-1, 2)
+        fetch.deleted.clear()
+        third = await batcher.get(-1, 2)
+        return first, second, third
+
+    first, second, third = asyncio.run(main())
+    assert first is None and second is None and third.id == 2
+    assert len(fetch.calls) == 2
+    assert batcher.stats()["cache_hits"] == 1
+
+
+def test_full_batch_is_sent_without_waiting_for_the_window():
+    fetch = Fetcher()
+    batcher = MessageBatcher(fetch, window_ms=10_000, max_batch=2)
+
+    async def main():
+        return await asyncio.wait_for(asyncio.gather(batcher.get(-1, 1), batcher.get(-1, 2)), 1)
+
+    assert [m.id for m in asyncio.run(main())] == [1, 2]
+    assert fetch.calls == [(-1, [1, 2])]
+
+
+def test_fetch_error_reaches_every_caller_and_is_not_cached():
+    fetch = Fetcher(error=RuntimeError("flood"))
+    batcher = MessageBatcher(fetch, window_ms=0)
+
+    async def main():
+        results = await asyncio.gather(batcher.get(-1, 1), batcher.get(-1, 2), return_exceptions=True)
+        fetch.error = None
+        return results, await batcher.get(-1, 1)
+
+    results, retry = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retry.id == 1
+    assert batcher.stats()["errors"] == 1
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_fetch():
+    fetch = Fetcher()
+    batcher = MessageBatcher(fetch, window_ms=10)
+
+    async def main():
+        first = asyncio.ensure_future(batcher.get(-1, 1))
+        second = asyncio.ensure_future(batcher.get(-1, 1))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()).id == 1
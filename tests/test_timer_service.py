@@ -0,0 +1,118 @@
+import asyncio
+
+from timer_service import TimerService
+
+
+def _live(entry):
+    handle = entry[2]
+    return handle._state == "pending" and handle.when == entry[0]
+
+
+def test_fires_in_deadline_order():
+    fired = []
+
+    async def record(handle, name):
+        fired.append(name)
+
+    async def main():
+        service = TimerService()
+        service.call_later("t", 0.03, record, "c")
+        service.call_later("t", 0.01, record, "a")
+        service.call_later("t", 0.02, record, "b")
+        await asyncio.sleep(0.1)
+        return service.counts()
+
+    counts = asyncio.run(main())
+    assert fired == ["a", "b", "c"]
+    assert counts["t"] == {"pending": 0, "running": 0, "fired": 3}
+
+
+def test_cancel_before_deadline_skips_callback_and_runs_done_callbacks():
+    fired = []
+    done = []
+
+    async def record(handle):
+        fired.append(handle)
+
+    async def main():
+        service = TimerService()
+        handle = service.call_later("t", 0.02, record)
+        handle.add_done_callback(done.append)
+        assert handle.cancel()
+        assert not handle.cancel()
+        await asyncio.sleep(0.05)
+        return service, handle
+
+    service, handle = asyncio.run(main())
+    assert fired == []
+    assert handle.cancelled() and handle.done()
+    assert done == [handle]
+    assert service.counts()["t"]["pending"] == 0
+
+
+def test_rearm_keeps_the_same_handle_until_the_last_stage():
+    stages = []
+    done = []
+
+    async def second(handle):
+        stages.append("second")
+
+    async def first(handle):
+        stages.append("first")
+        handle.rearm(0.01, second)
+
+    async def main():
+        service = TimerService()
+        handle = service.call_later("t", 0.01, first)
+        handle.add_done_callback(done.append)
+        await asyncio.sleep(0.015)
+        assert stages == ["first"] and not handle.done()
+        await asyncio.sleep(0.05)
+        return service, handle
+
+    service, handle = asyncio.run(main())
+    assert stages == ["first", "second"]
+    assert done == [handle] and not handle.cancelled()
+    assert service.counts()["t"]["fired"] == 2
+
+
+def test_callback_error_finishes_handle_and_is_logged():
+    errors = []
+
+    class Logger:
+        def error(self, msg):
+            errors.append(msg)
+
+    async def boom(handle):
+        raise ValueError("boom")
+
+    async def main():
+        service = TimerService(logger=Logger())
+        handle = service.call_later("t", 0, boom)
+        await asyncio.sleep(0.02)
+        return service, handle
+
+    service, handle = asyncio.run(main())
+    assert handle.done() and not handle.cancelled()
+    assert len(errors) == 1 and "boom" in errors[0]
+    assert service.counts()["t"]["running"] == 0
+
+
+def test_lazy_deletion_compacts_and_keeps_stale_count_exact():
+    async def noop(handle):
+        pass
+
+    async def main():
+        service = TimerService()
+        handles = [service.call_later("t", 60 + i, noop) for i in range(200)]
+        for handle in handles[:150]:
+            handle.cancel()
+            # 惰性删除的计数必须始终等于堆里死条目的实际数量
+            assert service._stale == sum(1 for entry in service._heap if not _live(entry))
+        assert len(service._heap) < 200
+        assert service.counts()["t"]["pending"] == 50
+        assert sorted(entry[2] for entry in service._heap if _live(entry)) == handles[150:]
+        for handle in handles[150:]:
+            handle.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+import pytest
+
+import wait_check_checkpoints
+from wait_check_checkpoints import GroupCheckpoint, RunCheckpoint, WaitCheckCheckpoints
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [10_000.0]
+    monkeypatch.setattr(wait_check_checkpoints.time, "time", lambda: now[0])
+    return now
+
+
+def make_run(scan_start=100, chat_id=-1, last_id=50, results=None):
+    run = RunCheckpoint(scan_start)
+    run.groups[chat_id] = GroupCheckpoint(last_id=last_id, results=results or {})
+    return run
+
+
+def test_settled_and_carried_respect_last_id_and_basis():
+    checkpoint = GroupCheckpoint(last_id=50, results={
+        10: (True, '{"closed": 10}', 60),
+        11: (False, '{"open": 11}', 60),
+        12: (True, '{"closed": 12}', None),
+    })
+    # 上次没留下结果的已扫描消息无需重判
+    assert checkpoint.settled(5)
+    assert not checkpoint.settled(51)
+    # 闭环结论只在判定依据（消息流最新一条）不变时沿用
+    assert checkpoint.settled(10, basis=60)
+    assert checkpoint.carried(10, basis=60) == '{"closed": 10}'
+    assert not checkpoint.settled(10, basis=61)
+    assert checkpoint.carried(10, basis=61) is None
+    # 未闭环的结果每次都要重新判定
+    assert not checkpoint.settled(11, basis=60)
+    assert checkpoint.carried(11, basis=60) is None
+    assert checkpoint.settled(12) and checkpoint.carried(12) == '{"closed": 12}'
+
+
+def test_checkpoint_without_last_id_settles_nothing():
+    assert not GroupCheckpoint().settled(1)
+
+
+def test_load_falls_back_to_full_scan_on_ttl_and_earlier_window(clock):
+    checkpoints = WaitCheckCheckpoints(ttl=60)
+    checkpoints.save("k", make_run(scan_start=100))
+    assert checkpoints.load("k", 100) is not None
+    assert checkpoints.load("k", 150) is not None
+    assert checkpoints.load("k", 99) is None
+    assert checkpoints.load("other", 100) is None
+    clock[0] += 61
+    assert checkpoints.load("k", 100) is None
+    stats = checkpoints.stats()
+    assert stats["loads"] == 5 and stats["reused"] == 2 and stats["full"] == 3
+
+
+def test_invalidate_marks_only_scanned_range_dirty(clock):
+    checkpoints = WaitCheckCheckpoints()
+    run = make_run(last_id=50)
+    checkpoints.save("k", run)
+    checkpoints.invalidate(-1, [60, 70])
+    assert checkpoints.group(run, -1) is not None
+    checkpoints.invalidate(-1, [70, 40])
+    assert checkpoints.group(run, -1) is None
+    assert checkpoints.stats()["invalidated"] == 1
+    assert checkpoints.group(None, -1) is None
+
+
+def test_edits_during_a_run_are_applied_when_it_is_saved(clock):
+    checkpoints = WaitCheckCheckpoints()
+    run = make_run(last_id=50)
+    clock[0] += 1
+    # 检测进行中（断点尚未保存）发生的编辑/删除
+    checkpoints.invalidate(-1, [45])
+    checkpoints.save("k", run)
+    assert checkpoints.group(run, -1) is None
+
+
+def test_edits_before_a_run_started_do_not_dirty_it(clock):
+    checkpoints = WaitCheckCheckpoints()
+    checkpoints.invalidate(-1, [45])
+    clock[0] += 1
+    run = make_run(last_id=50)
+    checkpoints.save("k", run)
+    assert checkpoints.group(run, -1) is not None
+
+
+def test_oldest_runs_are_evicted(clock):
+    checkpoints = WaitCheckCheckpoints(max_runs=2)
+    for key in ("a", "b", "c"):
+        checkpoints.save(key, make_run())
+    assert checkpoints.load("a", 100) is None
+    assert checkpoints.load("c", 100) is not None
+    assert checkpoints.stats()["runs"] == 2
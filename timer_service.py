@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+import itertools
+from collections import defaultdict
+
+
+class TimerHandle:
+    """
+    call_later 返回的句柄，用法与 asyncio.Task 保持一致：cancel() / cancelled() / done() / add_done_callback()。
+    到期后回调在独立 task 中运行（此时 cancel() 会取消该 task）；回调内可用 rearm() 把同一句柄重新排期。
+    """
+
+    __slots__ = ("kind", "when", "_service", "_callback", "_args", "_state", "_task", "_done_callbacks", "_rearmed")
+
+    def __init__(self, service, kind, when, callback, args):
+        self.kind = kind
+        self.when = when
+        self._service = service
+        self._callback = callback
+        self._args = args
+        self._state = "pending"  # pending -> running -> done；cancel 直接进入 done
+        self._task = None
+        self._done_callbacks = []
+        self._rearmed = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        if self._state == "pending":
+            # 先标记为已取消再通知 service：_discard 可能触发重建，重建只保留仍是 pending 的条目
+            self._state = "cancelled"
+            self._service._discard(self)
+            self._finish(cancelled=True)
+            return True
+        if self._state == "running" and self._task is not None:
+            return self._task.cancel()
+        return False
+
+    def cancelled(self):
+        return self._state == "cancelled"
+
+    def done(self):
+        return self._state in ("done", "cancelled")
+
+    def add_done_callback(self, fn):
+        if self.done():
+            self._service._loop.call_soon(fn, self)
+        else:
+            self._done_callbacks.append(fn)
+
+    def rearm(self, delay, callback=None):
+        """只能在本句柄的回调里调用：回调返回后句柄重新进入等待（可换成下一阶段的 callback），而不是结束。"""
+        self.when = self._service._loop.time() + max(0.0, float(delay))
+        if callback is not None:
+            self._callback = callback
+        self._rearmed = True
+
+    def _finish(self, cancelled=False):
+        self._state = "cancelled" if cancelled else "done"
+        callbacks, self._done_callbacks = self._done_callbacks, []
+        # 与 Task 一样在下一轮事件循环里回调，调用 cancel() 的代码可以先完成自己的清理
+        for fn in callbacks:
+            self._service._loop.call_soon(fn, self)
+
+
+class TimerService:
+    """
+    单协程驱动的最小堆定时器：schedule/cancel 为 O(log n)，等待期间不占用任何 task。
+    被取消的条目惰性留在堆里，占比过半时整体重建。
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self._heap = []
+        self._seq = itertools.count()
+        self._stale = 0
+        self._pending = defaultdict(int)
+        self._running = defaultdict(int)
+        self._fired = defaultdict(int)
+        self._loop = None
+        self._driver = None
+        self._wakeup = None
+
+    def call_later(self, kind, delay, callback, *args):
+        """到期时在事件循环里以 callback(handle, *args) 运行协程函数；必须在事件循环线程调用。"""
+        self._ensure_driver()
+        handle = TimerHandle(self, kind, self._loop.time() + max(0.0, float(delay)), callback, args)
+        self._push(handle)
+        return handle
+
+    def counts(self):
+        kinds = set(self._pending) | set(self._running)
+        return {
+            kind: {"pending": self._pending[kind], "running": self._running[kind], "fired": self._fired[kind]}
+            for kind in sorted(kinds)
+        }
+
+    def _ensure_driver(self):
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._driver = None
+        if self._driver is None or self._driver.done():
+            self._driver = loop.create_task(self._run())
+
+    def _push(self, handle):
+        handle._state = "pending"
+        self._pending[handle.kind] += 1
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (handle.when, next(self._seq), handle))
+        if earliest is None or handle.when < earliest:
+            self._wakeup.set()
+
+    def _discard(self, handle):
+        self._pending[handle.kind] -= 1
+        self._stale += 1
+        if self._stale > 64 and self._stale * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if entry[2]._state == "pending" and entry[2].when == entry[0]]
+            heapq.heapify(self._heap)
+            self._stale = 0
+
+    async def _run(self):
+        while True:
+            while self._heap and (self._heap[0][2]._state != "pending" or self._heap[0][2].when != self._heap[0][0]):
+                heapq.heappop(self._heap)
+                self._stale = max(0, self._stale - 1)
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - self._loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, handle = heapq.heappop(self._heap)
+            self._pending[handle.kind] -= 1
+            self._running[handle.kind] += 1
+            self._fired[handle.kind] += 1
+            handle._state = "running"
+            handle._task = self._loop.create_task(self._invoke(handle))
+
+    async def _invoke(self, handle):
+        handle._rearmed = False
+        try:
+            await handle._callback(handle, *handle._args)
+        except asyncio.CancelledError:
+            handle._rearmed = False
+        except Exception as e:
+            handle._rearmed = False
+            if self.logger:
+                self.logger.error(f"❌ [Timer] {handle.kind} 回调异常: {e}")
+        finally:
+            self._running[handle.kind] -= 1
+            handle._task = None
+            if handle._rearmed:
+                self._push(handle)
+            else:
+                handle._finish()
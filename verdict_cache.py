@@ -0,0 +1,121 @@
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict
+
+
+def verdict_key(kind, model, prompt):
+    """kind + 模型 + 空白规整后的完整 prompt 的 sha256：上下文里任何一条消息被编辑/删除、或提示词改版，都会换成新 key。"""
+    normalized = " ".join(str(prompt or "").split())
+    return hashlib.sha256(f"{kind}\x1f{model}\x1f{normalized}".encode("utf-8")).hexdigest()
+
+
+class VerdictStats:
+    """一次检测/巡检内的 AI 缓存命中统计；判定在线程池里执行，计数加锁。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: [0, 0])  # kind -> [hits, misses]
+
+    def record(self, kind, hit):
+        with self._lock:
+            self._counts[kind][0 if hit else 1] += 1
+
+    def summary(self):
+        with self._lock:
+            hits = sum(item[0] for item in self._counts.values())
+            misses = sum(item[1] for item in self._counts.values())
+            return {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+                "by_kind": {kind: {"hits": item[0], "misses": item[1]} for kind, item in sorted(self._counts.items())},
+            }
+
+
+class VerdictCache:
+    """
+    AI 判定结果的持久缓存（chat_logs.db 的 ai_verdicts 表）。读在调用线程直接查（AI 判定本来就跑在线程池里），
+    写交给 submit（单写线程），写失败只影响缓存不影响判定。只缓存 AI 正常返回的结果，出错时的兜底结论不入库。
+    """
+
+    def __init__(self, connect, submit, ttl=3 * 86400, logger=None):
+        self.connect = connect
+        self.submit = submit
+        self.ttl = ttl
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+
+    def get(self, key):
+        try:
+            conn = self.connect()
+            try:
+                row = conn.execute("SELECT verdict, created_at FROM ai_verdicts WHERE key=?", (key,)).fetchone()
+            finally:
+                conn.close()
+        except Exception:
+            row = None
+            self._count("_errors")
+        if row is None or (self.ttl and time.time() - row[1] > self.ttl):
+            self._count("_misses")
+            return None
+        try:
+            verdict = json.loads(row[0])
+        except ValueError:
+            self._count("_misses")
+            return None
+        self._count("_hits")
+        return verdict
+
+    def put(self, key, kind, model, verdict, chat_id=None, message_id=None):
+        row = (key, kind, model, json.dumps(verdict, ensure_ascii=False), chat_id, message_id, time.time())
+
+        def write(conn):
+            conn.execute(
+                """INSERT OR REPLACE INTO ai_verdicts(key, kind, model, verdict, chat_id, message_id, created_at)
+                   VALUES(?, ?, ?, ?, ?, ?, ?)""",
+                row
+            )
+
+        self._submit(write)
+
+    def invalidate_message(self, chat_id, message_id):
+        """目标消息被编辑时删掉以它为对象的判定；上下文里其他消息的编辑会自然换 key，不用额外处理。"""
+        if not chat_id or not message_id:
+            return
+        self._submit(lambda conn: conn.execute(
+            "DELETE FROM ai_verdicts WHERE chat_id=? AND message_id=?", (chat_id, message_id)
+        ))
+
+    def purge_expired(self):
+        if not self.ttl:
+            return
+        cutoff = time.time() - self.ttl
+        self._submit(lambda conn: conn.execute("DELETE FROM ai_verdicts WHERE created_at < ?", (cutoff,)))
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else None,
+                "errors": self._errors,
+            }
+
+    def _submit(self, job):
+        try:
+            self.submit(job)
+        except Exception as e:
+            self._count("_errors")
+            if self.logger:
+                self.logger.warning(f"⚠️ [VerdictCache] 写入失败: {e}")
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
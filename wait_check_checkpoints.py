@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import deque
+
+
+class GroupCheckpoint:
+    """
+    一个群在上次检测结束时的状态：last_id 为已扫描的最大消息 id，messages 为当时拉到的历史（新到旧），
+    results 为 {目标消息 id: (是否闭环, 结果 JSON, 判定依据)}。判定依据是结论所依赖的状态（如单关键词模式下
+    消息流最新一条的 id），本次依据不同时不能沿用。dirty 表示窗口内有消息被编辑/删除，不能再增量复用。
+    """
+
+    __slots__ = ("last_id", "messages", "results", "dirty")
+
+    def __init__(self, last_id=None, messages=None, results=None):
+        self.last_id = last_id
+        self.messages = list(messages or ())
+        self.results = dict(results or {})
+        self.dirty = False
+
+    def carried(self, msg_id, basis=None):
+        """上次依据相同且已判定闭环的结果 JSON；否则返回 None。"""
+        result = self.results.get(msg_id)
+        return result[1] if result and result[0] and result[2] == basis else None
+
+    def settled(self, msg_id, basis=None):
+        """上次已扫描过、且没有留下未闭环结果（或依据已变化）的消息，本次无需重新判定。"""
+        if self.last_id is None or msg_id > self.last_id:
+            return False
+        result = self.results.get(msg_id)
+        return result is None or (result[0] and result[2] == basis)
+
+
+class RunCheckpoint:
+    __slots__ = ("scan_start", "created_at", "groups")
+
+    def __init__(self, scan_start):
+        self.scan_start = scan_start
+        self.created_at = time.time()
+        self.groups = {}  # chat_id -> GroupCheckpoint
+
+
+class WaitCheckCheckpoints:
+    """
+    漏回检测的增量断点，按 (关键词, 日期) 保存最近一次检测的结果。下次检测只拉 last_id 之后的新消息，
+    只重新判定新消息和上次未闭环的候选，已闭环的结果直接沿用。
+    以下情况整体或按群退回全量扫描：断点超过 ttl、本次窗口起点早于上次、群内缓存的消息被编辑/删除、上次该群扫描失败。
+    """
+
+    def __init__(self, ttl=2 * 3600, max_runs=8):
+        self.ttl = ttl
+        self.max_runs = max(1, int(max_runs))
+        self._lock = threading.Lock()
+        self._runs = {}  # key -> RunCheckpoint
+        self._recent = deque(maxlen=2000)  # (时间, chat_id, 最小 id)：检测进行中发生的编辑/删除，保存断点时补记
+        self._stats = {"loads": 0, "reused": 0, "full": 0, "invalidated": 0}
+
+    def load(self, key, scan_start):
+        with self._lock:
+            self._stats["loads"] += 1
+            run = self._runs.get(key)
+            if run is None or (self.ttl and time.time() - run.created_at > self.ttl) or scan_start < run.scan_start:
+                self._stats["full"] += 1
+                return None
+            self._stats["reused"] += 1
+            return run
+
+    def group(self, run, chat_id):
+        if run is None:
+            return None
+        with self._lock:
+            checkpoint = run.groups.get(chat_id)
+            return None if checkpoint is None or checkpoint.dirty else checkpoint
+
+    def save(self, key, run):
+        with self._lock:
+            for ts, chat_id, msg_id in self._recent:
+                checkpoint = run.groups.get(chat_id)
+                if ts >= run.created_at and checkpoint and checkpoint.last_id is not None and msg_id <= checkpoint.last_id:
+                    checkpoint.dirty = True
+            self._runs.pop(key, None)
+            self._runs[key] = run
+            while len(self._runs) > self.max_runs:
+                del self._runs[next(iter(self._runs))]
+
+    def invalidate(self, chat_id, msg_ids):
+        """群内已扫描范围里的消息被编辑/删除：该群下次全量扫描。"""
+        msg_ids = [msg_id for msg_id in msg_ids or () if msg_id]
+        if not msg_ids:
+            return
+        with self._lock:
+            self._recent.append((time.time(), chat_id, min(msg_ids)))
+            for run in self._runs.values():
+                checkpoint = run.groups.get(chat_id)
+                if checkpoint and not checkpoint.dirty and checkpoint.last_id is not None and min(msg_ids) <= checkpoint.last_id:
+                    checkpoint.dirty = True
+                    self._stats["invalidated"] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["runs"] = len(self._runs)
+            data["messages"] = sum(len(cp.messages) for run in self._runs.values() for cp in run.groups.values())
+        data["ttl"] = self.ttl
+        return data